@@ -6,3 +6,13 @@ cp src/index.html plugin/omero_iviewer/templates/omero_iviewer
 cp -r build/css/* plugin/omero_iviewer/static/omero_iviewer/css
 cp build/*.js* plugin/omero_iviewer/static/omero_iviewer/
 cp src/openwith.js plugin/omero_iviewer/static/omero_iviewer/
+
+#precompress js and css for web servers serving static files as is
+echo "Precompressing static resources..."
+for f in $(find plugin/omero_iviewer/static/omero_iviewer \
+               -name "*.js" -o -name "*.css"); do
+    gzip -9 -n -c "$f" > "$f.gz"
+    if command -v brotli > /dev/null; then
+        brotli -f -q 11 -o "$f.br" "$f"
+    fi
+done
@@ -0,0 +1,181 @@
+#
+# Copyright (c) 2017 University of Dundee.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from collections import OrderedDict
+from threading import RLock
+from time import time
+
+
+# the named caches by name
+CACHES = OrderedDict()
+
+
+class LRUCache(object):
+
+    """
+    A thread safe, bounded, in memory least recently used cache.
+
+    The size of an entry is determined by size_of (1 per entry by default),
+    least recently used entries are evicted whenever the accumulated size
+    exceeds max_size. If ttl (in seconds) is given, entries expire after
+    that time. on_evict is called with key and value for every entry that
+    is removed from the cache for reasons other than being overwritten.
+    Named caches are listed in CACHES (e.g. for exporting their stats).
+    """
+
+    def __init__(self, max_size, size_of=None, ttl=None, on_evict=None,
+                 name=None):
+        self.max_size = max_size
+        self.size_of = size_of
+        self.ttl = ttl
+        self.on_evict = on_evict
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = RLock()
+        if name is not None:
+            CACHES[name] = self
+
+    def get(self, key, default=None):
+        """
+        Returns the value for key (marking it as recently used)
+        or default if there is no (unexpired) entry
+        """
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None and self.ttl is not None and \
+                    time() - entry[2] > self.ttl:
+                self.size -= entry[1]
+                self.evictions += 1
+                self.notify_evicted(key, entry[0])
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return default
+            self.entries[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value):
+        """
+        Adds/replaces the entry for key evicting least recently used
+        entries if the max size is exceeded. Entries that are larger
+        than max size are not cached at all (and handed to on_evict).
+        """
+        size = 1 if self.size_of is None else self.size_of(value)
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            if size > self.max_size:
+                self.notify_evicted(key, value)
+                return
+            self.entries[key] = (value, size, time())
+            self.size += size
+            while self.size > self.max_size:
+                evicted_key, evicted = self.entries.popitem(last=False)
+                self.size -= evicted[1]
+                self.evictions += 1
+                self.notify_evicted(evicted_key, evicted[0])
+
+    def pop(self, key, default=None):
+        """
+        Removes the entry for key returning its value or default
+        if there is no (unexpired) entry. on_evict is only called
+        for expired entries.
+        """
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.size -= entry[1]
+                if self.ttl is not None and time() - entry[2] > self.ttl:
+                    self.evictions += 1
+                    self.notify_evicted(key, entry[0])
+                    entry = None
+            if entry is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            return entry[0]
+
+    def invalidate(self, match=None):
+        """
+        Removes all entries whose key satisfies match (all if None),
+        returning the number of removed entries
+        """
+        with self.lock:
+            keys = [key for key in self.entries
+                    if match is None or match(key)]
+            for key in keys:
+                entry = self.entries.pop(key)
+                self.size -= entry[1]
+                self.notify_evicted(key, entry[0])
+            return len(keys)
+
+    def expire(self):
+        """
+        Removes all expired entries (if a ttl was given)
+        """
+        if self.ttl is None:
+            return 0
+        now = time()
+        with self.lock:
+            keys = [key for key, entry in self.entries.items()
+                    if now - entry[2] > self.ttl]
+            for key in keys:
+                entry = self.entries.pop(key)
+                self.size -= entry[1]
+                self.evictions += 1
+                self.notify_evicted(key, entry[0])
+            return len(keys)
+
+    def notify_evicted(self, key, value):
+        if self.on_evict is None:
+            return
+        try:
+            self.on_evict(key, value)
+        except Exception:
+            pass
+
+    def stats(self):
+        """
+        Returns a dictionary with counters and current size
+        """
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'size': self.size,
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
+
+    def keys(self):
+        """
+        Returns the keys, least recently used first
+        """
+        with self.lock:
+            return list(self.entries.keys())
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
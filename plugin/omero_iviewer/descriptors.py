@@ -0,0 +1,135 @@
+#
+# Copyright (c) 2017 University of Dundee.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from omero.rtypes import unwrap
+from omero_sys_ParametersI import ParametersI
+
+import iviewer_settings
+from cache import LRUCache
+from metrics import phase
+from pixels import get_cache_scope
+
+
+# image descriptors, keyed by session, group and image id
+IMAGE_DESCRIPTOR_CACHE = LRUCache(
+    iviewer_settings.IMAGE_DESCRIPTOR_CACHE_SIZE,
+    ttl=iviewer_settings.IMAGE_DESCRIPTOR_CACHE_TTL,
+    name='image_descriptor')
+
+
+class ImageDescriptor(object):
+
+    """
+    The immutable essentials of an image (dimensions, pixels, group and
+    physical sizes) needed by the views that don't need the image itself.
+    The getters are named like the ones of the gateway's ImageWrapper.
+    """
+
+    def __init__(self, image):
+        pixels = image.getPrimaryPixels()
+        self.id = image.getId().getValue()
+        self.group_id = image.getDetails().getGroup().getId().getValue()
+        self.pixels_id = pixels.getId().getValue()
+        self.pixels_type = pixels.getPixelsType().getValue().getValue()
+        self.size_x = pixels.getSizeX().getValue()
+        self.size_y = pixels.getSizeY().getValue()
+        self.size_z = pixels.getSizeZ().getValue()
+        self.size_c = pixels.getSizeC().getValue()
+        self.size_t = pixels.getSizeT().getValue()
+        self.physical_sizes = tuple([
+            get_length(size) for size in [
+                pixels.getPhysicalSizeX(), pixels.getPhysicalSizeY(),
+                pixels.getPhysicalSizeZ()]])
+
+    def getId(self):
+        return self.id
+
+    def getGroupId(self):
+        return self.group_id
+
+    def getPixelsId(self):
+        return self.pixels_id
+
+    def getPixelsType(self):
+        return self.pixels_type
+
+    def getSizeX(self):
+        return self.size_x
+
+    def getSizeY(self):
+        return self.size_y
+
+    def getSizeZ(self):
+        return self.size_z
+
+    def getSizeC(self):
+        return self.size_c
+
+    def getSizeT(self):
+        return self.size_t
+
+    def getPhysicalSizes(self):
+        """
+        Returns the physical sizes x, y and z as (value, unit) tuples
+        (None if not set)
+        """
+        return self.physical_sizes
+
+
+def get_length(length):
+    """
+    Returns an omero length as (value, unit) tuple, None if not set
+    """
+    if length is None:
+        return None
+    return (unwrap(length.getValue()), str(length.getUnit()))
+
+
+def get_image_descriptor(conn, image_id):
+    """
+    Returns the (cached) ImageDescriptor of the given image
+    or None if it doesn't exist (or isn't visible)
+    """
+    image_id = long(image_id)
+    key = get_cache_scope(conn) + (image_id,)
+    descriptor = IMAGE_DESCRIPTOR_CACHE.get(key)
+    if descriptor is not None:
+        return descriptor
+
+    # like conn.getObject we look across groups unless one is set
+    params = ParametersI()
+    params.addId(image_id)
+    ctx = conn.SERVICE_OPTS.copy()
+    if ctx.getOmeroGroup() is None:
+        ctx.setOmeroGroup(-1)
+    with phase('query'):
+        image = conn.getQueryService().findByQuery(
+            "select i from Image i join fetch i.pixels p " +
+            "join fetch p.pixelsType where i.id = :id", params, ctx)
+    if image is None:
+        return None
+    descriptor = ImageDescriptor(image)
+    IMAGE_DESCRIPTOR_CACHE.set(key, descriptor)
+    return descriptor
+
+
+def invalidate_image_descriptor(image_id):
+    """
+    Removes the cached descriptors of the given image
+    """
+    image_id = long(image_id)
+    IMAGE_DESCRIPTOR_CACHE.invalidate(lambda key: key[2] == image_id)
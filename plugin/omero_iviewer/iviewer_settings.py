@@ -0,0 +1,188 @@
+#
+# Copyright (c) 2017 University of Dundee.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import json
+import sys
+from omeroweb.settings import process_custom_settings, report_settings, \
+    parse_boolean
+
+# load settings
+IVIEWER_SETTINGS_MAPPING = {
+    "omero.web.iviewer.tile_cache_max_bytes":
+        ["TILE_CACHE_MAX_BYTES",
+         67108864,
+         int,
+         "Maximum number of bytes of decoded pixel data kept in memory"
+         " for intensity queries (per web worker). 0 disables the cache."],
+    "omero.web.iviewer.tile_cache_block_size":
+        ["TILE_CACHE_BLOCK_SIZE",
+         128,
+         int,
+         "Edge length of the aligned pixel blocks that intensity"
+         " queries are fetched and cached in."],
+    "omero.web.iviewer.raw_pixels_store_pool_size":
+        ["RAW_PIXELS_STORE_POOL_SIZE",
+         64,
+         int,
+         "Maximum number of idle RawPixelsStores kept open for reuse"
+         " (per web worker). 0 disables pooling."],
+    "omero.web.iviewer.raw_pixels_store_pool_size_per_user":
+        ["RAW_PIXELS_STORE_POOL_SIZE_PER_USER",
+         4,
+         int,
+         "Maximum number of idle RawPixelsStores kept open per user"
+         " (across all of their sessions)."],
+    "omero.web.iviewer.raw_pixels_store_idle_timeout":
+        ["RAW_PIXELS_STORE_IDLE_TIMEOUT",
+         60,
+         int,
+         "Number of seconds after which an idle RawPixelsStore is closed."],
+    "omero.web.iviewer.projection_workers":
+        ["PROJECTION_WORKERS",
+         2,
+         int,
+         "Number of threads (per web worker) running projection jobs."],
+    "omero.web.iviewer.projection_jobs_per_user":
+        ["PROJECTION_JOBS_PER_USER",
+         2,
+         int,
+         "Maximum number of queued/running projection jobs per user."],
+    "omero.web.iviewer.projection_async":
+        ["PROJECTION_ASYNC",
+         "false",
+         parse_boolean,
+         "Whether the viewer saves projections as background jobs and polls"
+         " for their status. The jobs are only known to the web worker"
+         " process running them, so only enable this if OMERO.web runs"
+         " a single worker process."],
+    "omero.web.iviewer.image_data_cache_size":
+        ["IMAGE_DATA_CACHE_SIZE",
+         1000,
+         int,
+         "Maximum number of image_data responses cached (per web worker)."
+         " 0 disables the cache."],
+    "omero.web.iviewer.image_data_cache_ttl":
+        ["IMAGE_DATA_CACHE_TTL",
+         300,
+         int,
+         "Number of seconds a cached image_data response is valid for."],
+    "omero.web.iviewer.image_descriptor_cache_size":
+        ["IMAGE_DESCRIPTOR_CACHE_SIZE",
+         1000,
+         int,
+         "Maximum number of image descriptors (dimensions, pixels type,"
+         " group and physical sizes) cached (per web worker)."
+         " 0 disables the cache."],
+    "omero.web.iviewer.image_descriptor_cache_ttl":
+        ["IMAGE_DESCRIPTOR_CACHE_TTL",
+         60,
+         int,
+         "Number of seconds a cached image descriptor is valid for."],
+    "omero.web.iviewer.shape_stats_cache_size":
+        ["SHAPE_STATS_CACHE_SIZE",
+         10000,
+         int,
+         "Maximum number of (per shape, plane and channel) statistics"
+         " cached (per web worker). 0 disables the cache."],
+    "omero.web.iviewer.shape_stats_engine":
+        ["SHAPE_STATS_ENGINE",
+         "server",
+         str,
+         "Where shape statistics are computed by default: 'server' (the"
+         " OMERO rois service) or 'local' (in the web worker using numpy)."],
+    "omero.web.iviewer.shape_index_cache_size":
+        ["SHAPE_INDEX_CACHE_SIZE",
+         100,
+         int,
+         "Maximum number of images whose spatial shape index is cached"
+         " (per web worker). 0 disables the cache."],
+    "omero.web.iviewer.shape_index_cell_shapes":
+        ["SHAPE_INDEX_CELL_SHAPES",
+         16,
+         int,
+         "Average number of shapes per grid cell of the spatial shape"
+         " index, which determines its cell size."],
+    "omero.web.iviewer.histogram_cache_size":
+        ["HISTOGRAM_CACHE_SIZE",
+         1000,
+         int,
+         "Maximum number of (per plane and channel) histograms cached"
+         " (per web worker). 0 disables the cache."],
+    "omero.web.iviewer.histogram_max_samples":
+        ["HISTOGRAM_MAX_SAMPLES",
+         4194304,
+         int,
+         "Maximum number of pixels read for a histogram. Histograms of"
+         " bigger planes are computed from a random selection of blocks."],
+    "omero.web.iviewer.image_stats_percentiles":
+        ["IMAGE_STATS_PERCENTILES",
+         "[0.1, 99.9]",
+         json.loads,
+         "The per channel intensity percentiles computed for"
+         " auto-contrast."],
+    "omero.web.iviewer.image_stats_max_planes":
+        ["IMAGE_STATS_MAX_PLANES",
+         10,
+         int,
+         "Maximum number of (evenly spaced) z/t planes the percentiles"
+         " are computed from."],
+    "omero.web.iviewer.image_stats_max_samples":
+        ["IMAGE_STATS_MAX_SAMPLES",
+         4194304,
+         int,
+         "Maximum number of pixels (per channel) the percentiles"
+         " are computed from."],
+    "omero.web.iviewer.image_stats_cache_size":
+        ["IMAGE_STATS_CACHE_SIZE",
+         10000,
+         int,
+         "Maximum number of images whose percentiles are cached"
+         " (per web worker). 0 disables the cache."],
+    "omero.web.iviewer.image_stats_workers":
+        ["IMAGE_STATS_WORKERS",
+         1,
+         int,
+         "Number of threads (per web worker) computing percentiles."],
+    "omero.web.iviewer.image_stats_jobs_per_user":
+        ["IMAGE_STATS_JOBS_PER_USER",
+         4,
+         int,
+         "Maximum number of queued/running percentile jobs per user."],
+    "omero.web.iviewer.image_stats_on_open":
+        ["IMAGE_STATS_ON_OPEN",
+         "false",
+         parse_boolean,
+         "Whether opening an image (image_data) starts computing its"
+         " percentiles if they aren't known yet. The percentiles are"
+         " cached per web worker, so each worker computes them again."],
+    "omero.web.iviewer.metrics_enabled":
+        ["METRICS_ENABLED",
+         "false",
+         parse_boolean,
+         "Whether request metrics are recorded and exported (Prometheus"
+         " text format) at iviewer's metrics/ url, which doesn't require"
+         " a login."],
+    "omero.web.iviewer.server_timing":
+        ["SERVER_TIMING",
+         "false",
+         parse_boolean,
+         "Whether responses carry a Server-Timing header with the time"
+         " spent in the phases of the request."],
+}
+
+process_custom_settings(sys.modules[__name__], 'IVIEWER_SETTINGS_MAPPING')
+report_settings(sys.modules[__name__])
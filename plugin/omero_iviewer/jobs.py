@@ -0,0 +1,174 @@
+#
+# Copyright (c) 2017 University of Dundee.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from Queue import Queue
+from threading import RLock, Thread
+from time import time
+from uuid import uuid4
+
+import omero.clients
+from omero.gateway import BlitzGateway
+
+import iviewer_settings
+
+
+# finished jobs are kept around (for status queries) for (in seconds)
+JOB_RETENTION = 3600
+
+
+def clone_connection(conn):
+    """
+    Returns a new connection joining the session of conn (with a copy
+    of its service options) which, unlike conn, can be used beyond the
+    request. Closing it doesn't end the session.
+    """
+    client = omero.client(host=conn.host, port=conn.port)
+    client.joinSession(conn.c.getSessionId()).detachOnDestroy()
+    cloned_conn = BlitzGateway(client_obj=client)
+    cloned_conn.SERVICE_OPTS = conn.SERVICE_OPTS.copy()
+    return cloned_conn
+
+
+class Job(object):
+
+    """
+    A job that is run by the JobQueue in the background.
+    Its state is one of: queued, running, finished or failed
+    """
+
+    def __init__(self, owner, steps=1, key=None):
+        self.id = uuid4().hex
+        self.owner = owner
+        self.key = key
+        self.state = 'queued'
+        self.steps = steps
+        self.steps_done = 0
+        self.result = None
+        self.error = None
+        self.created = time()
+        self.finished = None
+
+    def step(self):
+        """
+        Marks one more of the job's steps as done (for progress reports)
+        """
+        self.steps_done = min(self.steps_done + 1, self.steps)
+
+    def is_active(self):
+        return self.state in ['queued', 'running']
+
+    def as_dict(self):
+        return {
+            'job': self.id,
+            'state': self.state,
+            'progress': float(self.steps_done) / self.steps,
+            'result': self.result,
+            'error': self.error
+        }
+
+
+class JobQueue(object):
+
+    """
+    Runs submitted jobs in a fixed number of (daemon) worker threads,
+    limiting the number of active jobs per owner
+    """
+
+    def __init__(self, workers, max_per_owner):
+        self.workers = workers
+        self.max_per_owner = max_per_owner
+        self.queue = Queue()
+        self.jobs = {}
+        self.threads = []
+        self.lock = RLock()
+
+    def submit(self, owner, func, steps=1, key=None):
+        """
+        Queues func which will be called with the job as argument, its
+        return value becomes the job's result. Returns the job or None if
+        the owner has reached the maximum number of active jobs.
+        The optional key identifies the job's work (see find)
+        """
+        with self.lock:
+            self.prune()
+            active = [j for j in self.jobs.values()
+                      if j.owner == owner and j.is_active()]
+            if len(active) >= self.max_per_owner:
+                return None
+            job = Job(owner, steps, key)
+            self.jobs[job.id] = job
+            while len(self.threads) < self.workers:
+                thread = Thread(target=self.work)
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+        self.queue.put((job, func))
+        return job
+
+    def get(self, job_id, owner):
+        """
+        Returns the job for the given id if it belongs to owner
+        """
+        with self.lock:
+            job = self.jobs.get(job_id, None)
+        if job is None or job.owner != owner:
+            return None
+        return job
+
+    def find(self, key):
+        """
+        Returns an active job (of any owner) with the given key
+        """
+        with self.lock:
+            for job in self.jobs.values():
+                if job.key == key and job.is_active():
+                    return job
+        return None
+
+    def prune(self):
+        now = time()
+        with self.lock:
+            for job_id in list(self.jobs.keys()):
+                job = self.jobs[job_id]
+                if job.finished is not None and \
+                        now - job.finished > JOB_RETENTION:
+                    del self.jobs[job_id]
+
+    def work(self):
+        while True:
+            job, func = self.queue.get()
+            job.state = 'running'
+            try:
+                job.result = func(job)
+                job.steps_done = job.steps
+                job.state = 'finished'
+            except Exception as job_exception:
+                job.error = repr(job_exception)
+                job.state = 'failed'
+            finally:
+                job.finished = time()
+                self.queue.task_done()
+
+
+PROJECTION_JOBS = JobQueue(
+    iviewer_settings.PROJECTION_WORKERS,
+    iviewer_settings.PROJECTION_JOBS_PER_USER)
+
+
+IMAGE_STATS_JOBS = JobQueue(
+    iviewer_settings.IMAGE_STATS_WORKERS,
+    iviewer_settings.IMAGE_STATS_JOBS_PER_USER)
@@ -0,0 +1,213 @@
+#
+# Copyright (c) 2017 University of Dundee.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import wraps
+from threading import RLock, local
+from time import time
+
+import iviewer_settings
+from cache import CACHES
+
+
+# the upper bounds (in seconds) of the request duration histogram buckets
+DURATION_BUCKETS = [
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0]
+
+# the metrics of the request handled by the current thread (if any)
+CURRENT = local()
+
+
+def is_enabled():
+    return iviewer_settings.METRICS_ENABLED or \
+        iviewer_settings.SERVER_TIMING
+
+
+class RequestMetrics(object):
+
+    """
+    The time spent in the phases of one request and the number of OMERO
+    calls made in them
+    """
+
+    def __init__(self):
+        self.phases = OrderedDict()
+
+    def add(self, name, seconds, calls):
+        duration, count = self.phases.get(name, (0.0, 0))
+        self.phases[name] = (duration + seconds, count + calls)
+
+    def server_timing(self, total):
+        """
+        Returns the value of the Server-Timing header: the phases, the
+        remaining (other) and total time in milliseconds
+        """
+        timings = [(name, duration)
+                   for name, (duration, count) in self.phases.items()]
+        other = total - sum([duration for name, duration in timings])
+        timings += [('other', max(other, 0.0)), ('total', total)]
+        return ", ".join([
+            "%s;dur=%.1f" % (name, duration * 1000)
+            for name, duration in timings])
+
+
+@contextmanager
+def phase(name, calls=1):
+    """
+    Times the enclosed block as phase of the current request (if there
+    is one) which makes the given number of OMERO calls
+    """
+    metrics = getattr(CURRENT, 'metrics', None)
+    if metrics is None:
+        yield
+        return
+    start = time()
+    try:
+        yield
+    finally:
+        metrics.add(name, time() - start, calls)
+
+
+class MetricsRegistry(object):
+
+    """
+    Accumulates the metrics of all requests per view (thread safe)
+    """
+
+    def __init__(self):
+        self.requests = {}
+        self.durations = {}
+        self.response_bytes = {}
+        self.phases = {}
+        self.lock = RLock()
+
+    def observe(self, view, status, duration, size, request_metrics):
+        with self.lock:
+            key = (view, status)
+            self.requests[key] = self.requests.get(key, 0) + 1
+            buckets, total = self.durations.get(
+                view, ([0] * len(DURATION_BUCKETS), 0.0))
+            for i, bound in enumerate(DURATION_BUCKETS):
+                if duration <= bound:
+                    buckets[i] += 1
+            self.durations[view] = (buckets, total + duration)
+            self.response_bytes[view] = \
+                self.response_bytes.get(view, 0) + size
+            for name, (seconds, calls) in request_metrics.phases.items():
+                total_seconds, total_calls = self.phases.get(
+                    (view, name), (0.0, 0))
+                self.phases[(view, name)] = \
+                    (total_seconds + seconds, total_calls + calls)
+
+    def render(self):
+        """
+        Returns the metrics (and the stats of the named caches)
+        in the Prometheus text exposition format
+        """
+        lines = []
+
+        def add(name, metric_type, description, samples):
+            lines.append("# HELP %s %s" % (name, description))
+            lines.append("# TYPE %s %s" % (name, metric_type))
+            for suffix, labels, value in samples:
+                lines.append("%s%s{%s} %s" % (
+                    name, suffix,
+                    ",".join(['%s="%s"' % label for label in labels]),
+                    repr(float(value))))
+
+        with self.lock:
+            add("iviewer_requests_total", "counter",
+                "Number of requests per view and status code",
+                [("", [("view", view), ("status", status)], count)
+                 for (view, status), count in sorted(self.requests.items())])
+            samples = []
+            for view, (buckets, total) in sorted(self.durations.items()):
+                count = sum([c for (v, s), c in self.requests.items()
+                             if v == view])
+                for bound, bucket in zip(DURATION_BUCKETS, buckets):
+                    samples.append(
+                        ("_bucket", [("view", view), ("le", repr(bound))],
+                         bucket))
+                samples.append(
+                    ("_bucket", [("view", view), ("le", "+Inf")], count))
+                samples.append(("_sum", [("view", view)], total))
+                samples.append(("_count", [("view", view)], count))
+            add("iviewer_request_duration_seconds", "histogram",
+                "Duration of the requests per view", samples)
+            add("iviewer_response_bytes_total", "counter",
+                "Size of the (non streamed) responses per view",
+                [("", [("view", view)], size)
+                 for view, size in sorted(self.response_bytes.items())])
+            add("iviewer_phase_duration_seconds_total", "counter",
+                "Time spent per view and phase",
+                [("", [("view", view), ("phase", name)], seconds)
+                 for (view, name), (seconds, calls)
+                 in sorted(self.phases.items())])
+            add("iviewer_omero_calls_total", "counter",
+                "Number of OMERO calls per view and phase",
+                [("", [("view", view), ("phase", name)], calls)
+                 for (view, name), (seconds, calls)
+                 in sorted(self.phases.items())])
+
+        caches = [(name, cache.stats()) for name, cache in CACHES.items()]
+        for stat, metric_type, description in [
+                ('entries', 'gauge', 'Number of entries per cache'),
+                ('size', 'gauge', 'Size of the entries per cache'),
+                ('max_size', 'gauge', 'Maximum size per cache'),
+                ('hits', 'counter', 'Number of hits per cache'),
+                ('misses', 'counter', 'Number of misses per cache'),
+                ('evictions', 'counter', 'Number of evictions per cache')]:
+            suffix = '_total' if metric_type == 'counter' else ''
+            add("iviewer_cache_" + stat + suffix, metric_type, description,
+                [("", [("cache", name)], stats[stat])
+                 for name, stats in caches])
+        return "\n".join(lines) + "\n"
+
+
+METRICS = MetricsRegistry()
+
+
+def instrumented(view):
+    """
+    Decorates a view recording its duration, response size and the
+    phases (see phase) of each request in METRICS and, if configured,
+    reporting them in a Server-Timing header
+    """
+    @wraps(view)
+    def wrapped(request, *args, **kwargs):
+        if not is_enabled():
+            return view(request, *args, **kwargs)
+        request_metrics = RequestMetrics()
+        CURRENT.metrics = request_metrics
+        start = time()
+        try:
+            response = view(request, *args, **kwargs)
+        finally:
+            CURRENT.metrics = None
+        duration = time() - start
+        size = 0 if getattr(response, 'streaming', False) \
+            else len(response.content)
+        if iviewer_settings.METRICS_ENABLED:
+            METRICS.observe(
+                view.__name__, response.status_code, duration, size,
+                request_metrics)
+        if iviewer_settings.SERVER_TIMING:
+            response['Server-Timing'] = \
+                request_metrics.server_timing(duration)
+        return response
+    return wrapped
@@ -0,0 +1,560 @@
+#
+# Copyright (c) 2017 University of Dundee.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from threading import RLock
+
+import numpy
+import omero.util.pixelstypetopython as pixelstypetopython
+
+import iviewer_settings
+from cache import LRUCache
+from jobs import clone_connection
+from metrics import phase
+
+
+# decoded, aligned pixel blocks, see PixelsReader
+TILE_CACHE = LRUCache(
+    iviewer_settings.TILE_CACHE_MAX_BYTES, size_of=lambda tile: tile.nbytes,
+    name='tile')
+# the sizes of the resolution levels of pixels, see PixelsReader
+RESOLUTIONS_CACHE = LRUCache(
+    iviewer_settings.IMAGE_DESCRIPTOR_CACHE_SIZE, name='resolutions')
+
+
+def get_pixels_dtype(pixels_type):
+    """
+    Returns the numpy dtype for the given omero pixels type
+    (e.g. 'uint16'). Raw pixel data is big endian.
+    """
+    return numpy.dtype('>' + pixelstypetopython.toPython(pixels_type))
+
+
+def decode_tile(data, dtype, width, height):
+    """
+    Decodes the raw bytes returned by getTile/getPlane
+    into a numpy array of shape (height, width)
+    """
+    return numpy.frombuffer(data, dtype=dtype).reshape(height, width)
+
+
+def get_cache_scope(conn):
+    """
+    Returns the session and group the cached data of conn is scoped by,
+    which makes sure data is only ever shared with the same session
+    (and therefore the permissions it was read with)
+    """
+    return (conn.c.getSessionId(), conn.SERVICE_OPTS.getOmeroGroup())
+
+
+def close_raw_pixels_store(raw_pixels_store):
+    try:
+        raw_pixels_store.close()
+    except Exception:
+        pass
+
+
+class RawPixelsStorePool(object):
+
+    """
+    Keeps idle RawPixelsStores (scoped by session and group) open for reuse
+    by subsequent requests for the same pixels, saving the creation and
+    setPixelsId round trips.
+
+    The request's connection is closed at the end of the request (and its
+    stores along with it), so the stores are created on a connection the
+    pool owns instead: one per scope, joining the session (see connect),
+    which is closed along with the last store of its scope.
+
+    A store is used exclusively between acquire and release (or discard).
+    Idle stores are closed after idle_timeout seconds, when they are evicted
+    because the pool is full or once a user (across all of their sessions)
+    exceeds max_per_user idle stores.
+    """
+
+    def __init__(self, max_size, max_per_user, idle_timeout,
+                 connect=clone_connection):
+        self.max_per_user = max_per_user
+        self.connect = connect
+        self.stores = LRUCache(
+            max_size, ttl=idle_timeout,
+            on_evict=lambda key, store: self.close_store(key, store),
+            name='raw_pixels_store_pool')
+        self.lock = RLock()
+        # the pool's connection and number of open stores by scope,
+        # guarded by a lock of its own which is never held while
+        # calling into the store cache (whose on_evict takes it)
+        self.connections = {}
+        self.connections_lock = RLock()
+
+    def acquire(self, conn, pixels_id):
+        """
+        Returns an idle store for pixels_id or a newly created one
+        along with a flag indicating whether it was reused
+        """
+        self.stores.expire()
+        key = self.get_key(conn, pixels_id)
+        raw_pixels_store = self.stores.pop(key)
+        if raw_pixels_store is not None:
+            return raw_pixels_store, True
+        pool_conn = self.open_connection(conn, key)
+        try:
+            with phase('pixels_store', calls=2):
+                raw_pixels_store = pool_conn.createRawPixelsStore()
+                raw_pixels_store.setPixelsId(pixels_id, True)
+        except Exception:
+            if raw_pixels_store is not None:
+                close_raw_pixels_store(raw_pixels_store)
+            self.close_connection(key)
+            raise
+        return raw_pixels_store, False
+
+    def get_key(self, conn, pixels_id):
+        # the user id comes first, it's what the cap is counted by
+        return (conn.getUserId(),) + get_cache_scope(conn) + (pixels_id,)
+
+    def get_scope(self, key):
+        return key[1:-1]
+
+    def open_connection(self, conn, key):
+        """
+        Returns the pool's connection for the scope of key (connecting
+        if there is none), counting the store about to be created on it
+        """
+        scope = self.get_scope(key)
+        with self.connections_lock:
+            entry = self.connections.get(scope)
+            if entry is not None:
+                entry[1] += 1
+                return entry[0]
+        with phase('pixels_store'):
+            pool_conn = self.connect(conn)
+        with self.connections_lock:
+            entry = self.connections.get(scope)
+            if entry is None:
+                entry = self.connections[scope] = [pool_conn, 0]
+                pool_conn = None
+            entry[1] += 1
+        # another request connected in the meantime
+        if pool_conn is not None:
+            pool_conn.close(hard=False)
+        return entry[0]
+
+    def close_connection(self, key):
+        """
+        Uncounts a store of the scope of key, closing the scope's
+        connection if it was the last one
+        """
+        scope = self.get_scope(key)
+        with self.connections_lock:
+            entry = self.connections.get(scope)
+            if entry is None:
+                return
+            entry[1] -= 1
+            if entry[1] > 0:
+                return
+            del self.connections[scope]
+        try:
+            entry[0].close(hard=False)
+        except Exception:
+            pass
+
+    def close_store(self, key, raw_pixels_store):
+        close_raw_pixels_store(raw_pixels_store)
+        self.close_connection(key)
+
+    def release(self, conn, pixels_id, raw_pixels_store):
+        """
+        Hands back a store obtained by acquire for reuse
+        """
+        key = self.get_key(conn, pixels_id)
+        with self.lock:
+            if key in self.stores:
+                self.close_store(key, raw_pixels_store)
+                return
+            user_keys = [k for k in self.stores.keys() if k[0] == key[0]]
+            if len(user_keys) >= self.max_per_user:
+                oldest = user_keys[0]
+                self.stores.invalidate(lambda k: k == oldest)
+            self.stores.set(key, raw_pixels_store)
+
+    def discard(self, conn, pixels_id, raw_pixels_store):
+        """
+        Closes a store obtained by acquire which isn't to be reused
+        (e.g. because it failed)
+        """
+        self.close_store(self.get_key(conn, pixels_id), raw_pixels_store)
+
+
+RAW_PIXELS_STORE_POOL = RawPixelsStorePool(
+    iviewer_settings.RAW_PIXELS_STORE_POOL_SIZE,
+    iviewer_settings.RAW_PIXELS_STORE_POOL_SIZE_PER_USER,
+    iviewer_settings.RAW_PIXELS_STORE_IDLE_TIMEOUT)
+
+
+class PixelsReader(object):
+
+    """
+    Reads regions of the planes of a pixels object.
+
+    Regions are assembled from aligned blocks (block_size x block_size)
+    which are kept in the tile cache, so that subsequent reads of the same
+    or neighbouring regions don't need a server round trip.
+    A RawPixelsStore is only acquired (from the pool) on a cache miss.
+    Readers of many blocks that are unlikely to be read again (e.g.
+    background jobs) should bypass the cache (cache=False), so they don't
+    evict the blocks of interactive requests.
+
+    Pyramidal pixels can be read at a lower resolution level (see
+    set_resolution), the pooled stores are always at the full resolution.
+    """
+
+    def __init__(self, conn, pixels_id, pixels_type, size_x, size_y,
+                 block_size=None, cache=True):
+        self.conn = conn
+        self.pixels_id = pixels_id
+        self.dtype = get_pixels_dtype(pixels_type)
+        self.size_x = size_x
+        self.size_y = size_y
+        self.block_size = block_size if block_size is not None \
+            else iviewer_settings.TILE_CACHE_BLOCK_SIZE
+        self.scope = get_cache_scope(conn)
+        self.cache = cache
+        self.resolution = 0
+        self.raw_pixels_store = None
+        self.reused = False
+
+    def get_raw_pixels_store(self):
+        if self.raw_pixels_store is None:
+            self.raw_pixels_store, self.reused = \
+                RAW_PIXELS_STORE_POOL.acquire(self.conn, self.pixels_id)
+            if self.resolution > 0:
+                try:
+                    self.set_store_resolution(self.resolution)
+                except Exception:
+                    self.discard_raw_pixels_store()
+                    raise
+        return self.raw_pixels_store
+
+    def get_resolutions(self):
+        """
+        Returns the sizes (x, y) of the resolution levels of the pixels,
+        the first one being the full resolution (like the resolutions of
+        webgateway's tiles). Non pyramidal pixels have one level only
+        """
+        key = self.scope + (self.pixels_id,)
+        resolutions = RESOLUTIONS_CACHE.get(key)
+        if resolutions is None:
+            raw_pixels_store = self.get_raw_pixels_store()
+            with phase('pixels_store'):
+                descriptions = raw_pixels_store.getResolutionDescriptions()
+            resolutions = [(d.sizeX, d.sizeY) for d in descriptions]
+            RESOLUTIONS_CACHE.set(key, resolutions)
+        return resolutions
+
+    def set_store_resolution(self, resolution):
+        # the store's levels count the other way round (0 is the lowest)
+        levels = len(self.get_resolutions())
+        with phase('pixels_store'):
+            self.raw_pixels_store.setResolutionLevel(levels - 1 - resolution)
+
+    def set_resolution(self, resolution):
+        """
+        Makes the reader read the given resolution level (see
+        get_resolutions) whose size it adopts, i.e. all coordinates
+        refer to that level from then on
+        """
+        resolutions = self.get_resolutions()
+        if resolution < 0 or resolution >= len(resolutions):
+            raise ValueError(
+                "Invalid resolution level %s (%s levels)" %
+                (resolution, len(resolutions)))
+        if self.raw_pixels_store is not None and \
+                resolution != self.resolution:
+            try:
+                self.set_store_resolution(resolution)
+            except Exception:
+                self.discard_raw_pixels_store()
+                raise
+        self.resolution = resolution
+        self.size_x, self.size_y = resolutions[resolution]
+
+    def close(self):
+        """
+        Hands the store (if any) back to the pool
+        """
+        if self.raw_pixels_store is not None:
+            if self.resolution > 0:
+                try:
+                    self.set_store_resolution(0)
+                except Exception:
+                    self.discard_raw_pixels_store()
+                    return
+            RAW_PIXELS_STORE_POOL.release(
+                self.conn, self.pixels_id, self.raw_pixels_store)
+            self.raw_pixels_store = None
+
+    def discard_raw_pixels_store(self):
+        if self.raw_pixels_store is not None:
+            RAW_PIXELS_STORE_POOL.discard(
+                self.conn, self.pixels_id, self.raw_pixels_store)
+            self.raw_pixels_store = None
+
+    def fetch(self, z, c, t, x, y, width, height):
+        """
+        Reads the given region from the server (bypassing the cache).
+        A store that fails (including setting its resolution level) is
+        discarded, if it was a pooled one (which might have gone stale)
+        we retry once with a new one.
+        """
+        retry = True
+        while True:
+            try:
+                raw_pixels_store = self.get_raw_pixels_store()
+                with phase('pixels'):
+                    data = raw_pixels_store.getTile(
+                        z, c, t, x, y, width, height)
+                return decode_tile(data, self.dtype, width, height)
+            except Exception:
+                reused = self.reused
+                self.discard_raw_pixels_store()
+                if not reused or not retry:
+                    raise
+                retry = False
+
+    def get_block_key(self, z, c, t, block_x, block_y):
+        return self.scope + (
+            self.pixels_id, self.resolution, z, c, t, self.block_size,
+            block_x, block_y)
+
+    def get_blocks(self, z, c, t, block_coords):
+        """
+        Returns a dictionary of the blocks for the given (block_x, block_y)
+        coordinates, fetching the ones that aren't cached. If the missing
+        blocks are (mostly) adjacent, they are fetched as one region.
+        """
+        blocks = {}
+        missing = []
+        for block_x, block_y in block_coords:
+            block = TILE_CACHE.get(
+                self.get_block_key(z, c, t, block_x, block_y)) \
+                if self.cache else None
+            if block is None:
+                missing.append((block_x, block_y))
+            else:
+                blocks[(block_x, block_y)] = block
+        if len(missing) == 0:
+            return blocks
+
+        block_size = self.block_size
+        min_x = min([m[0] for m in missing])
+        min_y = min([m[1] for m in missing])
+        max_x = max([m[0] for m in missing])
+        max_y = max([m[1] for m in missing])
+        if (max_x - min_x + 1) * (max_y - min_y + 1) > 2 * len(missing):
+            # scattered: fetch them one by one
+            for block_x, block_y in missing:
+                blocks[(block_x, block_y)] = self.cache_block(
+                    z, c, t, block_x, block_y,
+                    self.fetch_region(
+                        z, c, t, block_x, block_y, block_x, block_y), 0, 0)
+            return blocks
+
+        # fetch the bounding box of all missing blocks with one call
+        # and split it up into blocks again for caching
+        region = self.fetch_region(z, c, t, min_x, min_y, max_x, max_y)
+        for block_x, block_y in missing:
+            blocks[(block_x, block_y)] = self.cache_block(
+                z, c, t, block_x, block_y, region,
+                (block_x - min_x) * block_size,
+                (block_y - min_y) * block_size)
+        return blocks
+
+    def fetch_region(self, z, c, t, min_x, min_y, max_x, max_y):
+        """
+        Fetches the region covered by the given (inclusive) block range
+        """
+        block_size = self.block_size
+        start_x, start_y = min_x * block_size, min_y * block_size
+        return self.fetch(
+            z, c, t, start_x, start_y,
+            min((max_x + 1) * block_size, self.size_x) - start_x,
+            min((max_y + 1) * block_size, self.size_y) - start_y)
+
+    def cache_block(self, z, c, t, block_x, block_y, region, off_x, off_y):
+        block_size = self.block_size
+        block = region[off_y:off_y + block_size,
+                       off_x:off_x + block_size].copy()
+        block.flags.writeable = False
+        if self.cache:
+            TILE_CACHE.set(
+                self.get_block_key(z, c, t, block_x, block_y), block)
+        return block
+
+    def read(self, z, c, t, x, y, width, height):
+        """
+        Returns the given region as numpy array of shape (height, width)
+        """
+        block_size = self.block_size
+        if TILE_CACHE.max_size <= 0 or block_size <= 0 or not self.cache:
+            return self.fetch(z, c, t, x, y, width, height)
+
+        blocks = self.get_blocks(z, c, t, [
+            (block_x, block_y)
+            for block_y in range(
+                y // block_size, (y + height - 1) // block_size + 1)
+            for block_x in range(
+                x // block_size, (x + width - 1) // block_size + 1)])
+
+        # copy the intersecting parts of the blocks into the region
+        ret = numpy.empty((height, width), dtype=self.dtype)
+        for (block_x, block_y), block in blocks.items():
+            block_start_x = block_x * block_size
+            block_start_y = block_y * block_size
+            start_x = max(x, block_start_x)
+            start_y = max(y, block_start_y)
+            end_x = min(x + width, block_start_x + block.shape[1])
+            end_y = min(y + height, block_start_y + block.shape[0])
+            ret[start_y - y:end_y - y, start_x - x:end_x - x] = \
+                block[start_y - block_start_y:end_y - block_start_y,
+                      start_x - block_start_x:end_x - block_start_x]
+        return ret
+
+    def read_points(self, z, c, t, xs, ys):
+        """
+        Returns the intensities at the given pixel coordinates
+        (numpy integer arrays) reading only the blocks that contain them
+        """
+        block_size = self.block_size
+        if block_size <= 0:
+            min_x, min_y = int(xs.min()), int(ys.min())
+            region = self.fetch(
+                z, c, t, min_x, min_y,
+                int(xs.max()) - min_x + 1, int(ys.max()) - min_y + 1)
+            return region[ys - min_y, xs - min_x]
+
+        block_xs, block_ys = xs // block_size, ys // block_size
+        blocks = self.get_blocks(
+            z, c, t, set(zip(block_xs.tolist(), block_ys.tolist())))
+        ret = numpy.empty(len(xs), dtype=self.dtype)
+        for (block_x, block_y), block in blocks.items():
+            in_block = (block_xs == block_x) & (block_ys == block_y)
+            ret[in_block] = block[
+                ys[in_block] - block_y * block_size,
+                xs[in_block] - block_x * block_size]
+        return ret
+
+    def read_interpolated(self, z, c, t, xs, ys):
+        """
+        Returns the bilinearly interpolated intensities (float64) at the
+        given sub-pixel coordinates (numpy float arrays of any shape),
+        pixel centers being at +0.5. Coordinates outside the image are
+        clamped to its edge pixels. Only the blocks containing the
+        neighbouring pixels are read
+        """
+        fxs = numpy.clip(xs - 0.5, 0, self.size_x - 1)
+        fys = numpy.clip(ys - 0.5, 0, self.size_y - 1)
+        x0s = numpy.floor(fxs).astype(numpy.int64)
+        y0s = numpy.floor(fys).astype(numpy.int64)
+        x1s = numpy.minimum(x0s + 1, self.size_x - 1)
+        y1s = numpy.minimum(y0s + 1, self.size_y - 1)
+        wxs, wys = fxs - x0s, fys - y0s
+
+        # read the 4 neighbours of all points at once
+        corners = self.read_points(
+            z, c, t,
+            numpy.concatenate([x0s.ravel(), x1s.ravel(),
+                               x0s.ravel(), x1s.ravel()]),
+            numpy.concatenate([y0s.ravel(), y0s.ravel(),
+                               y1s.ravel(), y1s.ravel()])
+        ).astype(numpy.float64).reshape((4,) + xs.shape)
+        top = corners[0] * (1 - wxs) + corners[1] * wxs
+        bottom = corners[2] * (1 - wxs) + corners[3] * wxs
+        return top * (1 - wys) + bottom * wys
+
+
+def sample_polyline(coords, spacing=1.0):
+    """
+    Returns the x and y coordinates (float arrays) of points sampled
+    along the polyline given as list of [x, y] at the given spacing,
+    the vertices included
+    """
+    coords = numpy.asarray(coords, dtype=numpy.float64).reshape(-1, 2)
+    if len(coords) < 2:
+        return coords[:, 0], coords[:, 1]
+    xs, ys = [], []
+    for start, end in zip(coords[:-1], coords[1:]):
+        length = numpy.hypot(*(end - start))
+        steps = max(int(numpy.ceil(length / spacing)), 1)
+        fractions = numpy.arange(steps) / float(steps)
+        xs.append(start[0] + fractions * (end[0] - start[0]))
+        ys.append(start[1] + fractions * (end[1] - start[1]))
+    xs.append(coords[-1:, 0])
+    ys.append(coords[-1:, 1])
+    return numpy.concatenate(xs), numpy.concatenate(ys)
+
+
+def count_polyline_samples(coords, spacing=1.0):
+    """
+    Returns (without sampling) the number of points sample_polyline
+    returns for the polyline given as list of [x, y] at the given
+    spacing, which is also the maximum number of samples per parallel
+    of sample_line_profile
+    """
+    coords = numpy.asarray(coords, dtype=numpy.float64).reshape(-1, 2)
+    if len(coords) < 2:
+        return len(coords)
+    lengths = numpy.hypot(*(coords[1:] - coords[:-1]).T)
+    return numpy.maximum(numpy.ceil(lengths / spacing), 1).sum() + 1
+
+
+def sample_line_profile(coords, spacing=1.0, width=1):
+    """
+    Returns the points sampled along the polyline given as list of [x, y]
+    at the given spacing (see sample_polyline) for a profile of the given
+    width: the x and y coordinates are float arrays of shape
+    (width, samples) holding the polyline and its parallels at a distance
+    of 1 (perpendicular to each segment). The third array holds the
+    distance of the samples along the polyline
+    """
+    coords = numpy.asarray(coords, dtype=numpy.float64).reshape(-1, 2)
+    xs, ys, normals, distances = [], [], [], []
+    distance = 0.0
+    for start, end in zip(coords[:-1], coords[1:]):
+        length = numpy.hypot(*(end - start))
+        if length == 0:
+            continue
+        steps = max(int(numpy.ceil(length / spacing)), 1)
+        fractions = numpy.arange(steps) / float(steps)
+        xs.append(start[0] + fractions * (end[0] - start[0]))
+        ys.append(start[1] + fractions * (end[1] - start[1]))
+        normals.append(numpy.tile(
+            [-(end[1] - start[1]) / length, (end[0] - start[0]) / length],
+            (steps, 1)))
+        distances.append(distance + fractions * length)
+        distance += length
+    # the last vertex (or the only point of a degenerate polyline)
+    xs.append(coords[-1:, 0])
+    ys.append(coords[-1:, 1])
+    normals.append(normals[-1][-1:] if len(normals) > 0 else
+                   numpy.zeros((1, 2)))
+    distances.append(numpy.array([distance]))
+    xs, ys = numpy.concatenate(xs), numpy.concatenate(ys)
+    normals = numpy.concatenate(normals)
+
+    offsets = (numpy.arange(width) - (width - 1) / 2.0)[:, numpy.newaxis]
+    return xs + offsets * normals[:, 0], ys + offsets * normals[:, 1], \
+        numpy.concatenate(distances)
@@ -0,0 +1,253 @@
+#
+# Copyright (c) 2017 University of Dundee.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+A compact binary encoding of json documents containing shapes
+(omero_marshal json), e.g. the responses of rois_in_viewport or the
+requests of persist_rois.
+
+The geometry of every shape (its coordinates and sizes, polygon and
+polyline points) is moved from the json into one typed array: the
+values are quantized (if possible without loss), delta encoded (x and y
+separately) and stored as the smallest fitting integer type (or as
+doubles if they can't be quantized). Each shape keeps its type and style
+in the json header, along with the offset and number of its values.
+
+Layout: MAGIC, flags (uint8, 1 = zlib compressed) followed by the
+(optionally compressed) body: the length of the json header (uint32),
+the json header (utf-8) and the values (little endian).
+"""
+
+import json
+import re
+import struct
+import zlib
+
+import numpy
+
+from shapes import format_points, parse_points
+
+
+MAGIC = b'IVS1'
+
+CONTENT_TYPE = 'application/x-iviewer-shapes'
+
+FLAG_COMPRESSED = 1
+
+# the maximum size (in bytes) of a decompressed body
+MAX_DECOMPRESSED_SIZE = 128 * 1024 * 1024
+
+# the geometry keys of the shape types (in pairs of x and y)
+GEOMETRY_KEYS = {
+    'Rectangle': ['X', 'Y', 'Width', 'Height'],
+    'Mask': ['X', 'Y', 'Width', 'Height'],
+    'Ellipse': ['X', 'Y', 'RadiusX', 'RadiusY'],
+    'Line': ['X1', 'Y1', 'X2', 'Y2'],
+    'Point': ['X', 'Y'],
+    'Label': ['X', 'Y'],
+    'Polygon': ['Points'],
+    'Polyline': ['Points'],
+}
+
+# the key holding offset and number of a shape's values
+GEOMETRY = '@geometry'
+
+# the scales tried for quantizing values without loss
+SCALES = [1, 10, 100, 1000]
+
+# the types of the values (quantized ones are integers)
+DTYPES = ['<i1', '<i2', '<i4', '<i8', '<f8']
+
+# plain points strings (x1,y1 x2,y2 ...) we can encode without loss
+PLAIN_POINTS = re.compile(r'^[0-9eE.,+\-\s]*$')
+
+
+def get_shape_type(value):
+    """
+    Returns the shape type of an omero_marshal json dict
+    (e.g. Polygon) or None if it isn't a (supported) shape
+    """
+    if not isinstance(value, dict):
+        return None
+    shape_type = value.get('@type', None)
+    if not isinstance(shape_type, basestring):
+        return None
+    shape_type = shape_type.split('#')[-1]
+    return shape_type if shape_type in GEOMETRY_KEYS else None
+
+
+def extract_geometry(shape, values):
+    """
+    Returns a copy of shape whose geometry has been appended to values
+    (if it is complete and can be encoded, otherwise shape is returned)
+    """
+    keys = GEOMETRY_KEYS[get_shape_type(shape)]
+    if keys == ['Points']:
+        points = shape.get('Points', None)
+        if not isinstance(points, basestring) or \
+                PLAIN_POINTS.match(points) is None:
+            return shape
+        try:
+            geometry = parse_points(points).ravel().tolist()
+        except ValueError:
+            # an odd number of coordinates
+            return shape
+    else:
+        geometry = [shape.get(key, None) for key in keys]
+        if any([not isinstance(v, (int, long, float)) or
+                isinstance(v, bool) for v in geometry]):
+            return shape
+    ret = dict([(k, v) for k, v in shape.items() if k not in keys])
+    ret[GEOMETRY] = [len(values), len(geometry)]
+    values.extend(geometry)
+    return ret
+
+
+def restore_geometry(shape, values):
+    """
+    Returns a copy of shape with its geometry taken from values
+    (or shape if its geometry wasn't extracted)
+    """
+    if GEOMETRY not in shape:
+        return shape
+    keys = GEOMETRY_KEYS[get_shape_type(shape)]
+    geometry = shape[GEOMETRY]
+    if not isinstance(geometry, list) or len(geometry) != 2 or \
+            any([not isinstance(v, (int, long)) or isinstance(v, bool)
+                 for v in geometry]):
+        raise ValueError("Invalid shape geometry %r" % (geometry,))
+    offset, count = geometry
+    if offset < 0 or count < 0 or offset + count > len(values) or \
+            (keys == ['Points'] and count % 2 != 0) or \
+            (keys != ['Points'] and count != len(keys)):
+        raise ValueError("Invalid shape geometry %r" % (geometry,))
+    geometry = values[offset:offset + count]
+    ret = dict([(k, v) for k, v in shape.items() if k != GEOMETRY])
+    if keys == ['Points']:
+        ret['Points'] = format_points(geometry.reshape(-1, 2))
+    else:
+        ret.update(zip(keys, geometry.tolist()))
+    return ret
+
+
+def transform(value, shape_func):
+    """
+    Returns a copy of the json value with shape_func applied to
+    every shape (dict) it contains
+    """
+    if isinstance(value, dict):
+        if get_shape_type(value) is not None:
+            value = shape_func(value)
+        return dict([(k, transform(v, shape_func))
+                     for k, v in value.items()])
+    if isinstance(value, list):
+        return [transform(v, shape_func) for v in value]
+    return value
+
+
+def pack_values(values):
+    """
+    Returns the dtype, scale and the (delta encoded) typed array
+    for the given values
+    """
+    values = numpy.asarray(values, dtype=numpy.float64)
+    for scale in SCALES:
+        quantized = numpy.round(values * scale)
+        if not numpy.all(numpy.abs(quantized / scale - values) < 1e-9) or \
+                (len(values) > 0 and numpy.abs(quantized).max() >= 2 ** 52):
+            continue
+        # the first x and y are kept, the rest are differences
+        deltas = quantized.copy()
+        deltas[2:] = quantized[2:] - quantized[:-2]
+        for dtype in ['<i1', '<i2', '<i4', '<i8']:
+            info = numpy.iinfo(dtype)
+            if len(deltas) == 0 or (deltas.min() >= info.min and
+                                    deltas.max() <= info.max):
+                return dtype, scale, deltas.astype(dtype)
+    return '<f8', 0, values.astype('<f8')
+
+
+def unpack_values(dtype, scale, data):
+    """
+    Returns the values (float64) for the output of pack_values,
+    raises a ValueError if dtype or scale aren't ones of pack_values
+    or the length of data doesn't fit dtype
+    """
+    if dtype not in DTYPES:
+        raise ValueError("Invalid dtype %r" % (dtype,))
+    if isinstance(scale, bool) or \
+            scale not in (SCALES if dtype != '<f8' else [0]):
+        raise ValueError("Invalid scale %r" % (scale,))
+    if len(data) % numpy.dtype(dtype).itemsize != 0:
+        raise ValueError("Invalid length of values")
+    values = numpy.frombuffer(data, dtype=str(dtype))
+    if scale == 0:
+        return values.astype(numpy.float64)
+    # undo the delta encoding of x and y separately
+    quantized = numpy.empty(len(values), dtype=numpy.int64)
+    quantized[0::2] = numpy.cumsum(values[0::2], dtype=numpy.int64)
+    quantized[1::2] = numpy.cumsum(values[1::2], dtype=numpy.int64)
+    return quantized / float(scale)
+
+
+def encode(document, compress=False):
+    """
+    Encodes the json document (see module doc)
+    """
+    values = []
+    header = transform(
+        document, lambda shape: extract_geometry(shape, values))
+    dtype, scale, data = pack_values(values)
+    header = json.dumps(
+        {'dtype': dtype, 'scale': scale, 'document': header},
+        separators=(',', ':')).encode('utf-8')
+    body = struct.pack('<I', len(header)) + header + data.tobytes()
+    if compress:
+        return MAGIC + struct.pack('<B', FLAG_COMPRESSED) + \
+            zlib.compress(body)
+    return MAGIC + struct.pack('<B', 0) + body
+
+
+def decode(data, max_size=MAX_DECOMPRESSED_SIZE):
+    """
+    Decodes the output of encode into the json document,
+    raises a ValueError if data isn't (valid) encoded shapes or if
+    it decompresses to more than max_size bytes
+    """
+    if data[:len(MAGIC)] != MAGIC or len(data) < len(MAGIC) + 1:
+        raise ValueError("Not encoded shapes")
+    flags = struct.unpack('<B', data[len(MAGIC):len(MAGIC) + 1])[0]
+    body = data[len(MAGIC) + 1:]
+    if flags & FLAG_COMPRESSED:
+        decompressor = zlib.decompressobj()
+        body = decompressor.decompress(body, max_size)
+        if decompressor.unconsumed_tail:
+            raise ValueError(
+                "Encoded shapes exceed %s bytes" % max_size)
+    if len(body) < 4:
+        raise ValueError("Not encoded shapes")
+    header_length = struct.unpack('<I', body[:4])[0]
+    if len(body) < 4 + header_length:
+        raise ValueError("Truncated encoded shapes")
+    header = json.loads(body[4:4 + header_length].decode('utf-8'))
+    if not isinstance(header, dict) or \
+            any([key not in header for key in ['dtype', 'scale', 'document']]):
+        raise ValueError("Invalid encoded shapes header")
+    values = unpack_values(
+        header['dtype'], header['scale'], body[4 + header_length:])
+    return transform(
+        header['document'], lambda shape: restore_geometry(shape, values))
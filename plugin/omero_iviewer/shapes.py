@@ -0,0 +1,193 @@
+#
+# Copyright (c) 2017 University of Dundee.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+import re
+
+import numpy
+import omero
+
+from pixels import sample_polyline
+
+
+NUMBER = re.compile(r'[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?')
+
+
+def parse_points(points):
+    """
+    Returns the coordinates of a polygon/polyline points string
+    ('x1,y1 x2,y2 ...') as numpy array of shape (n, 2)
+    """
+    return numpy.array(
+        [float(n) for n in NUMBER.findall(points)],
+        dtype=numpy.float64).reshape(-1, 2)
+
+
+def get_shape_geometry(shape):
+    """
+    Returns the geometry of the given omero shape as a dictionary with
+    the type (Rectangle, Ellipse, Polygon, Polyline, Line or Point) and
+    its coordinates. Returns None for other shapes (e.g. Label, Mask)
+    and for shapes that have a transform
+    """
+    if shape.getTransform() is not None:
+        return None
+    if isinstance(shape, omero.model.RectangleI):
+        return {'type': 'Rectangle',
+                'x': shape.getX().getValue(),
+                'y': shape.getY().getValue(),
+                'width': shape.getWidth().getValue(),
+                'height': shape.getHeight().getValue()}
+    if isinstance(shape, omero.model.EllipseI):
+        return {'type': 'Ellipse',
+                'x': shape.getX().getValue(),
+                'y': shape.getY().getValue(),
+                'radiusX': shape.getRadiusX().getValue(),
+                'radiusY': shape.getRadiusY().getValue()}
+    if isinstance(shape, omero.model.PolygonI) or \
+            isinstance(shape, omero.model.PolylineI):
+        return {'type': 'Polygon'
+                if isinstance(shape, omero.model.PolygonI) else 'Polyline',
+                'points': parse_points(shape.getPoints().getValue())}
+    if isinstance(shape, omero.model.LineI):
+        return {'type': 'Line',
+                'points': numpy.array(
+                    [[shape.getX1().getValue(), shape.getY1().getValue()],
+                     [shape.getX2().getValue(), shape.getY2().getValue()]])}
+    if isinstance(shape, omero.model.PointI):
+        return {'type': 'Point',
+                'x': shape.getX().getValue(),
+                'y': shape.getY().getValue()}
+    return None
+
+
+def rasterize(geometry, size_x, size_y):
+    """
+    Returns the mask of the pixels (x, y) of the given geometry (see
+    get_shape_geometry) as tuple of the x and y offset and a boolean
+    array of shape (height, width) covering the geometry's bounding box
+    clipped to the image. Areas contain the pixels whose coordinates lie
+    within them, lines and points the pixels they pass through.
+    Returns None if the geometry is outside of the image
+    """
+    shape_type = geometry['type']
+    if shape_type in ['Line', 'Polyline', 'Point']:
+        if shape_type == 'Point':
+            xs = numpy.array([geometry['x']])
+            ys = numpy.array([geometry['y']])
+        else:
+            xs, ys = sample_polyline(geometry['points'])
+        xs = numpy.floor(xs).astype(numpy.int64)
+        ys = numpy.floor(ys).astype(numpy.int64)
+        inside = (xs >= 0) & (xs < size_x) & (ys >= 0) & (ys < size_y)
+        xs, ys = xs[inside], ys[inside]
+        if len(xs) == 0:
+            return None
+        min_x, min_y = int(xs.min()), int(ys.min())
+        mask = numpy.zeros(
+            (int(ys.max()) - min_y + 1, int(xs.max()) - min_x + 1),
+            dtype=bool)
+        mask[ys - min_y, xs - min_x] = True
+        return min_x, min_y, mask
+
+    # the bounding box of areas (clipped to the image)
+    if shape_type == 'Rectangle':
+        bbox = [geometry['x'], geometry['y'],
+                geometry['x'] + geometry['width'],
+                geometry['y'] + geometry['height']]
+    elif shape_type == 'Ellipse':
+        bbox = [geometry['x'] - geometry['radiusX'],
+                geometry['y'] - geometry['radiusY'],
+                geometry['x'] + geometry['radiusX'],
+                geometry['y'] + geometry['radiusY']]
+    elif shape_type == 'Polygon':
+        points = geometry['points']
+        if len(points) < 3:
+            return None
+        bbox = [points[:, 0].min(), points[:, 1].min(),
+                points[:, 0].max(), points[:, 1].max()]
+    else:
+        raise ValueError("Unsupported shape type: " + shape_type)
+    min_x = max(int(numpy.ceil(bbox[0])), 0)
+    min_y = max(int(numpy.ceil(bbox[1])), 0)
+    max_x = min(int(numpy.floor(bbox[2])), size_x - 1)
+    max_y = min(int(numpy.floor(bbox[3])), size_y - 1)
+    if max_x < min_x or max_y < min_y:
+        return None
+    ys, xs = numpy.mgrid[min_y:max_y + 1, min_x:max_x + 1]
+
+    if shape_type == 'Rectangle':
+        mask = (xs < bbox[2]) & (ys < bbox[3])
+    elif shape_type == 'Ellipse':
+        if geometry['radiusX'] <= 0 or geometry['radiusY'] <= 0:
+            return None
+        mask = ((xs - geometry['x']) / float(geometry['radiusX'])) ** 2 + \
+            ((ys - geometry['y']) / float(geometry['radiusY'])) ** 2 <= 1
+    else:
+        # even-odd rule: count the edges a ray to the right crosses
+        mask = numpy.zeros(xs.shape, dtype=bool)
+        for (x1, y1), (x2, y2) in zip(points, numpy.roll(points, -1, 0)):
+            if y1 == y2:
+                continue
+            crosses = ((y1 > ys) != (y2 > ys)) & \
+                (xs < (x2 - x1) * (ys - y1) / (y2 - y1) + x1)
+            mask ^= crosses
+    if not mask.any():
+        return None
+    return min_x, min_y, mask
+
+
+def simplify_points(points, tolerance):
+    """
+    Simplifies the polyline (n, 2) with the Douglas-Peucker algorithm,
+    dropping the points that are closer than tolerance to the line
+    through their (kept) neighbours. The first and last point are kept
+    """
+    if len(points) < 3 or tolerance <= 0:
+        return points
+    keep = numpy.zeros(len(points), dtype=bool)
+    keep[0] = keep[-1] = True
+    ranges = [(0, len(points) - 1)]
+    while len(ranges) > 0:
+        start, end = ranges.pop()
+        if end - start < 2:
+            continue
+        inner = points[start + 1:end]
+        direction = points[end] - points[start]
+        length = numpy.hypot(*direction)
+        offsets = inner - points[start]
+        if length == 0:
+            distances = numpy.hypot(offsets[:, 0], offsets[:, 1])
+        else:
+            distances = numpy.abs(
+                direction[0] * offsets[:, 1] -
+                direction[1] * offsets[:, 0]) / length
+        farthest = int(distances.argmax())
+        if distances[farthest] > tolerance:
+            index = start + 1 + farthest
+            keep[index] = True
+            ranges.append((start, index))
+            ranges.append((index, end))
+    return points[keep]
+
+
+def format_points(points):
+    """
+    Returns the points (n, 2) as polygon/polyline points string
+    (see parse_points)
+    """
+    return " ".join(["%s,%s" % (repr(x), repr(y)) for x, y in points.tolist()])
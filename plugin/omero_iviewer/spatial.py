@@ -0,0 +1,207 @@
+#
+# Copyright (c) 2017 University of Dundee.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import numpy
+from omero.rtypes import unwrap
+from omero_sys_ParametersI import ParametersI
+
+import iviewer_settings
+from cache import LRUCache
+from metrics import phase
+from pixels import get_cache_scope
+from shapes import parse_points
+
+
+# shape indices of images, keyed by session, group and image id
+SHAPE_INDEX_CACHE = LRUCache(
+    iviewer_settings.SHAPE_INDEX_CACHE_SIZE, name='shape_index')
+
+# shapes covering more grid cells than this are checked for every query
+# rather than being added to all of their cells
+MAX_CELLS_PER_SHAPE = 64
+
+# the queries for the (untransformed) bounding boxes of the shapes of an
+# image per shape type: the selected fields are followed by a function
+# returning min x, min y, max x and max y for them
+SHAPE_BBOX_QUERIES = [
+    ("Rectangle", "s.x, s.y, s.width, s.height",
+     lambda x, y, w, h: (x, y, x + w, y + h)),
+    ("Mask", "s.x, s.y, s.width, s.height",
+     lambda x, y, w, h: (x, y, x + w, y + h)),
+    ("Ellipse", "s.x, s.y, s.radiusX, s.radiusY",
+     lambda x, y, rx, ry: (x - rx, y - ry, x + rx, y + ry)),
+    ("Line", "s.x1, s.y1, s.x2, s.y2",
+     lambda x1, y1, x2, y2: (
+         min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2))),
+    ("Point", "s.x, s.y", lambda x, y: (x, y, x, y)),
+    ("Label", "s.x, s.y", lambda x, y: (x, y, x, y)),
+    ("Polygon", "s.points", lambda points: get_points_bbox(points)),
+    ("Polyline", "s.points", lambda points: get_points_bbox(points)),
+]
+
+
+def get_points_bbox(points):
+    points = parse_points(points or "")
+    if len(points) == 0:
+        return None
+    return (points[:, 0].min(), points[:, 1].min(),
+            points[:, 0].max(), points[:, 1].max())
+
+
+class ShapeIndex(object):
+
+    """
+    A grid based spatial index of the bounding boxes of the shapes of an
+    image. Each grid cell holds the indices of the shapes whose bounding
+    box intersects it, shapes spanning many cells are checked for every
+    query instead. Shapes with a transform (whose bounding box we don't
+    know) are considered to intersect every viewport.
+    """
+
+    def __init__(self, shape_ids, zs, ts, bboxes, cell_size):
+        self.shape_ids = numpy.asarray(shape_ids, dtype=numpy.int64)
+        # -1 stands for all planes (z or t unset)
+        self.zs = numpy.asarray(zs, dtype=numpy.int64)
+        self.ts = numpy.asarray(ts, dtype=numpy.int64)
+        self.bboxes = numpy.asarray(
+            bboxes, dtype=numpy.float64).reshape(-1, 4)
+        self.cell_size = float(cell_size)
+
+        cells = {}
+        large = []
+        bounded = numpy.isfinite(self.bboxes).all(axis=1)
+        large.extend(numpy.flatnonzero(~bounded).tolist())
+        cell_bboxes = numpy.floor(
+            self.bboxes[bounded] / self.cell_size).astype(numpy.int64)
+        for i, (min_x, min_y, max_x, max_y) in zip(
+                numpy.flatnonzero(bounded).tolist(), cell_bboxes.tolist()):
+            if (max_x - min_x + 1) * (max_y - min_y + 1) > \
+                    MAX_CELLS_PER_SHAPE:
+                large.append(i)
+                continue
+            for cell_x in range(min_x, max_x + 1):
+                for cell_y in range(min_y, max_y + 1):
+                    cells.setdefault((cell_x, cell_y), []).append(i)
+        self.large = numpy.array(large, dtype=numpy.int64)
+        self.cells = dict(
+            (cell, numpy.array(indices, dtype=numpy.int64))
+            for cell, indices in cells.items())
+
+    def query(self, bbox, z, t):
+        """
+        Returns the ids of the shapes on plane z/t whose bounding box
+        intersects bbox (min x, min y, max x, max y)
+        """
+        min_x, min_y, max_x, max_y = [
+            int(numpy.floor(v / self.cell_size)) for v in bbox]
+        if (max_x - min_x + 1) * (max_y - min_y + 1) > len(self.cells):
+            # looking up the cells is more work than checking all shapes
+            candidates = numpy.arange(len(self.shape_ids))
+        else:
+            candidates = [self.large]
+            for cell_x in range(min_x, max_x + 1):
+                for cell_y in range(min_y, max_y + 1):
+                    indices = self.cells.get((cell_x, cell_y), None)
+                    if indices is not None:
+                        candidates.append(indices)
+            candidates = numpy.unique(numpy.concatenate(candidates))
+        if len(candidates) == 0:
+            return []
+
+        bboxes = self.bboxes[candidates]
+        hits = ((self.zs[candidates] == -1) | (self.zs[candidates] == z)) & \
+            ((self.ts[candidates] == -1) | (self.ts[candidates] == t))
+        bounded = numpy.isfinite(bboxes).all(axis=1)
+        hits &= ~bounded | (
+            (bboxes[:, 0] <= bbox[2]) & (bboxes[:, 2] >= bbox[0]) &
+            (bboxes[:, 1] <= bbox[3]) & (bboxes[:, 3] >= bbox[1]))
+        return self.shape_ids[candidates[hits]].tolist()
+
+
+def get_shapes_version(conn, image_id):
+    """
+    Returns the number of shapes of the image and their last update event,
+    which changes whenever shapes are added, modified or deleted
+    """
+    params = ParametersI()
+    params.addId(image_id)
+    with phase('query'):
+        result = conn.getQueryService().projection(
+            "select count(s.id), max(s.details.updateEvent.id) " +
+            "from Shape s where s.roi.image.id = :id",
+            params, conn.SERVICE_OPTS)
+    return tuple([unwrap(v) for v in result[0]])
+
+
+def build_shape_index(conn, image_id, size_x, size_y):
+    """
+    Builds the ShapeIndex of the given image querying the fields
+    its shapes' bounding boxes are derived from (one query per type)
+    """
+    params = ParametersI()
+    params.addId(image_id)
+    shape_ids, zs, ts, bboxes = [], [], [], []
+    query_service = conn.getQueryService()
+    for shape_type, fields, get_bbox in SHAPE_BBOX_QUERIES:
+        with phase('query'):
+            rows = query_service.projection(
+                "select s.id, s.theZ, s.theT, tr.id, " + fields +
+                " from " + shape_type + " s left outer join s.transform tr" +
+                " where s.roi.image.id = :id",
+                params, conn.SERVICE_OPTS)
+        for row in rows:
+            values = [unwrap(v) for v in row]
+            bbox = None
+            if values[3] is None and None not in values[4:]:
+                bbox = get_bbox(*values[4:])
+            shape_ids.append(values[0])
+            zs.append(values[1] if values[1] is not None else -1)
+            ts.append(values[2] if values[2] is not None else -1)
+            bboxes.append(bbox if bbox is not None else
+                          (-numpy.inf, -numpy.inf, numpy.inf, numpy.inf))
+
+    # about SHAPE_INDEX_CELL_SHAPES shapes per cell (if spread evenly)
+    cell_size = max(
+        numpy.sqrt(float(size_x) * size_y *
+                   iviewer_settings.SHAPE_INDEX_CELL_SHAPES /
+                   max(len(shape_ids), 1)),
+        16.0)
+    return ShapeIndex(shape_ids, zs, ts, bboxes, cell_size)
+
+
+def get_shape_index(conn, image_id, size_x, size_y):
+    """
+    Returns the (cached) ShapeIndex of the given image,
+    rebuilt whenever its shapes changed (see get_shapes_version)
+    """
+    image_id = long(image_id)
+    key = get_cache_scope(conn) + (image_id,)
+    version = get_shapes_version(conn, image_id)
+    cached = SHAPE_INDEX_CACHE.get(key)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    index = build_shape_index(conn, image_id, size_x, size_y)
+    SHAPE_INDEX_CACHE.set(key, (version, index))
+    return index
+
+
+def invalidate_shape_index(image_id):
+    """
+    Removes the cached shape indices of the given image
+    """
+    image_id = long(image_id)
+    SHAPE_INDEX_CACHE.invalidate(lambda key: key[2] == image_id)
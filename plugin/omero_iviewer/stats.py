@@ -0,0 +1,392 @@
+#
+# Copyright (c) 2017 University of Dundee.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+import numpy
+from omero_sys_ParametersI import ParametersI
+
+import iviewer_settings
+from cache import LRUCache
+from metrics import phase
+from pixels import PixelsReader, get_cache_scope
+from shapes import get_shape_geometry, rasterize
+
+
+# per channel statistics of shapes, keyed by session, group, shape id,
+# the shape's last update event, z, t and channel (None for all channels)
+SHAPE_STATS_CACHE = LRUCache(
+    iviewer_settings.SHAPE_STATS_CACHE_SIZE, name='shape_stats')
+
+# histograms, keyed by session, group, pixels id, z, t, channel, bins,
+# range (as requested, e.g. 'window') and the maximum number of samples
+HISTOGRAM_CACHE = LRUCache(
+    iviewer_settings.HISTOGRAM_CACHE_SIZE, name='histogram')
+
+# per channel percentiles of images (see compute_channel_percentiles),
+# keyed by pixels id (only served after the image has been loaded)
+IMAGE_STATS_CACHE = LRUCache(
+    iviewer_settings.IMAGE_STATS_CACHE_SIZE, name='image_stats')
+
+
+def get_shape_versions(conn, shape_ids):
+    """
+    Returns a dictionary of shape id to the id of its last update event
+    """
+    if len(shape_ids) == 0:
+        return {}
+    params = ParametersI()
+    params.addIds(shape_ids)
+    with phase('query'):
+        result = conn.getQueryService().projection(
+            "select s.id, s.details.updateEvent.id from Shape s " +
+            "where s.id in (:ids)", params, conn.SERVICE_OPTS)
+    return dict([(row[0].val, row[1].val) for row in result])
+
+
+def get_shape_stats(conn, shape_ids, z, t, channels, compute, versions=None):
+    """
+    Returns the statistics for the given shapes, plane and channels
+    (all if empty) as a dictionary of shape id to a list of per channel
+    statistics (ordered like channels).
+    Cached statistics are validated by the shape's last update event
+    (versions, see get_shape_versions, queried if not given),
+    compute is called for the missing ones with a list of shape ids,
+    z, t and a list of channels, returning the same structure
+    """
+    scope = get_cache_scope(conn)
+    if versions is None:
+        versions = get_shape_versions(conn, shape_ids)
+    ret = {}
+    cached = {}
+    missing = {}
+    for shape_id in shape_ids:
+        version = versions.get(shape_id, None)
+        if version is None:
+            # let compute deal with it
+            missing[shape_id] = tuple(channels)
+            continue
+        key = scope + (shape_id, version, z, t)
+        if len(channels) == 0:
+            stats = SHAPE_STATS_CACHE.get(key + (None,))
+            if stats is None:
+                missing[shape_id] = ()
+            else:
+                ret[str(shape_id)] = stats
+            continue
+        hits = []
+        missing_channels = []
+        for c in channels:
+            stat = SHAPE_STATS_CACHE.get(key + (c,))
+            if stat is None:
+                missing_channels.append(c)
+            else:
+                hits.append(stat)
+        if len(missing_channels) == 0:
+            ret[str(shape_id)] = hits
+        else:
+            cached[shape_id] = hits
+            missing[shape_id] = tuple(missing_channels)
+
+    # compute the missing ones, grouped by their missing channels
+    by_channels = {}
+    for shape_id, missing_channels in missing.items():
+        by_channels.setdefault(missing_channels, []).append(shape_id)
+    for missing_channels, ids in by_channels.items():
+        computed = compute(ids, z, t, list(missing_channels))
+        for shape_key, stats in computed.items():
+            shape_id = long(shape_key)
+            version = versions.get(shape_id, None)
+            if version is not None:
+                key = scope + (shape_id, version, z, t)
+                if len(missing_channels) == 0:
+                    SHAPE_STATS_CACHE.set(key + (None,), stats)
+                for stat in stats:
+                    SHAPE_STATS_CACHE.set(key + (stat['index'],), stat)
+            stats = cached.get(shape_id, []) + stats
+            if len(channels) > 0:
+                stats = sorted(
+                    stats, key=lambda stat: channels.index(stat['index']))
+            ret[str(shape_key)] = stats
+    return ret
+
+
+def invalidate_shape_stats(shape_ids):
+    """
+    Removes the cached statistics of the given shapes
+    """
+    shape_ids = set(shape_ids)
+    SHAPE_STATS_CACHE.invalidate(lambda key: key[2] in shape_ids)
+
+
+def compute_geometry_stats(geometry, reader, z, t, channels, size_x, size_y):
+    """
+    Returns the per channel statistics of the pixels within the given
+    geometry (see shapes.get_shape_geometry). Only the bounding box of the
+    geometry is read via reader, which can be any object with a method:
+    read(z, c, t, x, y, width, height) returning a numpy array
+    """
+    raster = rasterize(geometry, size_x, size_y)
+    ret = []
+    for c in channels:
+        stat = {"index": c, "points": 0, "min": 0.0, "max": 0.0,
+                "sum": 0.0, "mean": 0.0, "std_dev": 0.0}
+        if raster is not None:
+            x, y, mask = raster
+            values = reader.read(
+                z, c, t, x, y, mask.shape[1], mask.shape[0])[mask]
+            values = values.astype(numpy.float64)
+            stat["points"] = values.size
+            stat["min"] = float(values.min())
+            stat["max"] = float(values.max())
+            stat["sum"] = float(values.sum())
+            stat["mean"] = float(values.mean())
+            stat["std_dev"] = float(values.std())
+        ret.append(stat)
+    return ret
+
+
+def read_plane_sample(reader, z, c, t, max_samples):
+    """
+    Returns the intensities of a plane as flat numpy array. Planes with
+    more than max_samples pixels are subsampled: a random (but for a given
+    plane size always the same) selection of blocks is read that covers
+    about max_samples pixels
+    """
+    size_x, size_y = reader.size_x, reader.size_y
+    block_size = reader.block_size
+    if size_x * size_y <= max_samples or block_size <= 0:
+        return reader.read(z, c, t, 0, 0, size_x, size_y).ravel()
+
+    blocks_x = (size_x + block_size - 1) // block_size
+    blocks_y = (size_y + block_size - 1) // block_size
+    count = max(1, min(
+        blocks_x * blocks_y, max_samples // (block_size * block_size)))
+    selected = numpy.random.RandomState(0).choice(
+        blocks_x * blocks_y, count, replace=False)
+    blocks = reader.get_blocks(
+        z, c, t, [(int(b % blocks_x), int(b // blocks_x)) for b in selected])
+    return numpy.concatenate([block.ravel() for block in blocks.values()])
+
+
+def get_channel_windows(conn, pixels_id):
+    """
+    Returns a dictionary of channel index to the channel's window
+    (the global min and max of its StatsInfo) for the channels that
+    have one
+    """
+    params = ParametersI()
+    params.addId(pixels_id)
+    with phase('query'):
+        result = conn.getQueryService().projection(
+            "select index(c), s.globalMin, s.globalMax from Pixels p " +
+            "join p.channels c join c.statsInfo s where p.id = :id",
+            params, conn.SERVICE_OPTS)
+    return dict([(row[0].val, (float(row[1].val), float(row[2].val)))
+                 for row in result
+                 if row[1] is not None and row[2] is not None])
+
+
+def get_histograms(conn, reader, z, t, channels, bins, max_samples):
+    """
+    Returns the histograms of the given plane for channels, a list of
+    (channel, range) tuples, range being a (min, max) tuple, None for the
+    range of the data or 'window' for the channel's window (falling back
+    onto the data if there is none, see get_channel_windows), which is
+    only looked up for histograms that aren't cached. Each histogram is a
+    dictionary holding the counts (data), the range, the number of pixels
+    it was computed from and whether the plane was subsampled
+    (see read_plane_sample)
+    """
+    scope = get_cache_scope(conn)
+    windows = None
+    ret = []
+    for c, value_range in channels:
+        key = scope + (reader.pixels_id, z, t, c, bins, value_range,
+                       max_samples)
+        histogram = HISTOGRAM_CACHE.get(key)
+        if histogram is None:
+            if value_range == 'window':
+                if windows is None:
+                    windows = get_channel_windows(conn, reader.pixels_id)
+                value_range = windows.get(c, None)
+            values = read_plane_sample(reader, z, c, t, max_samples)
+            subsampled = values.size < reader.size_x * reader.size_y
+            if values.dtype.kind == 'f':
+                values = values[numpy.isfinite(values)]
+            if value_range is None:
+                value_range = (float(values.min()), float(values.max())) \
+                    if values.size > 0 else (0.0, 0.0)
+            counts, edges = numpy.histogram(
+                values, bins=bins, range=value_range)
+            histogram = {
+                "index": c,
+                "min": value_range[0],
+                "max": value_range[1],
+                "samples": values.size,
+                "subsampled": subsampled,
+                "data": counts.tolist()
+            }
+            HISTOGRAM_CACHE.set(key, histogram)
+        ret.append(histogram)
+    return ret
+
+
+def sample_planes(size_z, size_t, max_planes):
+    """
+    Returns a list of up to max_planes (z, t) tuples evenly spaced
+    across all the planes (z first)
+    """
+    count = size_z * size_t
+    indices = numpy.unique(numpy.linspace(
+        0, count - 1, min(count, max_planes)).round().astype(numpy.int64))
+    return [(int(i % size_z), int(i // size_z)) for i in indices]
+
+
+def compute_channel_percentiles(reader, size_z, size_c, size_t, percentiles,
+                                max_planes, max_samples, job=None):
+    """
+    Returns the min, max and the given percentiles of the intensities of
+    each channel computed from a subsample (see sample_planes and
+    read_plane_sample) of at most max_samples pixels per channel.
+    The optional job is notified of every channel done
+    """
+    planes = sample_planes(size_z, size_t, max_planes)
+    samples_per_plane = max(1, max_samples // len(planes))
+    channels = []
+    for c in range(size_c):
+        values = numpy.concatenate([
+            read_plane_sample(reader, z, c, t, samples_per_plane)
+            for z, t in planes])
+        if values.dtype.kind == 'f':
+            values = values[numpy.isfinite(values)]
+        if values.size == 0:
+            channels.append(None)
+        else:
+            channels.append({
+                "index": c,
+                "min": float(values.min()),
+                "max": float(values.max()),
+                "values": [float(v) for v in
+                           numpy.percentile(values, percentiles)]
+            })
+        if job is not None:
+            job.step()
+    return {
+        "percentiles": percentiles,
+        "planes": len(planes),
+        "channels": channels
+    }
+
+
+class LocalShapeStats(object):
+    """
+    Computes the statistics for shapes (see get_shape_stats) in process:
+    the shapes are rasterized and only the pixels of their bounding boxes
+    are read (via the block cache, reusing them across shapes).
+    Loaded shapes and the readers of their pixels are kept until close
+    is called, so that computing several planes of the same shapes
+    doesn't load them again. Shapes that aren't supported
+    (see shapes.get_shape_geometry) are handed to fallback
+    (which has the signature of compute)
+    """
+
+    def __init__(self, conn, fallback):
+        self.conn = conn
+        self.fallback = fallback
+        self.shapes = {}
+        self.readers = {}
+
+    def load_shapes(self, ids):
+        """
+        Loads the given shapes with the pixels of their images
+        """
+        if len(ids) == 0:
+            return
+        params = ParametersI()
+        params.addIds(ids)
+        with phase('query'):
+            shapes = self.conn.getQueryService().findAllByQuery(
+                "select s from Shape s join fetch s.roi r " +
+                "join fetch r.image i join fetch i.pixels p " +
+                "join fetch p.pixelsType where s.id in (:ids)",
+                params, self.conn.SERVICE_OPTS)
+        for shape in shapes:
+            self.shapes[shape.getId().getValue()] = shape
+
+    def get_reader(self, pixels):
+        """
+        Returns the (shared) reader for the given pixels
+        """
+        pixels_id = pixels.getId().getValue()
+        reader = self.readers.get(pixels_id, None)
+        if reader is None:
+            reader = PixelsReader(
+                self.conn, pixels_id,
+                pixels.getPixelsType().getValue().getValue(),
+                pixels.getSizeX().getValue(), pixels.getSizeY().getValue())
+            self.readers[pixels_id] = reader
+        return reader
+
+    def compute(self, ids, z, t, channels):
+        """
+        Returns the statistics for the given shapes, plane and channels
+        """
+        self.load_shapes([id for id in ids if id not in self.shapes])
+
+        ret = {}
+        unsupported = []
+        for shape_id in ids:
+            shape = self.shapes.get(shape_id, None)
+            if shape is None:
+                continue
+            geometry = get_shape_geometry(shape)
+            if geometry is None:
+                unsupported.append(shape_id)
+                continue
+            pixels = shape.getRoi().getImage().getPrimaryPixels()
+            if z < 0 or z >= pixels.getSizeZ().getValue() or \
+                    t < 0 or t >= pixels.getSizeT().getValue():
+                raise ValueError("z/t are out of bounds")
+            shape_channels = channels if len(channels) > 0 else \
+                range(pixels.getSizeC().getValue())
+            ret[str(shape_id)] = compute_geometry_stats(
+                geometry, self.get_reader(pixels), z, t, shape_channels,
+                pixels.getSizeX().getValue(), pixels.getSizeY().getValue())
+
+        if len(unsupported) > 0:
+            ret.update(self.fallback(unsupported, z, t, channels))
+        return ret
+
+    def close(self):
+        """
+        Closes the readers
+        """
+        for reader in self.readers.values():
+            reader.close()
+        self.readers = {}
+
+
+def compute_local_shape_stats(conn, ids, z, t, channels, fallback):
+    """
+    Computes the statistics for the given shapes and plane in process
+    (see LocalShapeStats)
+    """
+    local_stats = LocalShapeStats(conn, fallback)
+    try:
+        return local_stats.compute(ids, z, t, channels)
+    finally:
+        local_stats.close()
@@ -27,13 +27,31 @@ urlpatterns = patterns(
     url(r'^/?$', views.index, name='omero_iviewer_index'),
     url(r'^persist_rois/?$', views.persist_rois,
         name='omero_iviewer_persist_rois'),
+    url(r'^rois_in_viewport/?$', views.rois_in_viewport,
+        name='omero_iviewer_rois_in_viewport'),
     url(r'^image_data/(?P<image_id>[0-9]+)/$', views.image_data,
         name='omero_iviewer_image_data'),
+    url(r'^images_data/?$', views.images_data,
+        name='omero_iviewer_images_data'),
+    url(r'^image_stats/(?P<image_id>[0-9]+)/$', views.image_stats,
+        name='omero_iviewer_image_stats'),
+    url(r'^delta_t/(?P<image_id>[0-9]+)/$', views.delta_t,
+        name='omero_iviewer_delta_t'),
     url(r'^save_projection/?$', views.save_projection,
         name='omero_iviewer_save_projection'),
+    url(r'^projection_status/?$', views.projection_status,
+        name='omero_iviewer_projection_status'),
     url(r'^well_images/?$', views.well_images,
         name='omero_iviewer_well_images'),
     url(r'^get_intensity/?$', views.get_intensity,
         name='omero_iviewer_get_intensity'),
+    url(r'^get_intensities/?$', views.get_intensities,
+        name='omero_iviewer_get_intensities'),
+    url(r'^line_profile/?$', views.line_profile,
+        name='omero_iviewer_line_profile'),
+    url(r'^histograms/(?P<image_id>[0-9]+)/$', views.histograms,
+        name='omero_iviewer_histograms'),
     url(r'^shape_stats/?$', views.shape_stats,
-        name='omero_iviewer_shape_stats'))
+        name='omero_iviewer_shape_stats'),
+    url(r'^metrics/?$', views.metrics,
+        name='omero_iviewer_metrics'))
@@ -15,27 +15,44 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
-from django.shortcuts import render
-from django.http import JsonResponse
+from django.http import HttpResponse, JsonResponse
 from django.conf import settings
-from django.core.urlresolvers import reverse
+from django.core.urlresolvers import get_script_prefix, reverse
+from django.template.loader import render_to_string
+from django.utils.html import escape
 
 from os.path import splitext
-from struct import unpack
+from time import mktime, time
+from uuid import uuid4
 
-from omeroweb.decorators import login_required
+from omeroweb.decorators import login_required, ConnCleaningHttpResponse
 from omeroweb.webgateway.marshal import imageMarshal
 from omeroweb.webgateway.templatetags.common_filters import lengthformat,\
     lengthunit
 
 import json
+import numpy
 import omero_marshal
 import omero
-from omero.rtypes import rint, rlong
+from omero.gateway import ChannelWrapper, ImageWrapper
+from omero.rtypes import rint, rlist, rlong, unwrap
 from omero_sys_ParametersI import ParametersI
-import omero.util.pixelstypetopython as pixelstypetopython
 
 from version import __version__
+from cache import LRUCache
+from pixels import PixelsReader, count_polyline_samples, get_cache_scope, \
+    get_pixels_dtype, sample_line_profile, sample_polyline
+from jobs import IMAGE_STATS_JOBS, PROJECTION_JOBS, clone_connection
+from shapes import format_points, get_shape_geometry, parse_points, \
+    simplify_points
+from spatial import get_shape_index, invalidate_shape_index
+from descriptors import get_image_descriptor, invalidate_image_descriptor
+from metrics import METRICS, instrumented, phase
+import shape_codec
+from stats import IMAGE_STATS_CACHE, LocalShapeStats, \
+    compute_channel_percentiles, get_histograms, get_shape_stats, \
+    get_shape_versions, invalidate_shape_stats
+import iviewer_settings
 
 
 WEB_API_VERSION = 0
@@ -47,13 +64,71 @@ PROJECTIONS = {
     'intsum': omero.constants.projection.ProjectionType.SUMINTENSITY,
 }
 
-QUERY_DISTANCE = 25
+# the number of steps of a projection job: projection, rendering settings,
+# description and dataset link
+PROJECTION_STEPS = 4
 
+QUERY_DISTANCE = 25
 
+# image_data responses, keyed by session, group, image id and image state
+IMAGE_DATA_CACHE = LRUCache(
+    iviewer_settings.IMAGE_DATA_CACHE_SIZE,
+    ttl=iviewer_settings.IMAGE_DATA_CACHE_TTL,
+    name='image_data')
+# total image count of wells, keyed by session, group and well id
+WELL_IMAGES_COUNT_CACHE = LRUCache(
+    iviewer_settings.IMAGE_DATA_CACHE_SIZE,
+    ttl=iviewer_settings.IMAGE_DATA_CACHE_TTL,
+    name='well_images_count')
+# the max number of images images_data returns at once
+MAX_IMAGES_DATA = 100
+# delta t values and unit symbol, keyed by session, group and pixels id
+DELTA_T_CACHE = LRUCache(
+    iviewer_settings.IMAGE_DATA_CACHE_SIZE,
+    ttl=iviewer_settings.IMAGE_DATA_CACHE_TTL,
+    name='delta_t')
+
+# the rendered index page split at INDEX_PARAMS_MARKER (where the per
+# request params are inserted), keyed by version and script prefix
+INDEX_PAGE_CACHE = LRUCache(16, name='index_page')
+INDEX_PARAMS_MARKER = '/*iviewer-request-params*/'
+
+# persist_rois decodes and saves rois in batches of this size
+ROI_BATCH_SIZE = 500
+
+# the session key for the state of chunked persist_rois calls
+PERSIST_ROIS_SESSION_KEY = 'omero_iviewer_persist_rois'
+# unfinished chunked persist_rois calls are discarded after (in seconds)
+PERSIST_ROIS_TIMEOUT = 3600
+
+# optional (non legacy) response formats for get_intensity
+INTENSITY_FORMATS = ['columnar', 'raw']
+
+# the max number of intensities (points x planes x channels)
+# that can be requested by one get_intensities call
+MAX_INTENSITY_SAMPLES = 1000000
+
+# the maximum (and default) number of shapes rois_in_viewport returns
+MAX_VIEWPORT_SHAPES = 10000
+
+# the maximum width (in pixels) of a line profile
+MAX_LINE_PROFILE_WIDTH = 100
+
+# the maximum number of histogram bins
+MAX_HISTOGRAM_BINS = 65536
+
+# the statistics fields (in order) of the compact multi plane shape_stats
+SHAPE_STATS_FIELDS = ['points', 'min', 'max', 'sum', 'mean', 'std_dev']
+
+# the maximum number of planes (z times t) of one shape_stats request
+MAX_SHAPE_STATS_PLANES = 100000
+
+
+@instrumented
 @login_required()
 def index(request, iid=None, conn=None, **kwargs):
-    # set params
-    params = {'VERSION': __version__}
+    # set request params
+    params = {}
 
     # check for image_id (default viewer setup)
     if iid is not None:
@@ -68,217 +143,1218 @@ def index(request, iid=None, conn=None, **kwargs):
     server_settings = request.session.get('server_settings', {})
     params['INTERPOLATE'] = server_settings.get('interpolate_pixels', True)
 
+    # the rest of the page only changes with the version and the prefix
+    page = get_index_page()
+    for key in page['params']:
+        params.pop(key, None)
+    script = "".join([
+        "window.INITIAL_REQUEST_PARAMS[%s] = %s;" % (
+            json.dumps(escape(key)), json.dumps(escape(value)))
+        for key, value in params.items()])
+    return HttpResponse(page['head'] + script + page['tail'])
+
+
+def get_index_page():
+    """
+    Returns the index page rendered with the params that are the same
+    for all requests (the version and the (possibly prefixed) uris)
+    split at the point where the request params are to be inserted.
+    Cached per version and script prefix (unless in debug mode)
+    """
+    cache_key = (__version__, get_script_prefix())
+    page = INDEX_PAGE_CACHE.get(cache_key)
+    if page is not None and not settings.DEBUG:
+        return page
+
     # we add the (possibly prefixed) uris
+    params = {'VERSION': __version__}
     params['WEBGATEWAY'] = reverse('webgateway')
     params['WEBCLIENT'] = reverse('webindex')
     params['WEB_API_BASE'] = reverse(
         'api_base', kwargs={'api_version': WEB_API_VERSION})
     if settings.FORCE_SCRIPT_NAME is not None:
         params['URI_PREFIX'] = settings.FORCE_SCRIPT_NAME
-
-    return render(
-        request, 'omero_iviewer/index.html',
-        {'params': params, 'iviewer_url_suffix': u"?_iviewer-%s" % __version__}
-    )
-
-
+    params['PROJECTION_ASYNC'] = iviewer_settings.PROJECTION_ASYNC
+
+    html = render_to_string(
+        'omero_iviewer/index.html',
+        {'params': params,
+         'request_params': INDEX_PARAMS_MARKER,
+         'iviewer_url_suffix': u"?_iviewer-%s" % __version__})
+    head, tail = html.split(INDEX_PARAMS_MARKER, 1)
+    # the request params can override the version (but not the uris)
+    page = {'head': head, 'tail': tail,
+            'params': [key for key in params if key != 'VERSION']}
+    INDEX_PAGE_CACHE.set(cache_key, page)
+    return page
+
+
+@instrumented
 @login_required()
 def persist_rois(request, conn=None, **kwargs):
     if not request.method == 'POST':
         return JsonResponse({"error": "Use HTTP POST to send data!"})
 
     try:
-        rois_dict = json.loads(request.body)
+        # the rois may come in the compact binary encoding as well
+        if request.META.get('CONTENT_TYPE', '').startswith(
+                shape_codec.CONTENT_TYPE):
+            rois_dict = shape_codec.decode(request.body)
+        else:
+            rois_dict = json.loads(request.body)
     except Exception as e:
-        return JsonResponse({"error": "Failed to load json: " + e})
+        return JsonResponse({"error": "Failed to load json: " + str(e)})
 
     # some preliminary checks are following...
     image_id = rois_dict.get('imageId', None)
     if image_id is None:
         return JsonResponse({"error": "No image id provided!"})
+    try:
+        image_id = long(image_id)
+    except Exception:
+        return JsonResponse({"error": "Invalid image id!"})
+    # rois are sent whole, the shapes of existing rois may also be
+    # sent as changes only: created, modified and deleted
     rois = rois_dict.get('rois', None)
-    if rois is None:
+    shape_changes = rois_dict.get('shapes', None)
+    if rois is None and shape_changes is None:
         return JsonResponse({"error": "Could not find rois array!"})
+    if rois is None:
+        rois = {}
 
     # get the associated image and an instance of the update service
-    image = conn.getObject("Image", image_id, opts=conn.SERVICE_OPTS)
+    image = get_image_descriptor(conn, image_id)
     if image is None:
         return JsonResponse({"error": "Could not find associated image!"})
 
+    # chunked mode: the rois are sent in several (sequential) requests,
+    # the first one announcing the number of chunks and receiving a token
+    # which the following ones have to send along
+    chunk = rois_dict.get('chunk', None)
+    transaction = None
+    if chunk is not None:
+        transaction = get_persist_rois_transaction(
+            request, rois_dict, image_id)
+        if transaction.get('error', None) is not None:
+            return JsonResponse(transaction)
+
     # prepare services
     update_service = conn.getUpdateService()
-    rois_service = conn.getRoiService()
-    if update_service is None or rois_service is None:
-        return JsonResponse({"error": "Could not get update/rois service!"})
+    query_service = conn.getQueryService()
+    if update_service is None or query_service is None:
+        return JsonResponse({"error": "Could not get update/query service!"})
 
     # when persisting we use the specific group context
-    conn.SERVICE_OPTS['omero.group'] = image.getDetails().getGroup().getId()
+    conn.SERVICE_OPTS['omero.group'] = image.getGroupId()
 
-    # loop over the given rois, marshal and persist/delete
+    # marshal the given rois and asscociate them with the image,
+    # differentiating between new rois and existing ones which are then
+    # persisted respectively. we do this in batches to bound memory usage
     ret_ids = {}
     try:
-        for r in rois:
-            roi = rois.get(r)
-            # marshal and asscociate with image
-            decoder = omero_marshal.get_decoder(roi.get("@type"))
-            decoded_roi = decoder.decode(roi)
-            decoded_roi.setImage(image._obj)
-
-            # differentiate between new rois and existing ones
-            if int(r) < 0:
-                # we save the new ones including all its new shapes
-                decoded_roi = update_service.saveAndReturnObject(
-                    decoded_roi, conn.SERVICE_OPTS)
-                roi_id = decoded_roi.getId().getValue()
-                # we associate them with the ids handed in
-                i = 0
-                for s in decoded_roi.copyShapes():
-                    old_id = roi['shapes'][i].get('oldId', None)
-                    shape_id = s.getId().getValue()
-                    ret_ids[old_id] = str(roi_id) + ":" + str(shape_id)
-                    i += 1
-            else:
-                # we fetch the existing ones
-                result = rois_service.findByRoi(
-                    long(r), None, conn.SERVICE_OPTS)
-                # we need to have one only for each id
-                if result is None or len(result.rois) != 1:
-                    continue
-                existing_rois = result.rois[0]
-
-                # loop over decoded shapes (new, deleted and modified)
-                j = 0
-                shapes_done = {}
-                shapes_deleted = 0
-                shapes_to_be_added = []
-                roi_id = decoded_roi.getId().getValue()
-                for s in decoded_roi.copyShapes():
-                    old_id = roi['shapes'][j].get('oldId', None)
-                    delete = roi['shapes'][j].get('markedForDeletion', None)
-                    j += 1
-                    shape_id = s.getId().getValue()
-                    if shape_id < 0:
-                        # due to deletions/modifications that we store first
-                        # the newly added ones are added afterwards
-                        decoded_roi.removeShape(s)
-                        shapes_to_be_added.append(
-                            {"oldId": old_id, "shape": s})
-                        continue
-                    if delete is not None:
-                        decoded_roi.removeShape(s)
-                        shapes_deleted += 1
-                    shapes_done[shape_id] = old_id
-                # needed for saving multiple shapes in same roi
-                # otherwise the update routine keeps only the modified
-                for e in existing_rois.copyShapes():
-                    found = shapes_done.get(e.getId().getValue(), None)
-                    if found is None:
-                        decoded_roi.addShape(e)
-                # persist deletions and modifications
-                decoded_roi = update_service.saveAndReturnObject(
-                    decoded_roi, conn.SERVICE_OPTS)
-                # now append the new shapes to the existing ones
-                # and persist them
-                for n in shapes_to_be_added:
-                    decoded_roi.addShape(n['shape'])
-                decoded_roi = update_service.saveAndReturnObject(
-                    decoded_roi, conn.SERVICE_OPTS)
-                nr_of_existing_shapes = decoded_roi.sizeOfShapes()
-                nr_of_added_shapes = len(shapes_to_be_added)
-                # if we deleted all shapes in the roi => remove it as well
-                if nr_of_existing_shapes == 0:
-                    conn.deleteObjects("Roi", [roi_id], wait=False)
-                elif nr_of_added_shapes > 0:
-                    # gather new ids for newly persisted shapes
-                    start = nr_of_existing_shapes - nr_of_added_shapes
-                    for n in shapes_to_be_added:
-                        n_id = str(roi_id) + ":" +  \
-                            str(decoded_roi.getShape(start).getId().getValue())
-                        ret_ids[str(n['oldId'])] = n_id
-                        start += 1
-                # add to the list that contains the successfully persisted ids
-                for x in shapes_done.values():
-                    ret_ids[x] = x
+        roi_keys = list(rois.keys())
+        for b in range(0, len(roi_keys), ROI_BATCH_SIZE):
+            new_rois = []
+            existing_rois = []
+            for r in roi_keys[b:b + ROI_BATCH_SIZE]:
+                roi = rois.pop(r)
+                decoder = omero_marshal.get_decoder(roi.get("@type"))
+                decoded_roi = decoder.decode(roi)
+                decoded_roi.setImage(
+                    omero.model.ImageI(image.getId(), False))
+                if int(r) < 0:
+                    new_rois.append((roi, decoded_roi))
+                else:
+                    existing_rois.append((long(r), roi, decoded_roi))
+
+            save_new_rois(conn, update_service, new_rois, ret_ids)
+            save_existing_rois(
+                conn, update_service, query_service, existing_rois, ret_ids)
+        if shape_changes is not None:
+            save_shape_changes(conn, update_service, query_service,
+                               image.getId(), shape_changes, ret_ids)
     except Exception as marshalOrPersistenceException:
         # we return all successfully stored rois up to the error
         # as well as the error message
-        return JsonResponse({'ids': ret_ids,
-                            'error': repr(marshalOrPersistenceException)})
-
+        ret = {'ids': ret_ids, 'error': repr(marshalOrPersistenceException)}
+        if transaction is not None:
+            ret.update(transaction)
+        return JsonResponse(ret)
+    finally:
+        # the roi count (and the shapes) have (most likely) changed
+        invalidate_image_data(image_id)
+        invalidate_shape_index(image_id)
+
+    if transaction is not None:
+        finish_persist_rois_chunk(request, transaction, len(roi_keys))
+        transaction['ids'] = ret_ids
+        return JsonResponse(transaction)
     return JsonResponse({"ids": ret_ids})
 
 
+def get_persist_rois_transaction(request, rois_dict, image_id):
+    """
+    Validates the chunk info of a chunked persist_rois request, starting a
+    new transaction (stored in the session) for the first chunk.
+    Returns the token and chunk info or a dictionary with an error.
+    A failed chunk can be sent again (with the rois that didn't make it)
+    """
+    transactions = request.session.get(PERSIST_ROIS_SESSION_KEY, {})
+    try:
+        image_id = long(image_id)
+        chunk = int(rois_dict['chunk'])
+        token = rois_dict.get('token', None)
+        if token is None:
+            if chunk != 0:
+                return {"error": "The first chunk has to have index 0!"}
+            # discard abandoned transactions
+            now = time()
+            for t in list(transactions.keys()):
+                if now - transactions[t]['started'] > PERSIST_ROIS_TIMEOUT:
+                    del transactions[t]
+            token = uuid4().hex
+            transactions[token] = {
+                'imageId': image_id,
+                'chunks': max(int(rois_dict['chunks']), 1),
+                'received': 0,
+                'rois': 0,
+                'started': now
+            }
+            request.session[PERSIST_ROIS_SESSION_KEY] = transactions
+    except Exception:
+        return {"error":
+                "Invalid chunk info (imageId, chunk, chunks, token)!"}
+
+    state = transactions.get(token, None)
+    if state is None:
+        return {"error": "Unknown token: " + str(token)}
+    if state['imageId'] != image_id:
+        return {"error": "The token belongs to another image!"}
+    if chunk != state['received']:
+        return {"error": "Expected chunk " + str(state['received']) +
+                ", got " + str(chunk)}
+    return {'token': token, 'chunk': chunk}
+
+
+def finish_persist_rois_chunk(request, transaction, number_of_rois):
+    """
+    Records a successfully persisted chunk adding the progress to
+    transaction. The transaction is removed after the last chunk
+    """
+    transactions = request.session.get(PERSIST_ROIS_SESSION_KEY, {})
+    state = transactions[transaction['token']]
+    state['received'] += 1
+    state['rois'] += number_of_rois
+    transaction['progress'] = {
+        'chunks': state['received'],
+        'total': state['chunks'],
+        'rois': state['rois']
+    }
+    transaction['done'] = state['received'] >= state['chunks']
+    if transaction['done']:
+        del transactions[transaction['token']]
+    request.session[PERSIST_ROIS_SESSION_KEY] = transactions
+    request.session.modified = True
+
+
+def save_new_rois(conn, update_service, new_rois, ret_ids):
+    """
+    Saves the given new rois (tuples of json and decoded roi) including all
+    their shapes with one call, adding the ids to ret_ids
+    """
+    if len(new_rois) == 0:
+        return
+    with phase('update'):
+        saved_rois = update_service.saveAndReturnArray(
+            [n[1] for n in new_rois], conn.SERVICE_OPTS)
+    # we associate them with the ids handed in
+    for (roi, _), saved_roi in zip(new_rois, saved_rois):
+        roi_id = saved_roi.getId().getValue()
+        i = 0
+        for s in saved_roi.copyShapes():
+            old_id = roi['shapes'][i].get('oldId', None)
+            shape_id = s.getId().getValue()
+            ret_ids[old_id] = str(roi_id) + ":" + str(shape_id)
+            i += 1
+
+
+def save_existing_rois(conn, update_service, query_service,
+                       existing_rois, ret_ids):
+    """
+    Saves the new, deleted and modified shapes of the given existing rois
+    (tuples of roi id, json and decoded roi), adding the ids to ret_ids.
+    The rois are fetched with one query, deletions/modifications and
+    additions are saved with one call each.
+    """
+    if len(existing_rois) == 0:
+        return
+
+    # we fetch the existing ones
+    params = ParametersI()
+    params.addIds([e[0] for e in existing_rois])
+    fetched_rois = {}
+    with phase('query'):
+        result = query_service.findAllByQuery(
+            "select distinct r from Roi as r " +
+            "left outer join fetch r.shapes where r.id in (:ids)",
+            params, conn.SERVICE_OPTS)
+    for fetched_roi in result:
+        fetched_rois[fetched_roi.getId().getValue()] = fetched_roi
+
+    to_be_saved = []
+    for roi_id, roi, decoded_roi in existing_rois:
+        # we need to have one for each id
+        existing_roi = fetched_rois.get(roi_id, None)
+        if existing_roi is None:
+            continue
+
+        # loop over decoded shapes (new, deleted and modified)
+        j = 0
+        shapes_done = {}
+        shapes_to_be_added = []
+        for s in decoded_roi.copyShapes():
+            old_id = roi['shapes'][j].get('oldId', None)
+            delete = roi['shapes'][j].get('markedForDeletion', None)
+            j += 1
+            shape_id = s.getId().getValue()
+            if shape_id < 0:
+                # due to deletions/modifications that we store first
+                # the newly added ones are added afterwards
+                decoded_roi.removeShape(s)
+                shapes_to_be_added.append({"oldId": old_id, "shape": s})
+                continue
+            if delete is not None:
+                decoded_roi.removeShape(s)
+            shapes_done[shape_id] = old_id
+        # needed for saving multiple shapes in same roi
+        # otherwise the update routine keeps only the modified
+        for e in existing_roi.copyShapes():
+            found = shapes_done.get(e.getId().getValue(), None)
+            if found is None:
+                decoded_roi.addShape(e)
+        to_be_saved.append((roi_id, decoded_roi, shapes_done,
+                            shapes_to_be_added))
+    if len(to_be_saved) == 0:
+        return
+
+    # persist deletions and modifications
+    with phase('update'):
+        saved_rois = update_service.saveAndReturnArray(
+            [s[1] for s in to_be_saved], conn.SERVICE_OPTS)
+    invalidate_shape_stats(
+        [sid for s in to_be_saved for sid in s[2].keys()])
+    # add to the list that contains the successfully persisted ids
+    for s in to_be_saved:
+        for x in s[2].values():
+            ret_ids[x] = x
+
+    # now append the new shapes to the existing ones and persist them
+    rois_to_be_deleted = []
+    additions = []
+    for s, saved_roi in zip(to_be_saved, saved_rois):
+        shapes_to_be_added = s[3]
+        if len(shapes_to_be_added) == 0:
+            # if we deleted all shapes in the roi => remove it as well
+            if saved_roi.sizeOfShapes() == 0:
+                rois_to_be_deleted.append(s[0])
+            continue
+        for n in shapes_to_be_added:
+            saved_roi.addShape(n['shape'])
+        additions.append((s[0], saved_roi, shapes_to_be_added))
+    if len(additions) > 0:
+        with phase('update'):
+            saved_rois = update_service.saveAndReturnArray(
+                [a[1] for a in additions], conn.SERVICE_OPTS)
+        # gather new ids for newly persisted shapes
+        for (roi_id, _, shapes_to_be_added), saved_roi in \
+                zip(additions, saved_rois):
+            start = saved_roi.sizeOfShapes() - len(shapes_to_be_added)
+            for n in shapes_to_be_added:
+                n_id = str(roi_id) + ":" +  \
+                    str(saved_roi.getShape(start).getId().getValue())
+                ret_ids[str(n['oldId'])] = n_id
+                start += 1
+
+    if len(rois_to_be_deleted) > 0:
+        conn.deleteObjects("Roi", rois_to_be_deleted, wait=False)
+
+
+def save_shape_changes(conn, update_service, query_service, image_id,
+                       shape_changes, ret_ids):
+    """
+    Applies the created, modified and deleted shapes of existing rois of
+    the image (dictionaries keyed by roi id with lists of shape json, or
+    of shape ids for the deleted ones) adding the ids to ret_ids.
+    Created and modified shapes are saved with one call, deleted ones
+    removed with another. Unlike for whole rois, the untouched shapes
+    aren't loaded or saved (only the ids of the shapes of rois with
+    deletions are queried). Modified and deleted shapes have to belong
+    to the roi they are listed under. Rois that lose all their shapes
+    are deleted as well
+    """
+    def by_roi(key, convert=lambda v: v):
+        return dict([(long(r), [convert(v) for v in values]) for r, values
+                     in shape_changes.get(key, {}).items()])
+    created = by_roi('created')
+    modified = by_roi('modified')
+    deleted = by_roi('deleted', long)
+    roi_ids = set(created.keys()) | set(modified.keys()) | \
+        set(deleted.keys())
+    if len(roi_ids) == 0:
+        return
+
+    # one query checks that the rois belong to the image
+    params = ParametersI()
+    params.addIds(list(roi_ids))
+    params.addId(image_id)
+    with phase('query'):
+        result = query_service.projection(
+            "select r.id from Roi as r " +
+            "where r.id in (:ids) and r.image.id = :id",
+            params, conn.SERVICE_OPTS)
+    missing = roi_ids - set([unwrap(row[0]) for row in result])
+    if len(missing) > 0:
+        raise ValueError("Rois not found for image: " +
+                         ", ".join([str(r) for r in sorted(missing)]))
+
+    # the shapes are saved with an (unloaded) link to their roi
+    to_be_saved = []
+    for changes, new in [(created, True), (modified, False)]:
+        for roi_id, shapes in changes.items():
+            for shape in shapes:
+                decoded_shape = omero_marshal.get_decoder(
+                    shape.get("@type")).decode(shape)
+                if new:
+                    decoded_shape.setId(None)
+                elif decoded_shape.getId() is None:
+                    raise ValueError("Modified shapes need an id")
+                decoded_shape.setRoi(omero.model.RoiI(roi_id, False))
+                to_be_saved.append(
+                    (roi_id, shape.get('oldId', None), new, decoded_shape))
+
+    # the modified and deleted shapes have to belong to the roi they are
+    # listed under. another query loads their rois, along with the shapes
+    # of the rois that have deletions (to find the ones left empty)
+    referenced = [(s[3].getId().getValue(), s[0])
+                  for s in to_be_saved if not s[2]] + \
+        [(shape_id, roi_id) for roi_id, shape_ids in deleted.items()
+         for shape_id in shape_ids]
+    roi_shapes = {}
+    if len(referenced) > 0:
+        params = ParametersI()
+        params.addIds(list(set([r[0] for r in referenced])))
+        condition = "s.id in (:ids)"
+        if len(deleted) > 0:
+            params.add('rois', rlist([rlong(r) for r in deleted.keys()]))
+            condition += " or s.roi.id in (:rois)"
+        with phase('query'):
+            result = query_service.projection(
+                "select s.id, s.roi.id from Shape s where " + condition,
+                params, conn.SERVICE_OPTS)
+        shape_rois = {}
+        for row in result:
+            shape_rois[unwrap(row[0])] = unwrap(row[1])
+            roi_shapes.setdefault(unwrap(row[1]), set()).add(unwrap(row[0]))
+        invalid = sorted(set([shape_id for shape_id, roi_id in referenced
+                              if shape_rois.get(shape_id, None) != roi_id]))
+        if len(invalid) > 0:
+            raise ValueError("Shapes not found in their rois: " +
+                             ", ".join([str(i) for i in invalid]))
+
+    if len(to_be_saved) > 0:
+        with phase('update'):
+            saved_shapes = update_service.saveAndReturnArray(
+                [s[3] for s in to_be_saved], conn.SERVICE_OPTS)
+        for (roi_id, old_id, new, _), saved_shape in \
+                zip(to_be_saved, saved_shapes):
+            ret_ids[old_id] = str(roi_id) + ":" + \
+                str(saved_shape.getId().getValue()) if new else old_id
+
+    # rois losing all their shapes are deleted instead of the shapes
+    rois_to_be_deleted = []
+    shapes_to_be_deleted = []
+    for roi_id, shape_ids in deleted.items():
+        remaining = roi_shapes.get(roi_id, set()) - set(shape_ids)
+        if roi_id not in created and len(remaining) == 0:
+            rois_to_be_deleted.append(roi_id)
+        else:
+            shapes_to_be_deleted.extend(shape_ids)
+        for shape_id in shape_ids:
+            old_id = str(roi_id) + ":" + str(shape_id)
+            ret_ids[old_id] = old_id
+    if len(shapes_to_be_deleted) > 0:
+        conn.deleteObjects("Shape", shapes_to_be_deleted, wait=True)
+    if len(rois_to_be_deleted) > 0:
+        conn.deleteObjects("Roi", rois_to_be_deleted, wait=False)
+
+    invalidate_shape_stats(
+        [s[3].getId().getValue() for s in to_be_saved if not s[2]] +
+        [shape_id for shape_ids in deleted.values()
+         for shape_id in shape_ids])
+
+
+@instrumented
+@login_required()
+def rois_in_viewport(request, conn=None, **kwargs):
+    """
+    Returns the shapes of an image on plane z/t whose bounding box
+    intersects the viewport (bbox=min_x,min_y,max_x,max_y) grouped by
+    their rois (omero_marshal json, limited to limit shapes).
+    The shapes are looked up in a spatial index of the image's shapes.
+    If resolution (image pixels per screen pixel) is given, polygons
+    and polylines are simplified accordingly.
+    With format=binary the response is encoded by shape_codec
+    (zlib compressed if compress=true)
+    """
+    image_id = request.GET.get("image", None)
+    bbox = request.GET.get("bbox", None)
+    z, t = request.GET.get("z", None), request.GET.get("t", None)
+    if image_id is None or bbox is None or z is None or t is None:
+        return JsonResponse(
+            {"error": "Parameters image, bbox, z and t are mandatory"})
+
+    # convert input params
+    try:
+        bbox = [float(v) for v in bbox.split(',')]
+        if len(bbox) != 4 or bbox[0] > bbox[2] or bbox[1] > bbox[3]:
+            raise ValueError("Invalid bbox")
+        z, t = int(z), int(t)
+        resolution = float(request.GET.get("resolution", 0))
+        limit = min(int(request.GET.get("limit", MAX_VIEWPORT_SHAPES)),
+                    MAX_VIEWPORT_SHAPES)
+        binary = request.GET.get("format", "json") == "binary"
+        compress = request.GET.get("compress", "false") == "true"
+    except Exception:
+        return JsonResponse({"error": "Invalid Parameter types"})
+
+    img = get_image_descriptor(conn, image_id)
+    if img is None:
+        return JsonResponse({"error": "Image not Found"}, status=404)
+
+    try:
+        index = get_shape_index(
+            conn, img.getId(), img.getSizeX(), img.getSizeY())
+        shape_ids = index.query(bbox, z, t)
+        rois = get_rois_with_shapes(
+            conn, shape_ids[:limit], resolution if resolution > 1 else 0)
+        rv = {
+            "data": rois,
+            "meta": {
+                "totalCount": len(shape_ids),
+                "truncated": len(shape_ids) > limit
+            }
+        }
+        if binary:
+            return HttpResponse(shape_codec.encode(rv, compress),
+                                content_type=shape_codec.CONTENT_TYPE)
+        return JsonResponse(rv)
+    except Exception as rois_in_viewport_exception:
+        return JsonResponse({"error": repr(rois_in_viewport_exception)})
+
+
+def get_rois_with_shapes(conn, shape_ids, tolerance=0):
+    """
+    Returns the given shapes (loaded in batches) grouped by their rois as
+    omero_marshal json. Polygons and polylines are simplified with the
+    given tolerance (see shapes.simplify_points)
+    """
+    rois = {}
+    for b in range(0, len(shape_ids), ROI_BATCH_SIZE):
+        params = ParametersI()
+        params.addIds(shape_ids[b:b + ROI_BATCH_SIZE])
+        with phase('query'):
+            shapes = conn.getQueryService().findAllByQuery(
+                "select s from Shape s join fetch s.roi " +
+                "left outer join fetch s.transform where s.id in (:ids)",
+                params, conn.SERVICE_OPTS)
+        for shape in shapes:
+            roi = shape.getRoi()
+            roi_id = roi.getId().getValue()
+            if roi_id not in rois:
+                rois[roi_id] = omero_marshal.get_encoder(
+                    roi.__class__).encode(roi)
+                rois[roi_id]['shapes'] = []
+            encoded_shape = omero_marshal.get_encoder(
+                shape.__class__).encode(shape)
+            if tolerance > 0 and 'Points' in encoded_shape:
+                points = parse_points(encoded_shape['Points'])
+                encoded_shape['Points'] = format_points(
+                    simplify_points(points, tolerance))
+            rois[roi_id]['shapes'].append(encoded_shape)
+    return [rois[key] for key in sorted(rois.keys())]
+
+
+@instrumented
 @login_required()
 def image_data(request, image_id, conn=None, **kwargs):
 
-    image = conn.getObject("Image", image_id)
+    # one query gives us the state that cached responses are validated by
+    # (as well as the roi count), and tells us if the image exists
+    try:
+        image_state = get_image_state(conn, image_id)
+    except Exception as image_data_retrieval_exception:
+        return JsonResponse({'error': repr(image_data_retrieval_exception)})
+    if image_state is None:
+        return JsonResponse({"error": "Image not found"}, status=404)
+    lazy_delta_t = request.GET.get('delta_t', None) == 'lazy'
+    cache_key = get_cache_scope(conn) + (long(image_id),) + image_state + \
+        (lazy_delta_t,)
+    rv = IMAGE_DATA_CACHE.get(cache_key)
+    if rv is not None:
+        return JsonResponse(rv)
+    # the image (or its state) is new to us, so might be its descriptor
+    invalidate_image_descriptor(image_id)
+
+    with phase('gateway'):
+        image = conn.getObject("Image", image_id)
 
     if image is None:
         return JsonResponse({"error": "Image not found"}, status=404)
 
     try:
-        rv = imageMarshal(image)
+        rv = get_image_data(conn, image, image_state[2], lazy_delta_t)
+        IMAGE_DATA_CACHE.set(cache_key, rv)
+    except Exception as image_data_retrieval_exception:
+        return JsonResponse({'error': repr(image_data_retrieval_exception)})
 
-        # set roi count
-        rv['roi_count'] = image.getROICount()
-
-        # Add extra parameters with units data
-        # Note ['pixel_size']['x'] will have size in MICROMETER
-        px = image.getPrimaryPixels().getPhysicalSizeX()
-        if (px is not None):
-            size = image.getPixelSizeX(True)
-            value = format_value_with_units(size)
-            rv['pixel_size']['unit_x'] = value[0]
-            rv['pixel_size']['symbol_x'] = value[1]
-        py = image.getPrimaryPixels().getPhysicalSizeY()
-        if (py is not None):
-            size = image.getPixelSizeY(True)
-            value = format_value_with_units(size)
-            rv['pixel_size']['unit_y'] = value[0]
-            rv['pixel_size']['symbol_y'] = value[1]
-        pz = image.getPrimaryPixels().getPhysicalSizeZ()
-        if (pz is not None):
-            size = image.getPixelSizeZ(True)
-            value = format_value_with_units(size)
-            rv['pixel_size']['unit_z'] = value[0]
-            rv['pixel_size']['symbol_z'] = value[1]
-
-        size_t = image.getSizeT()
-        time_list = []
-        delta_t_unit_symbol = None
-        if size_t > 1:
-            params = omero.sys.ParametersI()
-            params.addLong('pid', image.getPixelsId())
-            z = 0
-            c = 0
-            query = "from PlaneInfo as Info where"\
-                " Info.theZ=%s and Info.theC=%s and pixels.id=:pid" % (z, c)
-            info_list = conn.getQueryService().findAllByQuery(
-                query, params, conn.SERVICE_OPTS)
-            timemap = {}
-            for info in info_list:
-                t_index = info.theT.getValue()
-                if info.deltaT is not None:
-                    value = format_value_with_units(info.deltaT)
-                    timemap[t_index] = value[0]
-                    if delta_t_unit_symbol is None:
-                        delta_t_unit_symbol = value[1]
-            for t in range(image.getSizeT()):
-                if t in timemap:
-                    time_list.append(timemap[t])
+    # have the percentiles ready the next time the image is opened,
+    # which is merely an optimization that mustn't fail the request
+    if rv['channel_percentiles'] is None and \
+            iviewer_settings.IMAGE_STATS_ON_OPEN:
+        try:
+            submit_image_stats(conn, get_image_descriptor(conn, image_id))
+        except Exception:
+            pass
+    return JsonResponse(rv)
 
-        rv['delta_t'] = time_list
-        rv['delta_t_unit_symbol'] = delta_t_unit_symbol
-        df = "%Y-%m-%d %H:%M:%S"
-        rv['import_date'] = image.creationEventDate().strftime(df)
-        if image.getAcquisitionDate() is not None:
-            rv['acquisition_date'] = image.getAcquisitionDate().strftime(df)
 
-        return JsonResponse(rv)
+@instrumented
+@login_required()
+def images_data(request, conn=None, **kwargs):
+    """
+    Returns the image_data responses for a list of images (ids) or the
+    images of a dataset or well (paged via offset and limit)
+    """
+    ids = request.GET.get("ids", None)
+    dataset_id = request.GET.get("dataset", None)
+    well_id = request.GET.get("well", None)
+    if ids is None and dataset_id is None and well_id is None:
+        return JsonResponse(
+            {"error": "Please supply image ids, a dataset or a well id"})
+    lazy_delta_t = request.GET.get('delta_t', None) == 'lazy'
+
+    try:
+        offset = int(request.GET.get("offset", 0))
+        limit = min(int(request.GET.get("limit", MAX_IMAGES_DATA)),
+                    MAX_IMAGES_DATA)
+        if ids is not None:
+            image_ids = [long(i) for i in ids.split(',') if i != '']
+            image_ids = image_ids[offset:offset + limit]
+    except Exception:
+        return JsonResponse({"error": "Invalid Parameter types"})
+
+    try:
+        if ids is None:
+            image_ids = get_container_image_ids(
+                conn, dataset_id, well_id, offset, limit)
+        if len(image_ids) == 0:
+            return JsonResponse({'data': []})
+
+        # validate cached responses for all images with one query
+        # and load the remaining images in one go
+        scope = get_cache_scope(conn)
+        image_states = get_image_states(conn, image_ids)
+        rvs = {}
+        to_be_loaded = []
+        for image_id, image_state in image_states.items():
+            rv = IMAGE_DATA_CACHE.get(
+                scope + (image_id,) + image_state + (lazy_delta_t,))
+            if rv is not None:
+                rvs[image_id] = rv
+            else:
+                to_be_loaded.append(image_id)
+        if len(to_be_loaded) > 0:
+            roi_counts = dict([(image_id, image_states[image_id][2])
+                               for image_id in to_be_loaded])
+            for image_id, rv in get_images_data(
+                    conn, roi_counts, lazy_delta_t).items():
+                if 'error' not in rv:
+                    IMAGE_DATA_CACHE.set(
+                        scope + (image_id,) + image_states[image_id] +
+                        (lazy_delta_t,), rv)
+                rvs[image_id] = rv
+
+        return JsonResponse({'data': [
+            rvs.get(i, {'id': i, 'error': "Image not found"})
+            for i in image_ids]})
     except Exception as image_data_retrieval_exception:
         return JsonResponse({'error': repr(image_data_retrieval_exception)})
 
 
+def get_container_image_ids(conn, dataset_id, well_id, offset, limit):
+    """
+    Returns the ids of the images of the given dataset (or well)
+    """
+    params = ParametersI()
+    params.page(offset, limit)
+    if dataset_id is not None:
+        params.addId(long(dataset_id))
+        query = "select l.child.id from DatasetImageLink l " + \
+            "where l.parent.id = :id order by l.child.id"
+    else:
+        params.addId(long(well_id))
+        query = "select ws.image.id from WellSample ws " + \
+            "where ws.well.id = :id order by well_index"
+    ctx = conn.SERVICE_OPTS.copy()
+    if ctx.getOmeroGroup() is None:
+        ctx.setOmeroGroup(-1)
+    return [row[0].val for row in conn.getQueryService().projection(
+        query, params, ctx)]
+
+
+def get_image_state(conn, image_id):
+    """
+    Returns the last update event of the image and of its rendering
+    settings, its roi count and the last update event of its channels
+    and of their logical channels (or None if not found)
+    """
+    return get_image_states(conn, [image_id]).get(long(image_id), None)
+
+
+def get_image_states(conn, image_ids):
+    """
+    Returns a dictionary of image id to the image state
+    (see get_image_state) for the given images with one query
+    """
+    if len(image_ids) == 0:
+        return {}
+    params = ParametersI()
+    params.addIds([long(image_id) for image_id in image_ids])
+    ctx = conn.SERVICE_OPTS.copy()
+    if ctx.getOmeroGroup() is None:
+        ctx.setOmeroGroup(-1)
+    with phase('query'):
+        result = conn.getQueryService().projection(
+            "select i.id, i.details.updateEvent.id, " +
+            "(select max(r.details.updateEvent.id) from RenderingDef r " +
+            "where r.pixels.image.id = i.id), " +
+            "(select count(roi.id) from Roi roi where roi.image.id = i.id), " +
+            "(select max(c.details.updateEvent.id) from Channel c " +
+            "where c.pixels.image.id = i.id), " +
+            "(select max(lc.details.updateEvent.id) from Channel c " +
+            "join c.logicalChannel lc where c.pixels.image.id = i.id) " +
+            "from Image i where i.id in (:ids)", params, ctx)
+    states = {}
+    for row in result:
+        states[row[0].val] = tuple([unwrap(v) for v in row[1:]])
+    return states
+
+
+def invalidate_image_data(image_id):
+    """
+    Removes the cached image_data responses for the given image
+    """
+    image_id = long(image_id)
+    IMAGE_DATA_CACHE.invalidate(lambda key: key[2] == image_id)
+
+
+def get_image_data(conn, image, roi_count, lazy_delta_t=False):
+    """
+    Returns the image_data response for the given image. If lazy_delta_t
+    is True, only the number of delta t values is included, the values
+    can be requested (paged) via delta_t
+    """
+    with phase('marshal', calls=0):
+        rv = imageMarshal(image)
+    return add_image_details(conn, image, rv, roi_count, lazy_delta_t)
+
+
+def get_images_data(conn, roi_counts, lazy_delta_t=False):
+    """
+    Returns a dictionary of image id to the image_data response (or an
+    error) for the given dictionary of image id to roi count. The images
+    are loaded and marshalled with a few queries for all of them (see
+    marshal_images), only the ones that need a rendering engine go
+    through imageMarshal one by one
+    """
+    ctx = conn.SERVICE_OPTS.copy()
+    if ctx.getOmeroGroup() is None:
+        ctx.setOmeroGroup(-1)
+    params = ParametersI()
+    params.addIds(roi_counts.keys())
+    with phase('query'):
+        images = conn.getQueryService().findAllByQuery(
+            "select i from Image i join fetch i.details.owner " +
+            "join fetch i.details.group join fetch i.details.creationEvent " +
+            "left outer join fetch i.pixels p " +
+            "left outer join fetch p.pixelsType where i.id in (:ids)",
+            params, ctx)
+    with_pixels = set([image.getId().getValue() for image in images
+                       if image.sizeOfPixels() > 0])
+    images = [ImageWrapper(conn, image) for image in images]
+    with_pixels = [image for image in images if image.getId() in with_pixels]
+    # look up the delta t values of all images at once
+    get_delta_ts(conn, dict(
+        [(image.getPixelsId(), image.getSizeT()) for image in with_pixels]))
+    marshalled = marshal_images(conn, with_pixels, ctx)
+
+    ret = {}
+    for image in images:
+        image_id = image.getId()
+        try:
+            rv = marshalled.get(image_id, None)
+            if rv is None:
+                with phase('marshal', calls=0):
+                    rv = imageMarshal(image)
+            ret[image_id] = add_image_details(
+                conn, image, rv, roi_counts[image_id], lazy_delta_t)
+        except Exception as image_data_retrieval_exception:
+            ret[image_id] = {'id': image_id,
+                             'error': repr(image_data_retrieval_exception)}
+    return ret
+
+
+def marshal_images(conn, images, ctx):
+    """
+    Returns a dictionary of image id to what imageMarshal returns for the
+    given images (gateway wrappers with their pixels loaded). Instead of
+    a rendering engine (and several queries) per image, the parents,
+    channels and rendering settings of all images are looked up with one
+    query each. Images that have no rendering settings yet (which the
+    rendering engine would create) and pyramids (whose tiles we'd need
+    the rendering engine for) are left out
+    """
+    if len(images) == 0:
+        return {}
+    image_ids = [image.getId() for image in images]
+    pixels_ids = [image.getPixelsId() for image in images]
+    owner_ids = set([conn.getUserId()] +
+                    [image.getOwner().getId() for image in images])
+    image_params = ParametersI()
+    image_params.addIds(image_ids)
+    pixels_params = ParametersI()
+    pixels_params.addIds(pixels_ids)
+    pixels_params.add('owners', rlist([rlong(id) for id in owner_ids]))
+    query_service = conn.getQueryService()
+    with phase('query', calls=7):
+        projects = query_service.projection(
+            "select i.id, p.id, p.name, p.description from Image i " +
+            "join i.datasetLinks dl join dl.parent ds " +
+            "join ds.projectLinks pl join pl.parent p where i.id in (:ids)",
+            image_params, ctx)
+        datasets = query_service.projection(
+            "select l.child.id, d.id, d.name, d.description " +
+            "from DatasetImageLink l join l.parent d " +
+            "where l.child.id in (:ids)", image_params, ctx)
+        wells = query_service.projection(
+            "select ws.image.id, ws.well.id from WellSample ws " +
+            "where ws.image.id in (:ids)", image_params, ctx)
+        objectives = query_service.projection(
+            "select i.id, o.nominalMagnification from Image i " +
+            "join i.objectiveSettings os join os.objective o " +
+            "where i.id in (:ids)", image_params, ctx)
+        pixels = query_service.findAllByQuery(
+            "select p from Pixels p join fetch p.pixelsType " +
+            "join fetch p.channels c join fetch c.logicalChannel " +
+            "left outer join fetch c.statsInfo where p.id in (:ids)",
+            pixels_params, ctx)
+        rdefs = query_service.findAllByQuery(
+            "select r from RenderingDef r join fetch r.model " +
+            "join fetch r.waveRendering cb left outer join fetch cb.family " +
+            "where r.pixels.id in (:ids) and r.details.owner.id in (:owners)",
+            pixels_params, ctx)
+        inverted = set([row[0].val for row in query_service.projection(
+            "select c.channelBinding.id from ReverseIntensityContext c " +
+            "where c.channelBinding.renderingDef.pixels.id in (:ids)",
+            pixels_params, ctx)])
+
+    def group_rows(rows):
+        grouped = {}
+        for row in rows:
+            grouped.setdefault(row[0].val, []).append(
+                [unwrap(v) for v in row[1:]])
+        return grouped
+
+    projects = group_rows(projects)
+    datasets = group_rows(datasets)
+    wells = group_rows(wells)
+    objectives = group_rows(objectives)
+    channels = dict([(p.getId().getValue(), p.copyChannels())
+                     for p in pixels])
+    # like the rendering engine we use the user's settings if there are
+    # any, otherwise the ones of the image's owner (the latest ones)
+    rdefs_by_owner = {}
+    for rdef in sorted(rdefs, key=lambda r: r.getId().getValue()):
+        rdefs_by_owner[(rdef.getPixels().getId().getValue(),
+                        rdef.getDetails().getOwner().getId().getValue())] = \
+            rdef
+
+    ret = {}
+    for image in images:
+        image_id = image.getId()
+        pixels_id = image.getPixelsId()
+        rdef = rdefs_by_owner.get(
+            (pixels_id, conn.getUserId()),
+            rdefs_by_owner.get((pixels_id, image.getOwner().getId())))
+        if rdef is None or pixels_id not in channels:
+            continue
+        reader = PixelsReader(
+            conn, pixels_id, image.getPixelsType(),
+            image.getSizeX(), image.getSizeY())
+        try:
+            if len(reader.get_resolutions()) > 1:
+                continue
+        except Exception:
+            continue
+        finally:
+            reader.close()
+
+        project = projects.get(image_id, [])
+        project = project[0] if len(project) == 1 else None
+        dataset = datasets.get(image_id, [])
+        dataset = dataset[0] if len(dataset) == 1 else None
+        well = wells.get(image_id, [])
+        well = well[0] if len(well) == 1 else None
+        owner = image.getOwner()
+        pixel_range = get_pixel_range(image.getPixelsType())
+        greyscale = \
+            rdef.getModel().getValue().getValue().lower() == 'greyscale'
+        image_channels = []
+        for index, (channel, binding) in enumerate(
+                zip(channels[pixels_id], rdef.copyWaveRendering())):
+            # channels without StatsInfo have the range of the pixels type
+            # (which is what the rendering engine falls back onto)
+            stats = channel.getStatsInfo()
+            window = pixel_range if stats is None else (
+                stats.getGlobalMin().getValue(),
+                stats.getGlobalMax().getValue())
+            image_channels.append(marshal_channel(
+                ChannelWrapper(conn, channel, idx=index, img=image),
+                binding, binding.getId().getValue() in inverted, window))
+        rv = {
+            'id': image_id,
+            'meta': {
+                'imageName': image.getName() or '',
+                'imageDescription': image.getDescription() or '',
+                'imageAuthor':
+                    owner.getFirstName() + " " + owner.getLastName(),
+                'projectName': project and project[1] or 'Multiple',
+                'projectId': project and project[0] or None,
+                'projectDescription': project and project[2] or '',
+                'datasetName': dataset and dataset[1] or 'Multiple',
+                'datasetId': dataset and dataset[0] or None,
+                'datasetDescription': dataset and dataset[2] or '',
+                'wellSampleId': '',
+                'wellId': well and well[0] or '',
+                'imageTimestamp': mktime(image.getDate().timetuple()),
+                'imageId': image_id,
+                'pixelsType': image.getPixelsType(),
+            },
+            'perms': {
+                'canAnnotate': image.canAnnotate(),
+                'canEdit': image.canEdit(),
+                'canDelete': image.canDelete(),
+                'canLink': image.canLink()
+            },
+            'tiles': False,
+            'interpolate': True,
+            'size': {'width': image.getSizeX(),
+                     'height': image.getSizeY(),
+                     'z': image.getSizeZ(),
+                     't': image.getSizeT(),
+                     'c': image.getSizeC()},
+            'pixel_size': {'x': get_size_in_microns(image.getPixelSizeX),
+                           'y': get_size_in_microns(image.getPixelSizeY),
+                           'z': get_size_in_microns(image.getPixelSizeZ)},
+            'init_zoom': 0,
+            'pixel_range': pixel_range,
+            'channels': image_channels,
+            'split_channel': image.splitChannelDims(),
+            'rdefs': {
+                'model': 'greyscale' if greyscale else 'color',
+                'projection': 'normal',
+                'defaultZ': rdef.getDefaultZ().getValue(),
+                'defaultT': rdef.getDefaultT().getValue(),
+                'invertAxis': False
+            }
+        }
+        magnification = objectives.get(image_id, [[None]])[0][0]
+        if magnification is not None:
+            rv['nominalMagnification'] = magnification
+        ret[image_id] = rv
+    return ret
+
+
+def marshal_channel(channel, binding, inverted, window):
+    """
+    Returns what channelMarshal returns for the given channel (a gateway
+    wrapper without rendering engine), its channel binding, whether that
+    is inverted and the (min, max) window of the channel
+    """
+    rv = {
+        'emissionWave': channel.getEmissionWave(),
+        'label': channel.getLabel(),
+        'color': "%0.2X%0.2X%0.2X" % (
+            binding.getRed().getValue(), binding.getGreen().getValue(),
+            binding.getBlue().getValue()),
+        'inverted': inverted,
+        'reverseIntensity': inverted,
+        'family': binding.getFamily().getValue().getValue(),
+        'coefficient': binding.getCoefficient().getValue(),
+        'window': {'min': window[0],
+                   'max': window[1],
+                   'start': binding.getInputStart().getValue(),
+                   'end': binding.getInputEnd().getValue()},
+        'active': binding.getActive().getValue()
+    }
+    lut = unwrap(binding.getLookupTable())
+    if lut:
+        rv['lut'] = lut
+    return rv
+
+
+def get_size_in_microns(get_size):
+    """
+    Returns the physical size returned by the given getter (e.g.
+    ImageWrapper.getPixelSizeX) in microns or None (like imageMarshal)
+    """
+    try:
+        size = get_size('MICROMETER')
+        return size.getValue() if size else None
+    except Exception:
+        return None
+
+
+def get_pixel_range(pixels_type):
+    """
+    Returns the (min, max) values of the given pixels type
+    (like ImageWrapper.getPixelRange, floats included)
+    """
+    dtype = get_pixels_dtype(pixels_type)
+    pmax = 2 ** (8 * dtype.itemsize)
+    if dtype.kind in 'if':
+        return (-pmax // 2, pmax // 2 - 1)
+    return (0, pmax - 1)
+
+
+def add_image_details(conn, image, rv, roi_count, lazy_delta_t=False):
+    """
+    Adds what the image_data response has on top of imageMarshal's rv
+    (roi count, units, delta t, dates and percentiles) for the given image
+    """
+    # set roi count
+    rv['roi_count'] = roi_count
+
+    # Add extra parameters with units data
+    # Note ['pixel_size']['x'] will have size in MICROMETER
+    pixels = image.getPrimaryPixels()
+    px = pixels.getPhysicalSizeX()
+    if (px is not None):
+        size = image.getPixelSizeX(True)
+        value = format_value_with_units(size)
+        rv['pixel_size']['unit_x'] = value[0]
+        rv['pixel_size']['symbol_x'] = value[1]
+    py = pixels.getPhysicalSizeY()
+    if (py is not None):
+        size = image.getPixelSizeY(True)
+        value = format_value_with_units(size)
+        rv['pixel_size']['unit_y'] = value[0]
+        rv['pixel_size']['symbol_y'] = value[1]
+    pz = pixels.getPhysicalSizeZ()
+    if (pz is not None):
+        size = image.getPixelSizeZ(True)
+        value = format_value_with_units(size)
+        rv['pixel_size']['unit_z'] = value[0]
+        rv['pixel_size']['symbol_z'] = value[1]
+
+    time_list, delta_t_unit_symbol = get_delta_t(
+        conn, image.getPixelsId(), image.getSizeT())
+    if lazy_delta_t:
+        rv['delta_t_count'] = len(time_list)
+    else:
+        rv['delta_t'] = time_list
+    rv['delta_t_unit_symbol'] = delta_t_unit_symbol
+    df = "%Y-%m-%d %H:%M:%S"
+    rv['import_date'] = image.creationEventDate().strftime(df)
+    if image.getAcquisitionDate() is not None:
+        rv['acquisition_date'] = image.getAcquisitionDate().strftime(df)
+
+    # per channel percentiles for auto-contrast (if computed already)
+    rv['channel_percentiles'] = IMAGE_STATS_CACHE.get(image.getPixelsId())
+
+    return rv
+
+
+@instrumented
+@login_required()
+def image_stats(request, image_id, conn=None, **kwargs):
+    """
+    Returns the per channel min, max and percentiles of the image's
+    intensities (see stats.compute_channel_percentiles) if known,
+    otherwise their computation is started (unless it's running already)
+    and the job's state is returned. Poll until the state is finished
+    """
+    img = get_image_descriptor(conn, image_id)
+    if img is None:
+        return JsonResponse({"error": "Image not Found"}, status=404)
+
+    result = IMAGE_STATS_CACHE.get(img.getPixelsId())
+    if result is not None:
+        return JsonResponse(
+            {"state": "finished", "progress": 1.0, "result": result})
+    try:
+        job = submit_image_stats(conn, img)
+    except Exception as image_stats_exception:
+        return JsonResponse({"error": repr(image_stats_exception)})
+    if job is None:
+        return JsonResponse(
+            {"error": "Too many statistics in progress, " +
+                "please try again later"})
+    return JsonResponse(job.as_dict())
+
+
+def submit_image_stats(conn, image):
+    """
+    Submits a job computing the percentiles of the given image
+    (descriptor, see descriptors.get_image_descriptor) which
+    stores them in the cache (there is only one job per image).
+    Returns the job or None if the user has too many jobs running
+    """
+    image_id = image.getId()
+    pixels_id = image.getPixelsId()
+    job_key = ('image_stats', pixels_id)
+    job = IMAGE_STATS_JOBS.find(job_key)
+    if job is not None:
+        return job
+
+    pixels_type = image.getPixelsType()
+    sizes = (image.getSizeX(), image.getSizeY(), image.getSizeZ(),
+             image.getSizeC(), image.getSizeT())
+    job_conn = clone_connection(conn)
+
+    def run_image_stats(job):
+        reader = None
+        try:
+            size_x, size_y, size_z, size_c, size_t = sizes
+            # the sampled blocks would only evict the cached ones
+            # of interactive requests
+            reader = PixelsReader(
+                job_conn, pixels_id, pixels_type, size_x, size_y,
+                cache=False)
+            result = compute_channel_percentiles(
+                reader, size_z, size_c, size_t,
+                iviewer_settings.IMAGE_STATS_PERCENTILES,
+                iviewer_settings.IMAGE_STATS_MAX_PLANES,
+                iviewer_settings.IMAGE_STATS_MAX_SAMPLES, job)
+            IMAGE_STATS_CACHE.set(pixels_id, result)
+            # image_data responses include them from now on
+            invalidate_image_data(image_id)
+            return result
+        finally:
+            if reader is not None:
+                reader.close()
+            job_conn.close(hard=False)
+
+    job = IMAGE_STATS_JOBS.submit(
+        conn.getUserId(), run_image_stats, max(sizes[3], 1), job_key)
+    if job is None:
+        job_conn.close(hard=False)
+    return job
+
+
+def get_delta_t(conn, pixels_id, size_t):
+    """
+    Returns the delta t values (of the planes for z/c 0) converted by
+    format_value_with_units and the unit symbol
+    """
+    return get_delta_ts(conn, {pixels_id: size_t})[pixels_id]
+
+
+def get_delta_ts(conn, sizes_t):
+    """
+    Returns a dictionary of pixels id to delta t values and unit symbol
+    (see get_delta_t) for the given dictionary of pixels id to size t.
+    The ones that aren't cached are looked up with one query for the
+    scalar values (ordered by t) and one for the units, assuming that
+    the values share the unit of the first plane info
+    """
+    scope = get_cache_scope(conn)
+    ret = {}
+    to_be_queried = {}
+    for pixels_id, size_t in sizes_t.items():
+        rv = DELTA_T_CACHE.get(scope + (pixels_id,))
+        if rv is not None:
+            ret[pixels_id] = rv
+        elif size_t > 1:
+            to_be_queried[pixels_id] = size_t
+        else:
+            ret[pixels_id] = ([], None)
+
+    if len(to_be_queried) > 0:
+        query_service = conn.getQueryService()
+        params = omero.sys.ParametersI()
+        params.addIds(to_be_queried.keys())
+        condition = " from PlaneInfo as {0} where" \
+            " {0}.theZ=0 and {0}.theC=0 and {0}.pixels.id in (:ids)" \
+            " and {0}.deltaT.value is not null"
+        with phase('query', calls=2):
+            infos = query_service.findAllByQuery(
+                "select Info" + condition.format("Info") +
+                " and Info.id in (select min(First.id)" +
+                condition.format("First") + " group by First.pixels.id)",
+                params, conn.SERVICE_OPTS)
+            rows = query_service.projection(
+                "select Info.pixels.id, Info.theT, Info.deltaT.value" +
+                condition.format("Info") + " order by Info.theT",
+                params, conn.SERVICE_OPTS)
+        factors = {}
+        for info in infos:
+            factors[info.pixels.id.val] = format_value_with_units(
+                omero.model.TimeI(1.0, info.deltaT.getUnit()))
+        timemaps = {}
+        for v in rows:
+            pixels_id, t_index = v[0].val, v[1].val
+            if pixels_id in factors and t_index < to_be_queried[pixels_id]:
+                timemaps.setdefault(pixels_id, {})[t_index] = \
+                    v[2].val * factors[pixels_id][0]
+        for pixels_id in to_be_queried:
+            timemap = timemaps.get(pixels_id, {})
+            rv = ([timemap[t] for t in sorted(timemap.keys())],
+                  factors.get(pixels_id, (None, None))[1])
+            DELTA_T_CACHE.set(scope + (pixels_id,), rv)
+            ret[pixels_id] = rv
+    return ret
+
+
+@instrumented
+@login_required()
+def delta_t(request, image_id, conn=None, **kwargs):
+    image = get_image_descriptor(conn, image_id)
+    if image is None:
+        return JsonResponse({"error": "Image not found"}, status=404)
+
+    try:
+        offset = int(request.GET.get("offset", 0))
+        limit = int(request.GET.get("limit", 100))
+    except Exception:
+        return JsonResponse({"error": "Invalid Parameter types"})
+
+    try:
+        time_list, delta_t_unit_symbol = get_delta_t(
+            conn, image.getPixelsId(), image.getSizeT())
+        return JsonResponse({
+            "data": time_list[offset:offset + limit],
+            "delta_t_unit_symbol": delta_t_unit_symbol,
+            "meta": {
+                "totalCount": len(time_list),
+                "offset": offset,
+                "limit": limit
+            }
+        })
+    except Exception as delta_t_retrieval_exception:
+        return JsonResponse({'error': repr(delta_t_retrieval_exception)})
+
+
 def format_value_with_units(value):
         """
         Formats the response for methods above.
@@ -307,6 +1383,7 @@ def format_value_with_units(value):
         return (length, unit)
 
 
+@instrumented
 @login_required()
 def save_projection(request, conn=None, **kwargs):
     # check for mandatory parameters
@@ -323,74 +1400,144 @@ def save_projection(request, conn=None, **kwargs):
     start = request.GET.get("start", None)
     end = request.GET.get("end", None)
     dataset_id = request.GET.get("dataset", None)
+    # if async=true is given the projection is run as a background job
+    # whose progress/result can be queried via projection_status
+    run_async = request.GET.get("async", "false").lower() == "true"
 
     # retrieve image object
     img = conn.getObject("Image", image_id, opts=conn.SERVICE_OPTS)
     if img is None:
         return JsonResponse({"error": "Image not Found"}, status=404)
 
+    if run_async:
+        try:
+            job_conn = clone_connection(conn)
+        except Exception as clone_connection_exception:
+            return JsonResponse({"error": repr(clone_connection_exception)})
+
+        def run_projection(job):
+            try:
+                job_img = job_conn.getObject(
+                    "Image", image_id, opts=job_conn.SERVICE_OPTS)
+                if job_img is None:
+                    raise ValueError("Image not Found")
+                return project_image(
+                    job_conn, job_img, proj_type, start, end, dataset_id,
+                    job)
+            finally:
+                job_conn.close(hard=False)
+
+        job = PROJECTION_JOBS.submit(
+            conn.getUserId(), run_projection, PROJECTION_STEPS)
+        if job is None:
+            job_conn.close(hard=False)
+            return JsonResponse(
+                {"error": "Too many projections in progress, " +
+                    "please try again later"})
+        return JsonResponse(job.as_dict())
+
     new_image_id = None
     try:
-        # no getter defined in gateway...
-        proj_svc = conn._proxies['projection']
+        new_image_id = project_image(
+            conn, img, proj_type, start, end, dataset_id)
+    except Exception as save_projection_exception:
+        return JsonResponse({"error": repr(save_projection_exception)})
 
-        # gather params needed for projection call
-        pixels_id = img.getPixelsId()
-        pixels = img.getPrimaryPixels()
-        pixels_type = pixels.getPixelsType()._obj
+    return JsonResponse({"id": new_image_id})
 
-        # assemble new file name
-        filename, extension = splitext(img.getName())
-        file_name = filename + '_proj' + extension
 
-        # delegate to projectPixels
-        new_image_id = proj_svc.projectPixels(
-            pixels_id, pixels_type, proj, 0, img.getSizeT()-1,
-            range(img.getSizeC()), 1, int(start), int(end), file_name)
+def project_image(conn, img, proj_type, start, end, dataset_id, job=None):
+    """
+    Creates a new image for the given projection of img (from z-section
+    start to end) returning its id. The optional job is notified of
+    every step done (see PROJECTION_STEPS)
+    """
+    proj = PROJECTIONS[proj_type]
 
-        # apply present rendering settings
-        try:
-            rnd = conn.getRenderingSettingsService()
-            rnd.applySettingsToImage(pixels_id, new_image_id)
-        except Exception:
-            pass
+    # no getter defined in gateway...
+    proj_svc = conn._proxies['projection']
 
-        # set image decription
-        details = []
-        details.append("Original Image: " + img.getName())
-        details.append("Original Image ID: " + image_id)
-        details.append("Projection Type: " + proj_type)
-        details.append(
-            "z-sections: " + str(int(start)+1) + "-" + str(int(end)+1))
-        size_t = img.getSizeT()
-        if size_t == 1:
-            details.append("timepoint: " + str(size_t))
-        else:
-            details.append("timepoints: 1-" + str(size_t))
-        description = "\n".join(details)
-
-        new_img = conn.getObject(
-            "Image", new_image_id, opts=conn.SERVICE_OPTS)
-        new_img.setDescription(description)
-        new_img.save()
-
-        # if we have a dataset id => we try to link to it
-        if dataset_id is not None:
-            upd_svc = conn.getUpdateService()
-            conn.SERVICE_OPTS.setOmeroGroup(
-                conn.getGroupFromContext().getId())
-            link = omero.model.DatasetImageLinkI()
-            link.parent = omero.model.DatasetI(long(dataset_id), False)
-            link.child = omero.model.ImageI(new_image_id, False)
-            upd_svc.saveObject(link, conn.SERVICE_OPTS)
-    except Exception as save_projection_exception:
-        return JsonResponse({"error": repr(save_projection_exception)})
+    # gather params needed for projection call
+    pixels_id = img.getPixelsId()
+    pixels = img.getPrimaryPixels()
+    pixels_type = pixels.getPixelsType()._obj
 
-    return JsonResponse({"id": new_image_id})
+    # assemble new file name
+    filename, extension = splitext(img.getName())
+    file_name = filename + '_proj' + extension
 
+    # delegate to projectPixels
+    new_image_id = proj_svc.projectPixels(
+        pixels_id, pixels_type, proj, 0, img.getSizeT()-1,
+        range(img.getSizeC()), 1, int(start), int(end), file_name)
+    if job is not None:
+        job.step()
 
+    # apply present rendering settings
+    try:
+        rnd = conn.getRenderingSettingsService()
+        rnd.applySettingsToImage(pixels_id, new_image_id)
+    except Exception:
+        pass
+    if job is not None:
+        job.step()
+
+    # set image decription
+    details = []
+    details.append("Original Image: " + img.getName())
+    details.append("Original Image ID: " + str(img.getId()))
+    details.append("Projection Type: " + proj_type)
+    details.append(
+        "z-sections: " + str(int(start)+1) + "-" + str(int(end)+1))
+    size_t = img.getSizeT()
+    if size_t == 1:
+        details.append("timepoint: " + str(size_t))
+    else:
+        details.append("timepoints: 1-" + str(size_t))
+    description = "\n".join(details)
+
+    new_img = conn.getObject(
+        "Image", new_image_id, opts=conn.SERVICE_OPTS)
+    new_img.setDescription(description)
+    new_img.save()
+    if job is not None:
+        job.step()
+
+    # if we have a dataset id => we try to link to it
+    if dataset_id is not None:
+        upd_svc = conn.getUpdateService()
+        conn.SERVICE_OPTS.setOmeroGroup(
+            conn.getGroupFromContext().getId())
+        link = omero.model.DatasetImageLinkI()
+        link.parent = omero.model.DatasetI(long(dataset_id), False)
+        link.child = omero.model.ImageI(new_image_id, False)
+        upd_svc.saveObject(link, conn.SERVICE_OPTS)
+
+    return new_image_id
+
+
+@instrumented
+@login_required()
+def projection_status(request, conn=None, **kwargs):
+    job_id = request.GET.get("job", None)
+    if job_id is None:
+        return JsonResponse({"error": "No job id provided."})
+
+    # jobs are only visible to the user that submitted them
+    job = PROJECTION_JOBS.get(job_id, conn.getUserId())
+    if job is None:
+        return JsonResponse({"error": "Job not found"}, status=404)
+    return JsonResponse(job.as_dict())
+
+
+@instrumented
 @login_required()
 def well_images(request, conn=None, **kwargs):
+    # all fields of a plate row or column can be requested at once
+    plate_id = request.GET.get("plate", None)
+    if plate_id is not None:
+        return plate_images(request, plate_id, conn)
+
     # check for mandatory parameter id
     well_id = request.GET.get("id", None)
     if well_id is None:
@@ -403,28 +1550,43 @@ def well_images(request, conn=None, **kwargs):
         params = ParametersI()
         params.add("well_id", rlong(long(well_id)))
 
-        # get total count first
-        count = query_service.projection(
-            "select count(distinct ws.id) from WellSample ws " +
-            "where ws.well.id = :well_id", params, )
-        results = {"data": [], "meta": {"totalCount": count[0][0].val}}
-
-        # set offset and limit
+        # get total count first (unless we have it already)
+        count_key = get_cache_scope(conn) + (long(well_id),)
+        count = WELL_IMAGES_COUNT_CACHE.get(count_key)
+        if count is None:
+            count = query_service.projection(
+                "select count(distinct ws.id) from WellSample ws " +
+                "where ws.well.id = :well_id", params)[0][0].val
+            WELL_IMAGES_COUNT_CACHE.set(count_key, count)
+        results = {"data": [], "meta": {"totalCount": count}}
+
+        # we page either by well index (keyset) if after/before are given
+        # or by offset, with limit in all cases
+        query = "select ws.image.id, ws.image.name, index(ws) " + \
+            "from Well w join w.wellSamples ws where w.id = :well_id"
         filter = omero.sys.Filter()
-        filter.offset = rint(request.GET.get("offset", 0))
         filter.limit = rint(request.GET.get("limit", 10))
+        after = request.GET.get("after", None)
+        before = request.GET.get("before", None)
+        if after is not None:
+            params.add("after", rint(int(after)))
+            query += " and index(ws) > :after order by index(ws)"
+        elif before is not None:
+            params.add("before", rint(int(before)))
+            query += " and index(ws) < :before order by index(ws) desc"
+        else:
+            filter.offset = rint(request.GET.get("offset", 0))
+            query += " order by index(ws)"
         params.theFilter = filter
 
-        # fire off query
-        images = query_service.findAllByQuery(
-            "select ws.image from WellSample ws " +
-            "where ws.well.id = :well_id order by well_index", params)
-
-        # we need only image id and name for our purposes
-        for img in images:
-            img_ret = {"@id": img.getId().getValue()}
-            if img.getName() is not None:
-                img_ret["Name"] = img.getName().getValue()
+        # fire off query, we need only image id and name for our purposes
+        rows = query_service.projection(query, params)
+        if before is not None:
+            rows.reverse()
+        for row in rows:
+            img_ret = {"@id": row[0].val, "well_index": row[2].val}
+            if row[1] is not None:
+                img_ret["Name"] = row[1].val
             results["data"].append(img_ret)
 
         return JsonResponse(results)
@@ -432,8 +1594,60 @@ def well_images(request, conn=None, **kwargs):
         return JsonResponse({"error": repr(get_well_images_exception)})
 
 
+def plate_images(request, plate_id, conn):
+    """
+    Returns the images of all fields of a plate's row or column
+    (ordered by column/row and well index)
+    """
+    row = request.GET.get("row", None)
+    column = request.GET.get("column", None)
+    if row is None and column is None:
+        return JsonResponse({"error": "Please supply a row or column"})
+
+    try:
+        params = ParametersI()
+        params.add("plate_id", rlong(long(plate_id)))
+        query = "select ws.image.id, ws.image.name, index(ws), " + \
+            "w.id, w.row, w.column from Well w join w.wellSamples ws " + \
+            "where w.plate.id = :plate_id"
+        if row is not None:
+            params.add("row", rint(int(row)))
+            query += " and w.row = :row order by w.column, index(ws)"
+        else:
+            params.add("column", rint(int(column)))
+            query += " and w.column = :column order by w.row, index(ws)"
+
+        results = {"data": []}
+        for r in conn.getQueryService().projection(query, params):
+            img_ret = {
+                "@id": r[0].val,
+                "well_index": r[2].val,
+                "well": r[3].val,
+                "row": unwrap(r[4]),
+                "column": unwrap(r[5])
+            }
+            if r[1] is not None:
+                img_ret["Name"] = r[1].val
+            results["data"].append(img_ret)
+        results["meta"] = {"totalCount": len(results["data"])}
+
+        return JsonResponse(results)
+    except Exception as get_plate_images_exception:
+        return JsonResponse({"error": repr(get_plate_images_exception)})
+
+
+@instrumented
 @login_required()
 def get_intensity(request, conn=None, **kwargs):
+    """
+    Returns the intensities of the pixels (of the given channels) within
+    QUERY_DISTANCE of x/y on plane z/t.
+    For pyramidal images an optional resolution level (0 being the full
+    resolution, like for webgateway's tiles) can be given. x/y are then
+    mapped to that level and the returned pixels (coordinates) refer to
+    it, the response includes the resolution and the scale (x, y) of the
+    full resolution relative to it
+    """
     # get mandatory params
     image_id = request.GET.get("image", None)
     x, y = request.GET.get("x", None), request.GET.get("y", None)
@@ -446,8 +1660,21 @@ def get_intensity(request, conn=None, **kwargs):
                 return JsonResponse(
                     {"error": "Mandatory params are: image,x,y,c, z and t"})
 
+    # optional format, the legacy one (keyed by 'x-y') is the default
+    response_format = request.GET.get("format", None)
+    if response_format is not None and \
+            response_format not in INTENSITY_FORMATS:
+        return JsonResponse(
+            {"error": "Supported formats are: " +
+                ", ".join(INTENSITY_FORMATS)})
+
+    try:
+        resolution = int(request.GET.get("resolution", 0))
+    except Exception:
+        return JsonResponse({"error": "The resolution has to be a number"})
+
     # retrieve image object
-    img = conn.getObject("Image", image_id, opts=conn.SERVICE_OPTS)
+    img = get_image_descriptor(conn, image_id)
     if img is None:
         return JsonResponse({"error": "Image not Found"}, status=404)
 
@@ -478,10 +1705,24 @@ def get_intensity(request, conn=None, **kwargs):
         return JsonResponse(
             {"error": "Please supply a valid list of channels"})
 
+    reader = None
     try:
-        raw_pixel_store = conn.createRawPixelsStore()
-        raw_pixel_store.setPixelsId(img.getPixelsId(), True)
-        pixels_type = img.getPrimaryPixels().getPixelsType().getValue()
+        pixels_type = img.getPixelsType()
+        reader = PixelsReader(
+            conn, img.getPixelsId(), pixels_type, size_x, size_y)
+
+        # map x/y to the requested resolution level
+        scale = None
+        if resolution != 0:
+            try:
+                reader.set_resolution(resolution)
+            except ValueError as invalid_resolution:
+                return JsonResponse({"error": str(invalid_resolution)})
+            scale = [size_x / float(reader.size_x),
+                     size_y / float(reader.size_y)]
+            size_x, size_y = reader.size_x, reader.size_y
+            x = min(int(x / scale[0]), size_x - 1)
+            y = min(int(y / scale[1]), size_y - 1)
 
         # determine query extent
         x_offset = x - QUERY_DISTANCE
@@ -497,38 +1738,413 @@ def get_intensity(request, conn=None, **kwargs):
         if y_offset + height >= size_y:
             height = size_y - y_offset
         extent = [x_offset, y_offset, x_offset + width, y_offset + height]
-        conversion = '>' + str(width * height) +  \
-            pixelstypetopython.toPython(pixels_type)
-
-        # prepare return object (setting extent)
-        results = {}
-        results['count'] = 0
-        results['pixels'] = {}
-
-        # loop over all channels and collect the pixel intensities
-        # contained in extent with getTile (extent width x height)
-        for chan in channels:
-            point_data = raw_pixel_store.getTile(
-                z, chan, t, x_offset, y_offset, width, height)
-            unpacked_point_data = unpack(conversion, point_data)
-            i = 0
-            for row in range(extent[1], extent[3]):
-                for col in range(extent[0], extent[2]):
-                    key = str(col) + "-" + str(row)
-                    entry = results['pixels'].get(key)
-                    if entry is None:
-                        entry = {}
-                        results['pixels'][key] = entry
-                    entry[str(chan)] = unpacked_point_data[i]
-                    i += 1
-            results['count'] += i
+
+        # read the pixel intensities contained in extent (width x height)
+        # for all channels: (channels, height, width). the reader serves
+        # them from cached blocks if it can
+        tiles = numpy.stack([
+            reader.read(z, chan, t, x_offset, y_offset, width, height)
+            for chan in channels])
+
+        if response_format == 'columnar':
+            results = intensities_as_columns(
+                tiles, extent, channels, pixels_type)
+            if scale is not None:
+                results.update({'resolution': resolution, 'scale': scale})
+            return JsonResponse(results)
+        if response_format == 'raw':
+            response = intensities_as_raw(
+                tiles, extent, channels, pixels_type)
+            if scale is not None:
+                response['X-Intensity-Resolution'] = str(resolution)
+                response['X-Intensity-Scale'] = \
+                    ",".join([repr(v) for v in scale])
+            return response
+
+        # prepare return object, one entry per pixel holding the
+        # intensities of all requested channels. we convert in bulk via
+        # tolist() which yields native python types for json encoding
+        chan_keys = [str(chan) for chan in channels]
+        values = tiles.reshape(len(channels), -1).T.tolist()
+        keys = [str(col) + "-" + str(row)
+                for row in range(extent[1], extent[3])
+                for col in range(extent[0], extent[2])]
+        results = {
+            'count': tiles.size,
+            'pixels': dict(
+                (key, dict(zip(chan_keys, vals)))
+                for key, vals in zip(keys, values))
+        }
+        if scale is not None:
+            results.update({'resolution': resolution, 'scale': scale})
         return JsonResponse(results)
     except Exception as pixel_service_exception:
         return JsonResponse({"error": repr(pixel_service_exception)})
+    finally:
+        if reader is not None:
+            reader.close()
+
+
+def intensities_as_columns(tiles, extent, channels, pixels_type):
+    """
+    Returns the intensities of tiles (channels, height, width) in columnar
+    form, i.e. one flat (row major) array per channel covering extent.
+    The intensity for x/y is found at index:
+    (y - extent[1]) * width + (x - extent[0])
+    """
+    return {
+        'extent': extent,
+        'width': tiles.shape[2],
+        'height': tiles.shape[1],
+        'dtype': pixels_type,
+        'channels': channels,
+        'count': tiles.size,
+        'data': [tile.ravel().tolist() for tile in tiles]
+    }
+
+
+def intensities_as_raw(tiles, extent, channels, pixels_type):
+    """
+    Returns the intensities of tiles (channels, height, width) as binary
+    response. The body contains the little endian (typed array compatible)
+    row major data of all channels one after the other, the extent,
+    channels and dtype are sent along as response headers.
+    """
+    data = tiles.astype(tiles.dtype.newbyteorder('<'), copy=False)
+    response = HttpResponse(
+        data.tobytes(), content_type='application/octet-stream')
+    response['X-Intensity-Extent'] = ",".join([str(e) for e in extent])
+    response['X-Intensity-Channels'] = ",".join([str(c) for c in channels])
+    response['X-Intensity-Dtype'] = pixels_type
+    return response
+
+
+@instrumented
+@login_required()
+def get_intensities(request, conn=None, **kwargs):
+    """
+    Returns the intensities for a list of points (or the points sampled
+    along a polyline at the given spacing) for several planes and channels.
+    Expects a json body of the form:
+    {"image": 1, "c": [0, 1], "planes": [[z, t], ...],
+     "points": [[x, y], ...] or "polyline": [[x, y], ...], "spacing": 1}
+    The intensities are returned as data[plane][channel][point]
+    """
+    if not request.method == 'POST':
+        return JsonResponse({"error": "Use HTTP POST to send data!"})
+
+    try:
+        query = json.loads(request.body)
+    except Exception as e:
+        return JsonResponse({"error": "Failed to load json: " + repr(e)})
+
+    # retrieve image object
+    image_id = query.get('image', None)
+    if image_id is None:
+        return JsonResponse({"error": "No image id provided!"})
+    img = get_image_descriptor(conn, image_id)
+    if img is None:
+        return JsonResponse({"error": "Image not Found"}, status=404)
+
+    # convert input params
+    try:
+        channels = [int(c) for c in query.get('c', [])]
+        planes = [[int(p[0]), int(p[1])] for p in query.get('planes', [])]
+        polyline = query.get('polyline', None)
+        if polyline is not None:
+            points = numpy.asarray(
+                polyline, dtype=numpy.float64).reshape(-1, 2)
+            spacing = float(query.get('spacing', 1))
+            if not numpy.isfinite(spacing) or spacing <= 0:
+                raise ValueError("Invalid spacing")
+            samples = count_polyline_samples(points, spacing)
+        else:
+            points = numpy.asarray(
+                query.get('points', []), dtype=numpy.float64).reshape(-1, 2)
+            samples = len(points)
+        if not numpy.isfinite(points).all():
+            raise ValueError("Invalid points")
+    except Exception:
+        return JsonResponse({"error": "Invalid Parameter types"})
+    if len(channels) == 0 or len(planes) == 0 or samples == 0:
+        return JsonResponse(
+            {"error": "Please supply points (or a polyline), planes " +
+                "and channels"})
+    # the limit is checked before a polyline is sampled
+    if samples * len(planes) * len(channels) > MAX_INTENSITY_SAMPLES:
+        return JsonResponse(
+            {"error": "Too many intensities requested (max: " +
+                str(MAX_INTENSITY_SAMPLES) + ")"})
+    if polyline is not None:
+        xs, ys = sample_polyline(points, spacing)
+    else:
+        xs, ys = points[:, 0], points[:, 1]
+    xs = numpy.floor(xs).astype(numpy.int64)
+    ys = numpy.floor(ys).astype(numpy.int64)
+
+    # bound checks
+    size_x, size_y = img.getSizeX(), img.getSizeY()
+    size_z, size_t, size_c = img.getSizeZ(), img.getSizeT(), img.getSizeC()
+    if xs.min() < 0 or xs.max() >= size_x or \
+            ys.min() < 0 or ys.max() >= size_y:
+        return JsonResponse(
+            {"error": "One or more points are out of bounds"})
+    for z, t in planes:
+        if z < 0 or z >= size_z or t < 0 or t >= size_t:
+            return JsonResponse(
+                {"error": "One or more planes are out of bounds"})
+    for c in channels:
+        if c < 0 or c >= size_c:
+            return JsonResponse(
+                {"error": "One or more channels are out of bounds"})
+
+    reader = None
+    try:
+        pixels_type = img.getPixelsType()
+        reader = PixelsReader(
+            conn, img.getPixelsId(), pixels_type, size_x, size_y)
+
+        # per plane and channel the reader fetches only the blocks
+        # containing the points, each of them once
+        data = [
+            [reader.read_points(z, c, t, xs, ys).tolist() for c in channels]
+            for z, t in planes]
+        return JsonResponse({
+            'points': numpy.column_stack((xs, ys)).tolist(),
+            'planes': planes,
+            'channels': channels,
+            'dtype': pixels_type,
+            'data': data
+        })
+    except Exception as pixel_service_exception:
+        return JsonResponse({"error": repr(pixel_service_exception)})
+    finally:
+        if reader is not None:
+            reader.close()
+
+
+@instrumented
+@login_required()
+def line_profile(request, conn=None, **kwargs):
+    """
+    Returns the intensities along a line or polyline, sampled at sub-pixel
+    spacing (bilinearly interpolated) and averaged over the given width
+    (perpendicular to the line), for several planes and channels.
+    Expects a json body of the form:
+    {"image": 1, "c": [0, 1], "planes": [[z, t], ...],
+     "polyline": [[x, y], ...] or "shape": line/polyline shape id,
+     "spacing": 1, "width": 1}
+    The intensities are returned as data[plane][channel][sample]
+    """
+    if not request.method == 'POST':
+        return JsonResponse({"error": "Use HTTP POST to send data!"})
+
+    try:
+        query = json.loads(request.body)
+    except Exception as e:
+        return JsonResponse({"error": "Failed to load json: " + repr(e)})
+
+    # retrieve image object
+    image_id = query.get('image', None)
+    if image_id is None:
+        return JsonResponse({"error": "No image id provided!"})
+    img = get_image_descriptor(conn, image_id)
+    if img is None:
+        return JsonResponse({"error": "Image not Found"}, status=404)
 
+    # convert input params
+    try:
+        channels = [int(c) for c in query.get('c', [])]
+        planes = [[int(p[0]), int(p[1])] for p in query.get('planes', [])]
+        spacing = float(query.get('spacing', 1))
+        width = int(query.get('width', 1))
+        polyline = query.get('polyline', None)
+        shape_id = query.get('shape', None)
+        if polyline is None and shape_id is not None:
+            polyline = get_line_shape_points(conn, long(shape_id), img)
+        polyline = numpy.asarray(
+            polyline, dtype=numpy.float64).reshape(-1, 2)
+    except Exception:
+        return JsonResponse({"error": "Invalid Parameter types"})
+    if len(channels) == 0 or len(planes) == 0 or len(polyline) == 0:
+        return JsonResponse(
+            {"error": "Please supply a polyline (or line shape), planes " +
+                "and channels"})
+    if not numpy.isfinite(spacing) or spacing <= 0 or width < 1 or \
+            width > MAX_LINE_PROFILE_WIDTH:
+        return JsonResponse(
+            {"error": "spacing has to be positive, width between 1 and " +
+                str(MAX_LINE_PROFILE_WIDTH)})
+    if not numpy.isfinite(polyline).all():
+        return JsonResponse({"error": "The line is out of bounds"})
+    # the limit is checked before the samples are taken
+    samples = count_polyline_samples(polyline, spacing) * width
+    if samples * len(planes) * len(channels) > MAX_INTENSITY_SAMPLES:
+        return JsonResponse(
+            {"error": "Too many intensities requested (max: " +
+                str(MAX_INTENSITY_SAMPLES) + ")"})
+    xs, ys, distances = sample_line_profile(polyline, spacing, width)
 
+    # bound checks (the parallels of wide profiles are clamped)
+    size_x, size_y = img.getSizeX(), img.getSizeY()
+    size_z, size_t, size_c = img.getSizeZ(), img.getSizeT(), img.getSizeC()
+    if polyline[:, 0].min() < 0 or polyline[:, 0].max() > size_x or \
+            polyline[:, 1].min() < 0 or polyline[:, 1].max() > size_y:
+        return JsonResponse(
+            {"error": "The line is out of bounds"})
+    for z, t in planes:
+        if z < 0 or z >= size_z or t < 0 or t >= size_t:
+            return JsonResponse(
+                {"error": "One or more planes are out of bounds"})
+    for c in channels:
+        if c < 0 or c >= size_c:
+            return JsonResponse(
+                {"error": "One or more channels are out of bounds"})
+
+    reader = None
+    try:
+        pixels_type = img.getPixelsType()
+        reader = PixelsReader(
+            conn, img.getPixelsId(), pixels_type, size_x, size_y)
+
+        # per plane and channel the reader fetches only the blocks
+        # the line (and its parallels) pass through
+        data = [
+            [reader.read_interpolated(z, c, t, xs, ys).mean(axis=0).tolist()
+             for c in channels]
+            for z, t in planes]
+        center = (width - 1) // 2
+        return JsonResponse({
+            'points': numpy.column_stack(
+                (xs[center], ys[center])).tolist(),
+            'distances': distances.tolist(),
+            'width': width,
+            'planes': planes,
+            'channels': channels,
+            'data': data
+        })
+    except Exception as pixel_service_exception:
+        return JsonResponse({"error": repr(pixel_service_exception)})
+    finally:
+        if reader is not None:
+            reader.close()
+
+
+def get_line_shape_points(conn, shape_id, img):
+    """
+    Returns the points of the given line or polyline shape of img
+    """
+    params = ParametersI()
+    params.addId(shape_id)
+    params.add('image_id', rlong(img.getId()))
+    shape = conn.getQueryService().findByQuery(
+        "select s from Shape s where s.id = :id " +
+        "and s.roi.image.id = :image_id", params, conn.SERVICE_OPTS)
+    geometry = get_shape_geometry(shape) if shape is not None else None
+    if geometry is None or geometry['type'] not in ['Line', 'Polyline']:
+        raise ValueError("Not a line or polyline of the image")
+    return geometry['points']
+
+
+@instrumented
 @login_required()
+def histograms(request, image_id, conn=None, **kwargs):
+    """
+    Returns the histograms of several channels (c, all if omitted) of the
+    plane z/t. The number of bins defaults to 256, the range of each
+    histogram is either the channel's window (range=window, the default),
+    the range of the plane's data (range=data) or given explicitly
+    (range=min:max). Planes with more pixels than samples (which defaults
+    to and must not exceed the configured maximum) are subsampled
+    """
+    img = get_image_descriptor(conn, image_id)
+    if img is None:
+        return JsonResponse({"error": "Image not Found"}, status=404)
+
+    # convert input params
+    try:
+        z = int(request.GET.get("z", 0))
+        t = int(request.GET.get("t", 0))
+        cs = request.GET.get("c", None)
+        channels = range(img.getSizeC()) if cs is None else \
+            [int(c) for c in cs.split(',') if c != '']
+        bins = int(request.GET.get("bins", 256))
+        samples = int(request.GET.get(
+            "samples", iviewer_settings.HISTOGRAM_MAX_SAMPLES))
+        value_range = request.GET.get("range", "window")
+        if value_range not in ['window', 'data']:
+            value_range = tuple(
+                [float(v) for v in value_range.split(':', 1)])
+            if len(value_range) != 2 or value_range[0] > value_range[1]:
+                raise ValueError("Invalid range")
+    except Exception:
+        return JsonResponse({"error": "Invalid Parameter types"})
+
+    # bound checks
+    if z < 0 or z >= img.getSizeZ() or t < 0 or t >= img.getSizeT():
+        return JsonResponse({"error": "z/t are out of bounds"})
+    if len(channels) == 0 or min(channels) < 0 or \
+            max(channels) >= img.getSizeC():
+        return JsonResponse(
+            {"error": "One or more channels are out of bounds"})
+    if bins < 1 or bins > MAX_HISTOGRAM_BINS:
+        return JsonResponse(
+            {"error": "bins has to be between 1 and " +
+                str(MAX_HISTOGRAM_BINS)})
+    if samples < 1 or samples > iviewer_settings.HISTOGRAM_MAX_SAMPLES:
+        return JsonResponse(
+            {"error": "samples has to be between 1 and " +
+                str(iviewer_settings.HISTOGRAM_MAX_SAMPLES)})
+
+    reader = None
+    try:
+        # the windows are only looked up for histograms that aren't cached
+        if value_range == 'data':
+            value_range = None
+        ranges = [(c, value_range) for c in channels]
+
+        pixels_type = img.getPixelsType()
+        reader = PixelsReader(
+            conn, img.getPixelsId(), pixels_type,
+            img.getSizeX(), img.getSizeY())
+        return JsonResponse({
+            'image': img.getId(),
+            'z': z,
+            't': t,
+            'bins': bins,
+            'data': get_histograms(conn, reader, z, t, ranges, bins, samples)
+        })
+    except Exception as histogram_exception:
+        return JsonResponse({"error": repr(histogram_exception)})
+    finally:
+        if reader is not None:
+            reader.close()
+
+
+@instrumented
+@login_required(doConnectionCleanup=False)
 def shape_stats(request, conn=None, **kwargs):
+    rsp = None
+    try:
+        rsp = get_shape_stats_response(request, conn)
+        return rsp
+    finally:
+        # a streamed response closes the connection once it's consumed
+        if not isinstance(rsp, ConnCleaningHttpResponse):
+            conn.close(hard=False)
+
+
+def get_shape_stats_response(request, conn):
+    """
+    Returns the response of shape_stats, i.e. the statistics of the
+    given shapes for planes z/t.
+    z and t can be single indices, ranges (e.g. 0-9) or comma separated
+    lists of both. For a single plane a dictionary of shape id to a list
+    of per channel statistics is returned, for several planes a compact
+    array indexed by [shape][plane][channel] whose entries are lists of
+    the statistics fields. With stream=true the planes are sent one
+    JSON object per line as soon as they're computed
+    """
     # check for mandatory parameters
     ids = request.GET.get("ids", None)
     z = request.GET.get("z", None)
@@ -544,39 +2160,187 @@ def shape_stats(request, conn=None, **kwargs):
             long(id.split(':')[1]) if ':' in id else long(id)
             for id in ids.split(',') if id != ''
         ]
-        z, t = int(z), int(t)
+        zs, ts = parse_indices(z), parse_indices(t)
         # optional cs
         cs = request.GET.get("cs", None)
         if cs is not None:
             channels = [int(c) for c in cs.split(',') if c != '']
     except Exception:
         return JsonResponse({"error": "Invalid Parameter types"})
-
+    if len(zs) * len(ts) > MAX_SHAPE_STATS_PLANES:
+        return JsonResponse({
+            "error": "The number of planes must not exceed " +
+            str(MAX_SHAPE_STATS_PLANES)})
+    stream = request.GET.get("stream", "false").lower() == "true"
+
+    # the engine computing the statistics: server or local (numpy)
+    engine = request.GET.get("engine", iviewer_settings.SHAPE_STATS_ENGINE)
+    if engine not in ['server', 'local']:
+        return JsonResponse({"error": "Engine has to be server or local"})
+
+    def compute_on_server(ids, z, t, channels):
+        return compute_shape_stats(conn, ids, z, t, channels)
+
+    local_stats = None
+    compute = compute_on_server
+    if engine == 'local':
+        # shared across planes, keeping the loaded shapes and tiles
+        local_stats = LocalShapeStats(conn, compute_on_server)
+        compute = local_stats.compute
+
+    # planes are iterated t first, z second
+    planes = [[plane_z, plane_t] for plane_t in ts for plane_z in zs]
+    streaming = False
     try:
-        # call rois service restricted stats method
-        # populating our own return objects for convenience
-        rois_service = conn.getRoiService()
-        stats = rois_service.getShapeStatsRestricted(ids, z, t, channels)
-        ret = {}
-        for stat in stats:
-            ret_stat = []
-            number_of_channels = len(stat.channelIds)
-            i = 0
-            while i < number_of_channels:
-                ret_stat_chan = {
-                    "index": stat.channelIds[i],
-                    "points": stat.pointsCount[i],
-                    "min": stat.min[i],
-                    "max": stat.max[i],
-                    "sum": stat.sum[i],
-                    "mean": stat.mean[i],
-                    "std_dev": stat.stdDev[i]
-                }
-                ret_stat.append(ret_stat_chan)
-                i += 1
-            ret[str(stat.shapeId)] = ret_stat
-        return JsonResponse(ret,)
+        # cached statistics are returned right away,
+        # the missing ones are computed by the chosen engine
+        if len(planes) == 1 and not stream:
+            ret = get_shape_stats(
+                conn, ids, planes[0][0], planes[0][1], channels, compute)
+            return JsonResponse(ret,)
+
+        versions = get_shape_versions(conn, ids)
+        header = {"shapes": ids, "planes": planes,
+                  "fields": SHAPE_STATS_FIELDS}
+        if stream:
+            # the stream closes the local engine once it's consumed
+            rsp = ConnCleaningHttpResponse(
+                stream_shape_stats(
+                    conn, ids, planes, channels, compute, versions,
+                    header, local_stats),
+                content_type='application/x-ndjson')
+            rsp.conn = conn
+            streaming = True
+            return rsp
+
+        ret = dict(header)
+        ret["channels"] = [None] * len(ids)
+        ret["stats"] = [[] for id in ids]
+        for plane_z, plane_t in planes:
+            stats = get_shape_stats(
+                conn, ids, plane_z, plane_t, channels, compute, versions)
+            for i, plane_stats in enumerate(
+                    stats_as_compact(ids, stats, ret["channels"])):
+                ret["stats"][i].append(plane_stats)
+        return JsonResponse(ret)
     except omero.ApiUsageException as api_exception:
         return JsonResponse({"error": api_exception.message})
     except Exception as stats_call_exception:
         return JsonResponse({"error": repr(stats_call_exception)})
+    finally:
+        if local_stats is not None and not streaming:
+            local_stats.close()
+
+
+def stream_shape_stats(conn, ids, planes, channels, compute, versions,
+                       header, local_stats=None):
+    """
+    Generates the shape statistics as lines of JSON: the header first,
+    then one object per plane with its compact statistics indexed by
+    [shape][channel] (and the shapes' channels). An error ends the stream
+    with an object containing the error
+    """
+    try:
+        yield json.dumps(header) + "\n"
+        shape_channels = [None] * len(ids)
+        for plane_z, plane_t in planes:
+            stats = get_shape_stats(
+                conn, ids, plane_z, plane_t, channels, compute, versions)
+            yield json.dumps({
+                "plane": [plane_z, plane_t],
+                "stats": stats_as_compact(ids, stats, shape_channels),
+                "channels": shape_channels}) + "\n"
+    except omero.ApiUsageException as api_exception:
+        yield json.dumps({"error": api_exception.message}) + "\n"
+    except Exception as stats_call_exception:
+        yield json.dumps({"error": repr(stats_call_exception)}) + "\n"
+    finally:
+        if local_stats is not None:
+            local_stats.close()
+
+
+def stats_as_compact(ids, stats, shape_channels):
+    """
+    Turns the statistics of one plane (see get_shape_stats) into a list
+    (ordered like ids) of per channel lists of the SHAPE_STATS_FIELDS.
+    The channel indices of each shape are recorded in shape_channels
+    (shapes without statistics have an empty list)
+    """
+    ret = []
+    for i, shape_id in enumerate(ids):
+        shape_stats = stats.get(str(shape_id), [])
+        if shape_channels[i] is None and len(shape_stats) > 0:
+            shape_channels[i] = [stat['index'] for stat in shape_stats]
+        ret.append([
+            [stat[field] for field in SHAPE_STATS_FIELDS]
+            for stat in shape_stats])
+    return ret
+
+
+def parse_indices(value):
+    """
+    Parses a comma separated list of indices and (inclusive) ranges,
+    e.g. 0,2,4-6 into a list of distinct indices (keeping their order)
+    """
+    ret = []
+    seen = set()
+    for part in value.split(','):
+        part = part.strip()
+        if part == '':
+            continue
+        if '-' in part:
+            start, end = [int(index) for index in part.split('-', 1)]
+            if end < start or \
+                    len(ret) + end - start >= MAX_SHAPE_STATS_PLANES:
+                raise ValueError("Invalid range: " + part)
+            indices = range(start, end + 1)
+        else:
+            indices = [int(part)]
+        for index in indices:
+            if index not in seen:
+                seen.add(index)
+                ret.append(index)
+    if len(ret) == 0:
+        raise ValueError("No indices given")
+    return ret
+
+
+def compute_shape_stats(conn, ids, z, t, channels):
+    """
+    Calls the rois service restricted stats method
+    populating our own return objects for convenience
+    """
+    rois_service = conn.getRoiService()
+    with phase('shape_stats'):
+        stats = rois_service.getShapeStatsRestricted(ids, z, t, channels)
+    ret = {}
+    for stat in stats:
+        ret_stat = []
+        number_of_channels = len(stat.channelIds)
+        i = 0
+        while i < number_of_channels:
+            ret_stat_chan = {
+                "index": stat.channelIds[i],
+                "points": stat.pointsCount[i],
+                "min": stat.min[i],
+                "max": stat.max[i],
+                "sum": stat.sum[i],
+                "mean": stat.mean[i],
+                "std_dev": stat.stdDev[i]
+            }
+            ret_stat.append(ret_stat_chan)
+            i += 1
+        ret[str(stat.shapeId)] = ret_stat
+    return ret
+
+
+@instrumented
+def metrics(request, **kwargs):
+    """
+    Exports the request metrics and cache stats in the Prometheus text
+    format (if enabled, see omero.web.iviewer.metrics_enabled)
+    """
+    if not iviewer_settings.METRICS_ENABLED:
+        return HttpResponse("Metrics are disabled", status=404)
+    return HttpResponse(
+        METRICS.render(), content_type='text/plain; version=0.0.4')
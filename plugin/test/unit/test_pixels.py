@@ -0,0 +1,287 @@
+#
+# Copyright (c) 2017 University of Dundee.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Tests of the PixelsReader against a fake pixel source
+"""
+
+from uuid import uuid4
+
+import numpy
+import pytest
+
+from omero_iviewer.pixels import PixelsReader, RAW_PIXELS_STORE_POOL, \
+    TILE_CACHE
+
+
+SIZE_X = 100
+SIZE_Y = 70
+BLOCK_SIZE = 32
+
+
+class FakeRawPixelsStore(object):
+
+    """
+    Serves the tiles of one (uint16) plane, recording the getTile and
+    setResolutionLevel calls. A stale store fails every call
+    """
+
+    def __init__(self, plane):
+        self.plane = plane
+        self.tiles = []
+        self.levels = []
+        self.stale = False
+
+    def check(self):
+        if self.stale:
+            raise Exception("stale store")
+
+    def setPixelsId(self, pixels_id, bypass):
+        pass
+
+    def getResolutionDescriptions(self):
+        self.check()
+        return [FakeResolutionDescription(SIZE_X, SIZE_Y),
+                FakeResolutionDescription(SIZE_X // 2, SIZE_Y // 2)]
+
+    def setResolutionLevel(self, level):
+        self.check()
+        self.levels.append(level)
+
+    def getTile(self, z, c, t, x, y, width, height):
+        self.check()
+        self.tiles.append((x, y, width, height))
+        return self.plane[y:y + height, x:x + width].astype('>u2').tobytes()
+
+    def close(self):
+        pass
+
+
+class FakeResolutionDescription(object):
+
+    def __init__(self, size_x, size_y):
+        self.sizeX = size_x
+        self.sizeY = size_y
+
+
+class FakeServiceOpts(object):
+
+    def getOmeroGroup(self):
+        return 1
+
+
+class FakeClient(object):
+
+    def __init__(self, session_id):
+        self.session_id = session_id
+
+    def getSessionId(self):
+        return self.session_id
+
+
+class FakeConnection(object):
+
+    """
+    Has a session of its own, so that cached blocks and pooled stores
+    aren't shared between tests
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.c = FakeClient(uuid4().hex)
+        self.SERVICE_OPTS = FakeServiceOpts()
+        self.clones = []
+
+    def getUserId(self):
+        return 1
+
+    def createRawPixelsStore(self):
+        return self.store
+
+
+class FakeClonedConnection(object):
+
+    """
+    Stands in for the connection the store pool clones from conn
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.closed = False
+        conn.clones.append(self)
+
+    def createRawPixelsStore(self):
+        assert not self.closed
+        return self.conn.createRawPixelsStore()
+
+    def close(self, hard=True):
+        self.closed = True
+
+
+@pytest.fixture(autouse=True)
+def clone_connection(monkeypatch):
+    monkeypatch.setattr(RAW_PIXELS_STORE_POOL, 'connect', FakeClonedConnection)
+
+
+@pytest.fixture
+def plane():
+    return numpy.arange(SIZE_X * SIZE_Y, dtype=numpy.uint16).reshape(
+        SIZE_Y, SIZE_X)
+
+
+@pytest.fixture
+def store(plane):
+    return FakeRawPixelsStore(plane)
+
+
+@pytest.fixture
+def reader(store):
+    reader = PixelsReader(FakeConnection(store), 1, 'uint16',
+                          SIZE_X, SIZE_Y, block_size=BLOCK_SIZE)
+    yield reader
+    reader.close()
+
+
+@pytest.mark.parametrize('region', [
+    (0, 0, 1, 1),
+    (5, 7, 10, 3),
+    (30, 30, 5, 5),
+    (0, 0, SIZE_X, SIZE_Y),
+    (31, 31, 34, 34),
+])
+def test_read(reader, plane, region):
+    x, y, width, height = region
+    assert numpy.array_equal(
+        reader.read(0, 0, 0, x, y, width, height),
+        plane[y:y + height, x:x + width])
+
+
+def test_adjacent_blocks_are_fetched_aligned_with_one_call(reader, store):
+    reader.read(0, 0, 0, 20, 20, 20, 20)
+    assert store.tiles == [(0, 0, 2 * BLOCK_SIZE, 2 * BLOCK_SIZE)]
+
+
+def test_edge_blocks(reader, store, plane):
+    # the last column and row of blocks are cut off by the image
+    region = reader.read(0, 0, 0, SIZE_X - 3, SIZE_Y - 2, 3, 2)
+    assert numpy.array_equal(region, plane[-2:, -3:])
+    assert store.tiles == [(96, 64, SIZE_X - 96, SIZE_Y - 64)]
+    block = TILE_CACHE.get(reader.get_block_key(0, 0, 0, 3, 2))
+    assert block.shape == (SIZE_Y - 64, SIZE_X - 96)
+
+
+def test_cache_hits(reader, store, plane):
+    reader.read(0, 0, 0, 10, 10, 40, 40)
+    tiles = list(store.tiles)
+    # the same and any region within the same blocks are served cached
+    reader.read(0, 0, 0, 10, 10, 40, 40)
+    region = reader.read(0, 0, 0, 0, 0, 2 * BLOCK_SIZE, 2 * BLOCK_SIZE)
+    assert store.tiles == tiles
+    assert numpy.array_equal(
+        region, plane[:2 * BLOCK_SIZE, :2 * BLOCK_SIZE])
+    # other planes/channels aren't
+    reader.read(0, 1, 0, 10, 10, 1, 1)
+    assert len(store.tiles) == len(tiles) + 1
+
+
+def test_scattered_blocks_are_fetched_one_by_one(reader, store, plane):
+    xs = numpy.array([1, SIZE_X - 1])
+    ys = numpy.array([1, SIZE_Y - 1])
+    assert numpy.array_equal(
+        reader.read_points(0, 0, 0, xs, ys), plane[ys, xs])
+    assert sorted(store.tiles) == [
+        (0, 0, BLOCK_SIZE, BLOCK_SIZE),
+        (96, 64, SIZE_X - 96, SIZE_Y - 64)]
+
+
+def test_uncached_reader_bypasses_cache(store, plane):
+    conn = FakeConnection(store)
+    reader = PixelsReader(conn, 1, 'uint16', SIZE_X, SIZE_Y,
+                          block_size=BLOCK_SIZE, cache=False)
+    blocks = reader.get_blocks(0, 0, 0, [(0, 0), (1, 0)])
+    assert numpy.array_equal(blocks[(1, 0)], plane[:32, 32:64])
+    reader.get_blocks(0, 0, 0, [(0, 0), (1, 0)])
+    reader.close()
+    assert len(store.tiles) == 2
+    assert TILE_CACHE.get(reader.get_block_key(0, 0, 0, 0, 0)) is None
+
+
+def test_stale_pooled_store_is_replaced(store, plane):
+    conn = FakeConnection(store)
+    reader = PixelsReader(conn, 1, 'uint16', SIZE_X, SIZE_Y, cache=False)
+    reader.read(0, 0, 0, 0, 0, 1, 1)
+    reader.close()
+    # the pooled store has gone stale, the next one works
+    store.stale = True
+    conn.store = FakeRawPixelsStore(plane)
+    reader = PixelsReader(conn, 1, 'uint16', SIZE_X, SIZE_Y, cache=False)
+    assert numpy.array_equal(
+        reader.read(0, 0, 0, 5, 5, 2, 2), plane[5:7, 5:7])
+    reader.close()
+    assert conn.store.tiles == [(5, 5, 2, 2)]
+
+
+def test_stale_pooled_store_failing_resolution_is_replaced(store, plane):
+    conn = FakeConnection(store)
+    reader = PixelsReader(conn, 1, 'uint16', SIZE_X, SIZE_Y, cache=False)
+    reader.get_resolutions()
+    reader.close()
+    store.stale = True
+    conn.store = FakeRawPixelsStore(plane)
+    reader = PixelsReader(conn, 1, 'uint16', SIZE_X, SIZE_Y, cache=False)
+    reader.set_resolution(1)
+    reader.read(0, 0, 0, 0, 0, 2, 2)
+    assert conn.store.levels == [0]
+    assert conn.store.tiles == [(0, 0, 2, 2)]
+    reader.close()
+
+
+def test_failing_new_store_is_not_retried(store):
+    conn = FakeConnection(store)
+    store.stale = True
+    reader = PixelsReader(conn, 1, 'uint16', SIZE_X, SIZE_Y, cache=False)
+    with pytest.raises(Exception):
+        reader.read(0, 0, 0, 0, 0, 1, 1)
+    assert reader.raw_pixels_store is None
+
+
+def test_pooled_stores_live_on_a_connection_of_their_own(store, plane):
+    conn = FakeConnection(store)
+    reader = PixelsReader(conn, 1, 'uint16', SIZE_X, SIZE_Y, cache=False)
+    reader.read(0, 0, 0, 0, 0, 1, 1)
+    reader.close()
+    # the pooled store is reused, the pool's connection isn't closed
+    # while it's open
+    reader = PixelsReader(conn, 1, 'uint16', SIZE_X, SIZE_Y, cache=False)
+    reader.read(0, 0, 0, 0, 0, 1, 1)
+    assert reader.reused
+    reader.close()
+    assert len(conn.clones) == 1
+    assert not conn.clones[0].closed
+    # and closed along with the scope's last store
+    RAW_PIXELS_STORE_POOL.stores.invalidate(
+        lambda key: key[1] == conn.c.getSessionId())
+    assert conn.clones[0].closed
+
+
+def test_discarded_store_closes_the_pools_connection(store):
+    conn = FakeConnection(store)
+    store.stale = True
+    reader = PixelsReader(conn, 1, 'uint16', SIZE_X, SIZE_Y, cache=False)
+    with pytest.raises(Exception):
+        reader.read(0, 0, 0, 0, 0, 1, 1)
+    assert [clone.closed for clone in conn.clones] == [True]
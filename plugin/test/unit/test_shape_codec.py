@@ -0,0 +1,198 @@
+#
+# Copyright (c) 2017 University of Dundee.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Tests of the binary shapes encoding
+"""
+
+import json
+import struct
+import zlib
+
+import numpy
+import pytest
+
+from omero_iviewer import shape_codec
+from omero_iviewer.shapes import parse_points
+
+
+SCHEMA = 'http://www.openmicroscopy.org/Schemas/OME/2016-06#'
+
+
+def shape(shape_type, **kwargs):
+    kwargs['@type'] = SCHEMA + shape_type
+    kwargs['StrokeColor'] = -16776961
+    return kwargs
+
+
+def document(*shapes):
+    return {'imageId': 1, 'rois': [
+        {'@type': SCHEMA + 'ROI', '@id': 2, 'shapes': list(shapes)}]}
+
+
+def assert_same(decoded, expected):
+    """
+    Compares documents, points strings by their coordinates
+    (they are formatted as floats)
+    """
+    if isinstance(expected, dict):
+        assert sorted(decoded.keys()) == sorted(expected.keys())
+        for key, value in expected.items():
+            if key == 'Points' and shape_codec.PLAIN_POINTS.match(value):
+                assert numpy.allclose(
+                    parse_points(decoded[key]), parse_points(value),
+                    rtol=0, atol=1e-9)
+            else:
+                assert_same(decoded[key], value)
+    elif isinstance(expected, list):
+        assert len(decoded) == len(expected)
+        for decoded_value, value in zip(decoded, expected):
+            assert_same(decoded_value, value)
+    elif isinstance(expected, float):
+        assert abs(decoded - expected) < 1e-9
+    else:
+        assert decoded == expected
+
+
+def get_header(data):
+    body = data[len(shape_codec.MAGIC) + 1:]
+    header_length = struct.unpack('<I', body[:4])[0]
+    return json.loads(body[4:4 + header_length].decode('utf-8'))
+
+
+def build(header, values=b''):
+    """
+    Returns encoded shapes with the given header and values
+    """
+    header = json.dumps(header).encode('utf-8')
+    return shape_codec.MAGIC + struct.pack('<B', 0) + \
+        struct.pack('<I', len(header)) + header + values
+
+
+ALL_TYPES = document(
+    shape('Rectangle', X=10, Y=20, Width=30, Height=40),
+    shape('Mask', X=0, Y=0, Width=5, Height=5),
+    shape('Ellipse', X=50, Y=60, RadiusX=5, RadiusY=7),
+    shape('Line', X1=1, Y1=2, X2=300, Y2=400),
+    shape('Point', X=7, Y=8, TheZ=1),
+    shape('Label', X=9, Y=10, Text='label'),
+    shape('Polygon', Points='1,2 3,4 5,6'),
+    shape('Polyline', Points='100,200 -100,-200'))
+
+
+@pytest.mark.parametrize('compress', [False, True])
+@pytest.mark.parametrize('doc, dtype, scale', [
+    (ALL_TYPES, '<i2', 1),
+    (document(shape('Point', X=0.5, Y=1.25)), '<i1', 100),
+    (document(shape('Rectangle', X=1e6, Y=2e6, Width=1, Height=1)),
+     '<i4', 1),
+    (document(shape('Polygon', Points='0.1,0.2 3.14159265358979,2')),
+     '<f8', 0),
+])
+def test_round_trip(doc, dtype, scale, compress):
+    header = get_header(shape_codec.encode(doc))
+    assert (header['dtype'], header['scale']) == (dtype, scale)
+    data = shape_codec.encode(doc, compress=compress)
+    assert_same(shape_codec.decode(data), doc)
+
+
+def test_compressed_flag():
+    data = shape_codec.encode(ALL_TYPES, compress=True)
+    offset = len(shape_codec.MAGIC)
+    flags = struct.unpack('<B', data[offset:offset + 1])[0]
+    assert flags & shape_codec.FLAG_COMPRESSED
+
+
+@pytest.mark.parametrize('points', [
+    # the format of old OMERO versions
+    'points[1,2 3,4] points1[1,2 3,4] points2[1,2 3,4]',
+    '1,2 3,4 5',
+])
+def test_non_plain_or_odd_points_are_kept(points):
+    doc = document(shape('Polygon', Points=points))
+    decoded = shape_codec.decode(shape_codec.encode(doc))
+    assert decoded['rois'][0]['shapes'][0]['Points'] == points
+
+
+def test_incomplete_geometry_is_kept():
+    doc = document(shape('Rectangle', X=1, Y=2, Width=None, Height=True))
+    data = shape_codec.encode(doc)
+    assert shape_codec.GEOMETRY not in json.dumps(get_header(data))
+    assert shape_codec.decode(data) == doc
+
+
+def test_size_limit():
+    doc = document(*[shape('Point', X=i, Y=i) for i in range(1000)])
+    data = shape_codec.encode(doc, compress=True)
+    assert_same(shape_codec.decode(data), doc)
+    with pytest.raises(ValueError):
+        shape_codec.decode(data, max_size=1000)
+
+
+@pytest.mark.parametrize('data', [
+    b'',
+    b'IVS0\x00',
+    shape_codec.MAGIC,
+    shape_codec.MAGIC + b'\x00\x01',
+    shape_codec.MAGIC + b'\x00' + struct.pack('<I', 100) + b'{}',
+    shape_codec.MAGIC + b'\x01' + b'not compressed',
+])
+def test_invalid_data(data):
+    with pytest.raises((ValueError, zlib.error)):
+        shape_codec.decode(data)
+
+
+@pytest.mark.parametrize('dtype, scale', [
+    ('<u8', 1),
+    ('object', 1),
+    ('<i2', 0),
+    ('<i2', 7),
+    ('<f8', 1),
+])
+def test_invalid_dtype_or_scale(dtype, scale):
+    data = build(
+        {'dtype': dtype, 'scale': scale, 'document': {}}, b'\x00' * 8)
+    with pytest.raises(ValueError):
+        shape_codec.decode(data)
+
+
+@pytest.mark.parametrize('geometry', [
+    [0, 4, 1],
+    [0, '4'],
+    [-1, 4],
+    [0, 5],
+    [2, 4],
+    [0, 2],
+])
+def test_invalid_geometry(geometry):
+    rectangle = shape('Rectangle')
+    rectangle[shape_codec.GEOMETRY] = geometry
+    values = numpy.arange(4, dtype='<i1').tobytes()
+    data = build({'dtype': '<i1', 'scale': 1,
+                  'document': document(rectangle)}, values)
+    with pytest.raises(ValueError):
+        shape_codec.decode(data)
+
+
+def test_odd_points_geometry():
+    polygon = shape('Polygon')
+    polygon[shape_codec.GEOMETRY] = [0, 3]
+    values = numpy.arange(4, dtype='<i1').tobytes()
+    data = build({'dtype': '<i1', 'scale': 1,
+                  'document': document(polygon)}, values)
+    with pytest.raises(ValueError):
+        shape_codec.decode(data)
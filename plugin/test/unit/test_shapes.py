@@ -0,0 +1,152 @@
+#
+# Copyright (c) 2017 University of Dundee.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Tests of the rasterization of shape geometries
+"""
+
+import numpy
+import pytest
+
+from omero_iviewer.shapes import rasterize
+
+
+SIZE_X = 20
+SIZE_Y = 15
+
+
+def pixels(raster):
+    """
+    Returns the set of pixels (x, y) of the output of rasterize
+    """
+    if raster is None:
+        return set()
+    min_x, min_y, mask = raster
+    ys, xs = numpy.nonzero(mask)
+    return set(zip((xs + min_x).tolist(), (ys + min_y).tolist()))
+
+
+def image_pixels(inside):
+    """
+    Returns the set of pixels (x, y) of the image for which
+    inside(xs, ys) (applied to the coordinate arrays) is true
+    """
+    ys, xs = numpy.mgrid[0:SIZE_Y, 0:SIZE_X]
+    selected = inside(xs, ys)
+    return set(zip(xs[selected].tolist(), ys[selected].tolist()))
+
+
+def rectangle(x, y, width, height):
+    return {'type': 'Rectangle', 'x': x, 'y': y,
+            'width': width, 'height': height}
+
+
+def ellipse(x, y, radius_x, radius_y):
+    return {'type': 'Ellipse', 'x': x, 'y': y,
+            'radiusX': radius_x, 'radiusY': radius_y}
+
+
+def polygon(shape_type, *points):
+    return {'type': shape_type,
+            'points': numpy.array(points, dtype=numpy.float64)}
+
+
+def test_rectangle():
+    raster = rasterize(rectangle(2, 3, 4, 2), SIZE_X, SIZE_Y)
+    assert raster[:2] == (2, 3)
+    assert pixels(raster) == image_pixels(
+        lambda xs, ys: (xs >= 2) & (xs < 6) & (ys >= 3) & (ys < 5))
+
+
+def test_rectangle_with_fractional_coordinates():
+    # only the pixels whose coordinates lie within it
+    assert pixels(rasterize(rectangle(1.5, 2.5, 2, 1), SIZE_X, SIZE_Y)) == \
+        set([(2, 3), (3, 3)])
+
+
+def test_ellipse():
+    assert pixels(rasterize(ellipse(10, 7, 4, 3), SIZE_X, SIZE_Y)) == \
+        image_pixels(lambda xs, ys:
+                     ((xs - 10) / 4.0) ** 2 + ((ys - 7) / 3.0) ** 2 <= 1)
+
+
+def test_polygon():
+    triangle = polygon('Polygon', [0, 0], [10, 0], [0, 10])
+    assert pixels(rasterize(triangle, SIZE_X, SIZE_Y)) == \
+        image_pixels(lambda xs, ys: xs + ys < 10)
+
+
+def test_concave_polygon():
+    # a U whose gap (x 3 to 6, y 3 to 8) isn't part of it
+    u = polygon('Polygon', [0, 0], [9, 0], [9, 9], [6, 9], [6, 3],
+                [3, 3], [3, 9], [0, 9])
+    assert pixels(rasterize(u, SIZE_X, SIZE_Y)) == image_pixels(
+        lambda xs, ys: (xs < 9) & (ys < 9) &
+        ~((xs >= 3) & (xs < 6) & (ys >= 3)))
+
+
+def test_line():
+    line = polygon('Line', [0, 5], [9, 5])
+    assert pixels(rasterize(line, SIZE_X, SIZE_Y)) == \
+        set([(x, 5) for x in range(10)])
+
+
+def test_polyline():
+    polyline = polygon('Polyline', [0, 0], [4, 0], [4, 4])
+    assert pixels(rasterize(polyline, SIZE_X, SIZE_Y)) == \
+        set([(x, 0) for x in range(5)] + [(4, y) for y in range(5)])
+
+
+def test_point():
+    point = {'type': 'Point', 'x': 3.7, 'y': 2.2}
+    assert rasterize(point, SIZE_X, SIZE_Y)[:2] == (3, 2)
+    assert pixels(rasterize(point, SIZE_X, SIZE_Y)) == set([(3, 2)])
+
+
+@pytest.mark.parametrize('geometry, inside', [
+    (rectangle(-5, -5, 10, 10), lambda xs, ys: (xs < 5) & (ys < 5)),
+    (rectangle(15, 10, 10, 10), lambda xs, ys: (xs >= 15) & (ys >= 10)),
+    (ellipse(SIZE_X, SIZE_Y, 5, 5), lambda xs, ys:
+     (xs - SIZE_X) ** 2 + (ys - SIZE_Y) ** 2 <= 25),
+    (polygon('Polygon', [-10, -10], [30, -10], [-10, 30]),
+     lambda xs, ys: xs + ys < 20),
+    (polygon('Line', [-5, 1], [5, 1]), lambda xs, ys: (xs <= 5) & (ys == 1)),
+])
+def test_clipped_at_the_image_edge(geometry, inside):
+    assert pixels(rasterize(geometry, SIZE_X, SIZE_Y)) == \
+        image_pixels(inside)
+
+
+@pytest.mark.parametrize('geometry', [
+    rectangle(SIZE_X, 0, 5, 5),
+    rectangle(-10, -10, 5, 5),
+    # between pixel coordinates
+    rectangle(1.2, 1.2, 0.5, 0.5),
+    ellipse(5, 5, 0, 3),
+    ellipse(5.5, 5.5, 0.2, 0.2),
+    polygon('Polygon', [0, 0], [5, 5]),
+    polygon('Polygon', [0.1, 0.1], [0.9, 0.1], [0.5, 0.9]),
+    polygon('Line', [-5, -1], [30, -1]),
+    {'type': 'Point', 'x': -0.5, 'y': 3},
+])
+def test_empty(geometry):
+    assert rasterize(geometry, SIZE_X, SIZE_Y) is None
+
+
+def test_unsupported():
+    with pytest.raises(ValueError):
+        rasterize({'type': 'Label'}, SIZE_X, SIZE_Y)
@@ -0,0 +1,269 @@
+#
+# Copyright (c) 2017 University of Dundee.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Tests of the (local) shape statistics and histograms against a fake reader
+"""
+
+from uuid import uuid4
+
+import numpy
+import omero.model
+import pytest
+from omero.rtypes import rdouble, rint, rlong, rstring
+
+from omero_iviewer.shapes import rasterize
+from omero_iviewer.stats import LocalShapeStats, compute_geometry_stats, \
+    get_histograms
+
+
+SIZE_X = 20
+SIZE_Y = 15
+SIZE_C = 2
+
+
+class FakeReader(object):
+
+    """
+    Reads regions of (random) planes per channel, recording the reads
+    """
+
+    def __init__(self, planes):
+        self.planes = planes
+        self.reads = []
+        self.pixels_id = 1
+        self.size_x = SIZE_X
+        self.size_y = SIZE_Y
+        self.block_size = 8
+
+    def read(self, z, c, t, x, y, width, height):
+        self.reads.append((z, c, t, x, y, width, height))
+        return self.planes[c][y:y + height, x:x + width]
+
+    def close(self):
+        pass
+
+
+class FakeQueryService(object):
+
+    """
+    Returns the StatsInfo windows of channel 0, recording the queries
+    """
+
+    def __init__(self):
+        self.queries = []
+
+    def projection(self, query, params, ctx):
+        self.queries.append(query)
+        return [[rint(0), rdouble(100), rdouble(200)]]
+
+
+class FakeServiceOpts(object):
+
+    def getOmeroGroup(self):
+        return 1
+
+
+class FakeClient(object):
+
+    def __init__(self):
+        self.session_id = uuid4().hex
+
+    def getSessionId(self):
+        return self.session_id
+
+
+class FakeConnection(object):
+
+    def __init__(self):
+        self.c = FakeClient()
+        self.SERVICE_OPTS = FakeServiceOpts()
+        self.query_service = FakeQueryService()
+
+    def getQueryService(self):
+        return self.query_service
+
+
+@pytest.fixture
+def planes():
+    random = numpy.random.RandomState(0)
+    return [random.randint(0, 1000, (SIZE_Y, SIZE_X)).astype(numpy.uint16)
+            for c in range(SIZE_C)]
+
+
+@pytest.fixture
+def reader(planes):
+    return FakeReader(planes)
+
+
+def expected_stats(values, c):
+    values = values.astype(numpy.float64)
+    return {"index": c, "points": values.size,
+            "min": values.min(), "max": values.max(),
+            "sum": values.sum(), "mean": values.mean(),
+            "std_dev": values.std()}
+
+
+def assert_stats(stats, expected):
+    assert sorted(stats.keys()) == sorted(expected.keys())
+    for key, value in expected.items():
+        assert abs(stats[key] - value) < 1e-9, key
+
+
+GEOMETRIES = [
+    {'type': 'Rectangle', 'x': 2, 'y': 3, 'width': 4, 'height': 2},
+    {'type': 'Rectangle', 'x': -5, 'y': 10, 'width': 10, 'height': 10},
+    {'type': 'Ellipse', 'x': 10, 'y': 7, 'radiusX': 4, 'radiusY': 3},
+    {'type': 'Polygon',
+     'points': numpy.array([[0, 0], [10, 0], [0, 10]], dtype=float)},
+    {'type': 'Line', 'points': numpy.array([[0, 5], [30, 5]], dtype=float)},
+    {'type': 'Polyline',
+     'points': numpy.array([[0, 0], [4, 0], [4, 4]], dtype=float)},
+    {'type': 'Point', 'x': 3.7, 'y': 2.2},
+]
+
+
+@pytest.mark.parametrize('geometry', GEOMETRIES)
+def test_compute_geometry_stats(geometry, reader, planes):
+    min_x, min_y, mask = rasterize(geometry, SIZE_X, SIZE_Y)
+    height, width = mask.shape
+    stats = compute_geometry_stats(
+        geometry, reader, 0, 0, range(SIZE_C), SIZE_X, SIZE_Y)
+    assert len(stats) == SIZE_C
+    for c in range(SIZE_C):
+        values = planes[c][min_y:min_y + height, min_x:min_x + width][mask]
+        assert_stats(stats[c], expected_stats(values, c))
+    # only the bounding box is read
+    assert reader.reads == [
+        (0, c, 0, min_x, min_y, width, height) for c in range(SIZE_C)]
+
+
+def test_compute_geometry_stats_of_rectangle(reader, planes):
+    geometry = GEOMETRIES[0]
+    stats = compute_geometry_stats(geometry, reader, 0, 0, [1],
+                                   SIZE_X, SIZE_Y)
+    assert_stats(stats[0], expected_stats(planes[1][3:5, 2:6], 1))
+
+
+@pytest.mark.parametrize('geometry', [
+    {'type': 'Rectangle', 'x': SIZE_X, 'y': 0, 'width': 5, 'height': 5},
+    {'type': 'Rectangle', 'x': 1.2, 'y': 1.2, 'width': 0.5, 'height': 0.5},
+    {'type': 'Point', 'x': -1, 'y': -1},
+])
+def test_compute_geometry_stats_of_empty_mask(geometry, reader):
+    stats = compute_geometry_stats(
+        geometry, reader, 0, 0, [0, 1], SIZE_X, SIZE_Y)
+    for c, stat in enumerate(stats):
+        assert stat == {"index": c, "points": 0, "min": 0.0, "max": 0.0,
+                        "sum": 0.0, "mean": 0.0, "std_dev": 0.0}
+    assert reader.reads == []
+
+
+def make_shapes():
+    """
+    Returns a rectangle, a point and a label of the same image
+    """
+    pixels_type = omero.model.PixelsTypeI()
+    pixels_type.setValue(rstring('uint16'))
+    pixels = omero.model.PixelsI()
+    pixels.setId(rlong(1))
+    pixels.setPixelsType(pixels_type)
+    pixels.setSizeX(rint(SIZE_X))
+    pixels.setSizeY(rint(SIZE_Y))
+    pixels.setSizeZ(rint(1))
+    pixels.setSizeC(rint(SIZE_C))
+    pixels.setSizeT(rint(1))
+    image = omero.model.ImageI()
+    image.addPixels(pixels)
+    roi = omero.model.RoiI()
+    roi.setImage(image)
+
+    rectangle = omero.model.RectangleI()
+    rectangle.setX(rdouble(2))
+    rectangle.setY(rdouble(3))
+    rectangle.setWidth(rdouble(4))
+    rectangle.setHeight(rdouble(2))
+    point = omero.model.PointI()
+    point.setX(rdouble(3.7))
+    point.setY(rdouble(2.2))
+    label = omero.model.LabelI()
+    label.setX(rdouble(1))
+    label.setY(rdouble(1))
+    shapes = {1: rectangle, 2: point, 3: label}
+    for shape in shapes.values():
+        shape.setRoi(roi)
+    return shapes
+
+
+@pytest.fixture
+def local_stats(reader):
+    fallback_calls = []
+
+    def fallback(ids, z, t, channels):
+        fallback_calls.append(ids)
+        return dict([(str(id), []) for id in ids])
+
+    # the shapes are loaded already, so no connection is needed
+    local_stats = LocalShapeStats(None, fallback)
+    local_stats.shapes = make_shapes()
+    local_stats.get_reader = lambda pixels: reader
+    local_stats.fallback_calls = fallback_calls
+    yield local_stats
+    local_stats.close()
+
+
+def test_local_shape_stats(local_stats, planes):
+    stats = local_stats.compute([1, 2, 3], 0, 0, [])
+    assert sorted(stats.keys()) == ['1', '2', '3']
+    for c in range(SIZE_C):
+        assert_stats(stats['1'][c],
+                     expected_stats(planes[c][3:5, 2:6], c))
+        assert_stats(stats['2'][c],
+                     expected_stats(planes[c][2:3, 3:4], c))
+    # labels aren't supported
+    assert stats['3'] == []
+    assert local_stats.fallback_calls == [[3]]
+
+
+def test_local_shape_stats_of_given_channels(local_stats, planes):
+    stats = local_stats.compute([1], 0, 0, [1])
+    assert len(stats['1']) == 1
+    assert_stats(stats['1'][0], expected_stats(planes[1][3:5, 2:6], 1))
+    assert local_stats.fallback_calls == []
+
+
+@pytest.mark.parametrize('z, t', [(1, 0), (0, 1), (-1, 0)])
+def test_local_shape_stats_out_of_bounds(local_stats, z, t):
+    with pytest.raises(ValueError):
+        local_stats.compute([1], z, t, [])
+
+
+def test_histograms_of_windows_are_looked_up_once(reader, planes):
+    conn = FakeConnection()
+    channels = [(0, 'window'), (1, 'window')]
+    histograms = get_histograms(conn, reader, 0, 0, channels, 10, 1000)
+    # channel 1 has no window, the range of its data is used
+    assert [(h['min'], h['max']) for h in histograms] == [
+        (100.0, 200.0),
+        (float(planes[1].min()), float(planes[1].max()))]
+    counts, edges = numpy.histogram(planes[0], bins=10, range=(100, 200))
+    assert histograms[0]['data'] == counts.tolist()
+    assert len(conn.query_service.queries) == 1
+    # cached histograms don't need the windows
+    assert get_histograms(
+        conn, reader, 0, 0, channels, 10, 1000) == histograms
+    assert len(conn.query_service.queries) == 1
@@ -149,6 +149,12 @@ export default class Context {
       */
      interpolate = true;
 
+     /**
+      * should projections be saved as background jobs (polling their status)?
+      * @type {boolean}
+      */
+     projection_async = false;
+
      /**
       * application wide keyhandlers.
       * see addKeyListener/removeKeyListener
@@ -389,6 +395,12 @@ export default class Context {
             typeof this.initParams[REQUEST_PARAMS.INTERPOLATE] === 'string' ?
                 this.initParams[REQUEST_PARAMS.INTERPOLATE].toLowerCase() : 'true';
         this.interpolate = (interpolate === 'true');
+
+        let projectionAsync =
+            this.initParams[REQUEST_PARAMS.PROJECTION_ASYNC];
+        this.projection_async =
+            typeof projectionAsync === 'string' &&
+                projectionAsync.toLowerCase() === 'true';
     }
 
     /**
@@ -425,6 +425,8 @@ export default class ImageInfo {
             this.context.getInitialRequestParam(REQUEST_PARAMS.MAPS);
         initialChannels =
             Misc.parseChannelParameters(initialChannels, initialMaps);
+        this.applyChannelPercentiles(
+            response.channels, response.channel_percentiles);
         this.channels =
             this.initAndMixChannelsWithInitialSettings(
                 response.channels, initialChannels);
@@ -640,6 +642,34 @@ export default class ImageInfo {
         return activeChannels;
     }
 
+    /**
+     * Uses the precomputed percentiles (if any) as start/end of the
+     * channels whose window still spans their full range
+     * (i.e. the untouched defaults)
+     *
+     * @memberof ImageInfo
+     * @param {Array.<Object>} channels the existing channels (response)
+     * @param {Object} percentiles the channel percentiles (response)
+     */
+    applyChannelPercentiles(channels, percentiles) {
+        if (!Misc.isArray(channels) || typeof percentiles !== 'object' ||
+            percentiles === null || !Misc.isArray(percentiles.channels))
+                return;
+
+        percentiles.channels.map((p) => {
+            if (typeof p !== 'object' || p === null ||
+                typeof channels[p.index] !== 'object' ||
+                !Misc.isArray(p.values) || p.values.length < 2) return;
+            let w = channels[p.index].window;
+            let start = p.values[0];
+            let end = p.values[p.values.length-1];
+            if (w.start !== w.min || w.end !== w.max ||
+                start < w.min || end > w.max || start >= end) return;
+            w.start = start;
+            w.end = end;
+        });
+    }
+
     /**
      * Performs some more initialization (lut) AND
      * if there are initial settings they are integrated into the channel
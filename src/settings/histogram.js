@@ -18,7 +18,7 @@
 
 import {noView} from 'aurelia-framework';
 import Misc from '../utils/misc';
-import {WEBGATEWAY} from '../utils/constants';
+import {IVIEWER} from '../utils/constants';
 import ImageInfo from '../model/image_info';
 import {
     IMAGE_SETTINGS_CHANGE, IMAGE_DIMENSION_CHANGE, HISTOGRAM_RANGE_UPDATE,
@@ -323,6 +323,10 @@ export default class Histogram extends EventSubscriber {
 
     /**
      * Requests Histogram Data
+     *
+     * The histograms of all active channels (and the given one) of the
+     * present plane are requested in one go and cached
+     *
      * @param {number} channel the channel
      * @param {function} handler the success handler
      * @memberof Histogram
@@ -335,26 +339,38 @@ export default class Histogram extends EventSubscriber {
                 channel > this.image_info.channels.length ||
                 typeof handler !== 'function')) return;
 
-        // assemble url
-        let server = this.image_info.context.server;
-        let uri_prefix = this.image_info.context.getPrefixedURI(WEBGATEWAY);
+        // the channels whose histograms we don't have yet
         let time = this.image_info.dimensions.t;
         let plane = this.image_info.dimensions.z;
-        let url = server + uri_prefix + "/histogram_json/" +
-            this.image_info.image_id + "/channel/" + channel + "/?theT=" +
-            time + "&theZ="+ plane;
+        let channels = [channel];
+        if (Misc.isArray(this.image_info.channels))
+            this.image_info.channels.map((c, i) => {
+                if (c.active && i !== channel && !this.data_cache.has(
+                        "" + i + "/" + plane + "/" + time)) channels.push(i);
+            });
+
+        // assemble url
+        let server = this.image_info.context.server;
+        let uri_prefix = this.image_info.context.getPrefixedURI(IVIEWER);
+        let url = server + uri_prefix + "/histograms/" +
+            this.image_info.image_id + "/?c=" + channels.join(',') +
+            "&t=" + time + "&z=" + plane + "&bins=" + this.graph_cols;
 
         // fire off ajax request
         $.ajax({url : url,
             success : (response) => {
                 // for error and non array data (which is what we want)
                 // we return null and the handler will respond accordingly
-                let data =
+                let histograms =
                     typeof response === 'object' &&
-                        Misc.isArray(response.data) ? response.data : null;
-                if (data) // store requested data
+                        Misc.isArray(response.data) ? response.data : [];
+                let data = null;
+                histograms.map((h) => {
+                    // store requested data
                     this.data_cache.set(
-                        "" + channel + "/" + plane + "/" + time, data);
+                        "" + h.index + "/" + plane + "/" + time, h.data);
+                    if (h.index === channel) data = h.data;
+                });
                 handler(data);
             },
             error : () => handler(null)});
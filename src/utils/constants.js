@@ -118,6 +118,7 @@ export const REQUEST_PARAMS = {
     MODEL: 'M',
     PLANE: 'Z',
     PROJECTION: 'P',
+    PROJECTION_ASYNC: 'PROJECTION_ASYNC',
     SERVER: 'SERVER',
     TIME: 'T',
     VERSION: 'VERSION',
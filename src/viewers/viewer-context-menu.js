@@ -287,31 +287,16 @@ export default class ViewerContextMenu {
                 typeof imgInf.parent_id === 'number')
                     url += "&dataset=" + imgInf.parent_id;
 
+            // background jobs are only known to the web worker running
+            // them, which is why they have to be enabled on the server
+            if (this.context.projection_async) url += "&async=true";
+
             $.ajax({
                 url: url,
                 success: (resp) => {
-                    let msg = "";
-                    if (typeof resp.id === 'number') {
-                        let linkWebclient = this.context.server +
-                            this.context.getPrefixedURI(WEBCLIENT) +
-                            "/?show=image-" + resp.id;
-                        let linkIviewer = this.context.server +
-                            this.context.getPrefixedURI(IVIEWER) +
-                            "/?images=" + resp.id;
-                        if (this.context.initial_type !== INITIAL_TYPES.WELL &&
-                            typeof imgInf.parent_id === 'number')
-                                linkIviewer += "&dataset=" + imgInf.parent_id;
-                    msg =
-                        "<a href='" + linkWebclient + "' target='_blank'>" +
-                        "Navigate to Image in Webclient</a><br>" +
-                        "<br><a href='" + linkIviewer + "' target='_blank'>" +
-                        "Open Image in iviewer</a>";
-                    } else {
-                        msg = "Failed to create projected image";
-                        if (typeof resp.error === 'string')
-                            console.error(resp.error);
-                    }
-                    Ui.showModalMessage(msg, 'Close');
+                    if (typeof resp.job === 'string')
+                        this.pollProjectionJob(resp.job);
+                    else this.showProjectionResult(resp.error, resp.id);
                 }
             });
         }
@@ -321,6 +306,57 @@ export default class ViewerContextMenu {
         return false;
     }
 
+    /**
+     * Polls the status of a projection job until it has finished or failed
+     *
+     * @param {string} job the job id
+     * @memberof ViewerContextMenu
+     */
+    pollProjectionJob(job) {
+        $.ajax({
+            url: this.context.server + this.context.getPrefixedURI(IVIEWER) +
+                 '/projection_status/?job=' + job,
+            success: (resp) => {
+                if (resp.state === 'queued' || resp.state === 'running')
+                    setTimeout(() => this.pollProjectionJob(job), 1000);
+                else this.showProjectionResult(resp.error, resp.result);
+            },
+            error: () => this.showProjectionResult("Lost projection job")
+        });
+    }
+
+    /**
+     * Shows the links to the projected image or an error message
+     *
+     * @param {string} error an error message if the projection failed
+     * @param {number} id the id of the projected image
+     * @memberof ViewerContextMenu
+     */
+    showProjectionResult(error, id) {
+        let imgInf = this.image_config.image_info;
+        let msg = "";
+        if (typeof id === 'number') {
+            let linkWebclient = this.context.server +
+                this.context.getPrefixedURI(WEBCLIENT) +
+                "/?show=image-" + id;
+            let linkIviewer = this.context.server +
+                this.context.getPrefixedURI(IVIEWER) +
+                "/?images=" + id;
+            if (this.context.initial_type !== INITIAL_TYPES.WELL &&
+                typeof imgInf.parent_id === 'number')
+                    linkIviewer += "&dataset=" + imgInf.parent_id;
+            msg =
+                "<a href='" + linkWebclient + "' target='_blank'>" +
+                "Navigate to Image in Webclient</a><br>" +
+                "<br><a href='" + linkIviewer + "' target='_blank'>" +
+                "Open Image in iviewer</a>";
+        } else {
+            msg = "Failed to create projected image";
+            if (typeof error === 'string') console.error(error);
+        }
+        Ui.showModalMessage(msg, 'Close');
+    }
+
     /**
      * Sends event to captures viewport as png
      *